@@ -1,4 +1,15 @@
-import peakpo
+import os
+import sys
+import runpy
+
+# modules of peakpo import each other as top level modules
+peakpo_dir = os.path.dirname(os.path.abspath(__file__))
+if peakpo_dir not in sys.path:
+    sys.path.insert(0, peakpo_dir)
 
 if __name__ == '__main__':
-    peakpo()
+    from cli import COMMANDS
+    if sys.argv[1:2] in [[command] for command in COMMANDS]:
+        from cli import main
+        sys.exit(main(sys.argv[1:]))
+    runpy.run_path(os.path.join(peakpo_dir, 'peakpo.py'), run_name='__main__')
@@ -0,0 +1,377 @@
+"""
+Headless processing of a directory of diffraction data, so that the GUI
+finds background, cake and peak fitting results in temp files later.
+
+    python -m peakpo batch <directory> --poni <file.poni> --settings <file>
+    python -m peakpo propagate <file.dpp> --chains 2
+
+propagate fits the sections saved in a dpp to all chi files in the same
+directory in order of pressure, see model.propagate.
+
+Settings file is JSON, all keys are optional:
+
+    {"wavelength": 0.3344,
+     "bg_roi": [6.0, 21.0],
+     "bg_params": [20, 10, 20],
+     "bg_engine": "cheb",
+     "mask": [0, 10000000],
+     "cake": true,
+     "cake_compression": null,
+     "cake_max_error": null,
+     "sections": [{"roi": [8.0, 9.0], "poly_order": 1,
+                   "maxwidth": 0.3, "centerrange": 0.3,
+                   "peaks": [{"center": 8.5, "fwhm": 0.01,
+                              "phasename": "unknown", "hkl": [1, 1, 1]}]}]}
+
+bg_engine is "cheb", "snip" or "als", bg_params are for the engine.
+cake_compression is null, "zlib" or "zlib-quantized".  The last one keeps
+intensity errors within cake_max_error.
+"""
+import os
+import glob
+import json
+import time
+import hashlib
+import argparse
+import datetime
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+DEFAULT_SETTINGS = {'wavelength': 0.3344,
+                    'bg_roi': [6.0, 21.0],
+                    'bg_params': [20, 10, 20],
+                    'bg_engine': 'cheb',
+                    'mask': [0, 10000000],
+                    'cake': True,
+                    'cake_compression': None,
+                    'cake_max_error': None,
+                    'sections': []}
+IMAGE_EXTENSIONS = ['tif', 'tiff', 'mar3450', 'cbf']
+CHECKPOINT_FILENAME = 'peakpo-batch.json'
+# first arguments which start the command line instead of the GUI
+COMMANDS = ['batch', 'propagate']
+
+
+def _now():
+    return str(datetime.datetime.now())[:-7]
+
+
+def read_settings(filen):
+    settings = dict(DEFAULT_SETTINGS)
+    if filen is not None:
+        with open(filen) as f:
+            settings.update(json.load(f))
+    return settings
+
+
+def _hash_settings(settings, poni_filen):
+    h = hashlib.sha1(json.dumps(settings, sort_keys=True).encode())
+    if poni_filen is not None:
+        with open(poni_filen, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _get_stamp(chi_filen):
+    stamp = []
+    from utils import find_associated_image
+    for filen in [chi_filen, find_associated_image(chi_filen)]:
+        if (filen is None) or (not os.path.exists(filen)):
+            stamp += [0, 0]
+        else:
+            stat = os.stat(filen)
+            stamp += [stat.st_size, stat.st_mtime_ns]
+    return stamp
+
+
+def integrate_images_without_chi(directory, poni_filen, settings):
+    """
+    make chi files from images which do not have one yet
+    """
+    from ds_cake import DiffImg
+    from utils import writechi
+    chi_filens = []
+    for ext in IMAGE_EXTENSIONS:
+        for img_filen in sorted(glob.glob(os.path.join(directory, '*.' + ext))):
+            chi_filen = os.path.splitext(img_filen)[0] + '.chi'
+            if os.path.exists(chi_filen) or (chi_filen in chi_filens):
+                continue
+            diff_img = DiffImg()
+            diff_img.load(img_filen)
+            diff_img.set_calibration(poni_filen)
+            diff_img.set_mask(settings['mask'])
+            tth, intensity = diff_img.integrate_to_1d()
+            writechi(chi_filen, tth, intensity,
+                     preheader='# ' + os.path.basename(img_filen) +
+                     '\n2-theta\n\n')
+            chi_filens.append(chi_filen)
+    return chi_filens
+
+
+def process_file(chi_filen, poni_filen, settings):
+    """
+    Background subtraction, caking and section fitting for a chi file.
+    Results go to the -param directory, where the GUI looks for them.
+    Top level function so that it can be sent to a process pool.
+
+    :return: list of output files
+    """
+    from ds_powdiff import PatternPeakPo, bg_cache, get_bg_cache_dir
+    from ds_cake import make_temp_cake
+    from utils import get_temp_dir
+    t_start = time.time()
+    temp_dir = get_temp_dir(chi_filen)
+    outputs = []
+    ptn = PatternPeakPo()
+    ptn.read_file(chi_filen, sidecar=True)
+    ptn.wavelength = settings['wavelength']
+    if not ptn.read_bg_from_tempfile(temp_dir=temp_dir,
+                                     roi=settings['bg_roi'],
+                                     params=settings['bg_params'],
+                                     engine=settings['bg_engine']):
+        ptn.get_chbg(settings['bg_roi'], params=settings['bg_params'],
+                     yshift=0, cache=bg_cache,
+                     cache_dir=get_bg_cache_dir(chi_filen),
+                     engine=settings['bg_engine'])
+        ptn.write_temporary_bgfiles(temp_dir)
+    outputs += list(ptn.make_temp_filenames(temp_dir=temp_dir))
+    if settings['cake'] and (poni_filen is not None):
+        cake_filen = make_temp_cake(
+            chi_filen, poni_filen, settings['mask'],
+            compression=settings['cake_compression'],
+            max_error=settings['cake_max_error'])
+        if cake_filen is not None:
+            outputs.append(cake_filen)
+    if settings['sections'] != []:
+        filen_xls = fit_sections(ptn, settings['sections'], temp_dir)
+        if filen_xls is not None:
+            outputs.append(filen_xls)
+    print(_now(), ": Batch processing of ", chi_filen,
+          " takes {0:.2f}s".format(time.time() - t_start))
+    return outputs
+
+
+def fit_sections(ptn, sections, temp_dir):
+    """
+    fit sections the same way as PeakFitController and save the results
+    to the same xls file as the GUI
+
+    :return: xls filename, None if no section was fitted
+    """
+    from model import PeakPoModel
+    from ds_section import Section
+    from utils import make_filename
+    model = PeakPoModel()
+    model.base_ptn = ptn
+    for setting in sections:
+        model.current_section = Section()
+        model.set_current_section(setting['roi'])
+        for peak in setting['peaks']:
+            model.current_section.set_single_peak(
+                peak['center'], peak.get('fwhm', 0.01),
+                hkl=peak.get('hkl', [0, 0, 0]),
+                phase_name=peak.get('phasename', 'unknown'))
+        if not model.current_section.peaks_exist():
+            print(_now(), ": No peak in section ", setting['roi'])
+            continue
+        model.current_section.prepare_for_fitting(
+            setting.get('poly_order', 1), setting.get('maxwidth', 0.3),
+            setting.get('centerrange', 0.3))
+        if model.current_section.conduct_fitting():
+            model.save_current_section()
+    if not model.section_list_exist():
+        return None
+    filen_xls = make_filename(ptn.fname, 'peakfit.xls', temp_dir=temp_dir)
+    model.save_peak_fit_results_to_xls(filen_xls)
+    return filen_xls
+
+
+class Checkpoint(object):
+    """
+    Files already processed with the same settings, so that an interrupted
+    run can resume.  Saved after every file.
+    """
+
+    def __init__(self, filen, settings_key):
+        self.filen = filen
+        self.settings_key = settings_key
+        self.done = {}
+        if os.path.exists(filen):
+            try:
+                with open(filen) as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                saved = {}
+            if saved.get('settings') == settings_key:
+                self.done = saved.get('files', {})
+
+    def is_done(self, chi_filen):
+        return self.done.get(os.path.basename(chi_filen)) == \
+            _get_stamp(chi_filen)
+
+    def set_done(self, chi_filen):
+        self.done[os.path.basename(chi_filen)] = _get_stamp(chi_filen)
+        temp_filen = self.filen + '.tmp'
+        with open(temp_filen, 'w') as f:
+            json.dump({'settings': self.settings_key, 'files': self.done}, f)
+        os.replace(temp_filen, self.filen)
+
+
+def run_batch(directory, poni_filen=None, settings=None, max_workers=None,
+              checkpoint_filen=None, restart=False):
+    """
+    :return: number of files failed
+    """
+    if settings is None:
+        settings = dict(DEFAULT_SETTINGS)
+    t_start = time.time()
+    if poni_filen is not None:
+        integrate_images_without_chi(directory, poni_filen, settings)
+    chi_filens = sorted(
+        f for f in glob.glob(os.path.join(directory, '*.chi'))
+        if not f.endswith(('.bg.chi', '.bgsub.chi')))
+    if checkpoint_filen is None:
+        checkpoint_filen = os.path.join(directory, CHECKPOINT_FILENAME)
+    if restart and os.path.exists(checkpoint_filen):
+        os.remove(checkpoint_filen)
+    checkpoint = Checkpoint(checkpoint_filen,
+                            _hash_settings(settings, poni_filen))
+    to_do = [f for f in chi_filens if not checkpoint.is_done(f)]
+    n_total = to_do.__len__()
+    print(_now(), ": Batch processing {0:d} of {1:d} files in {2:s}".format(
+        n_total, chi_filens.__len__(), directory))
+    failed = []
+
+    def report(chi_filen, error=None):
+        if error is None:
+            checkpoint.set_done(chi_filen)
+        else:
+            failed.append(chi_filen)
+            print(_now(), ": Failed ", chi_filen, "\n", error)
+        n_finished = n_total - remaining.__len__()
+        print(_now(), ": [{0:d}/{1:d}] {2:s}".format(
+            n_finished, n_total, os.path.basename(chi_filen)))
+
+    def process_here(chi_filen):
+        remaining.remove(chi_filen)
+        try:
+            process_file(chi_filen, poni_filen, settings)
+        except Exception:
+            report(chi_filen, error=traceback.format_exc())
+            return
+        report(chi_filen)
+
+    remaining = list(to_do)
+    # the first file makes the disk caches for lookup tables, the others
+    # read them instead of making their own
+    if remaining != []:
+        process_here(remaining[0])
+    if remaining.__len__() > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(process_file, f, poni_filen,
+                                           settings): f for f in remaining}
+                for future in as_completed(futures):
+                    chi_filen = futures[future]
+                    try:
+                        future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as inst:
+                        remaining.remove(chi_filen)
+                        report(chi_filen, error=inst)
+                        continue
+                    remaining.remove(chi_filen)
+                    report(chi_filen)
+        except (BrokenProcessPool, OSError) as inst:
+            print(_now(), ": Process pool failed, process one by one: ", inst)
+    for chi_filen in list(remaining):
+        process_here(chi_filen)
+    print(_now(), ": Batch processing finished in {0:.2f}s, "
+          "{1:d} failed".format(time.time() - t_start, failed.__len__()))
+    return failed.__len__()
+
+
+def run_propagate(filen_dpp, n_chains=2, max_workers=None, eos_shift=True,
+                  maxwidth=0.3, centerrange=0.3):
+    """
+    :return: number of files failed
+    """
+    from model import propagate_sections, DEFAULT_PROPAGATE_SETTINGS, \
+        load_dpp
+    from utils import change_file_path
+    directory = os.path.dirname(os.path.abspath(filen_dpp))
+    model = load_dpp(filen_dpp)
+    if not model.section_list_exist():
+        print(_now(), ": No section in ", filen_dpp)
+        return 1
+    # dpp may have been moved with the data
+    model.base_ptn.fname = change_file_path(model.base_ptn.fname, directory)
+    settings = dict(DEFAULT_PROPAGATE_SETTINGS)
+    settings.update({'wavelength': model.base_ptn.wavelength,
+                     'bg_roi': list(model.base_ptn.roi),
+                     'bg_params': list(model.base_ptn.params_chbg),
+                     'bg_engine': model.base_ptn.bg_engine,
+                     'maxwidth': maxwidth,
+                     'centerrange': centerrange,
+                     'eos_shift': eos_shift,
+                     'temperature': model.get_saved_temperature()})
+    chi_filens = sorted(
+        f for f in glob.glob(os.path.join(directory, '*.chi'))
+        if not f.endswith(('.bg.chi', '.bgsub.chi')))
+    results = propagate_sections(model, chi_filens, settings=settings,
+                                 n_chains=n_chains, max_workers=max_workers)
+    for chi_filen, __, error in results:
+        if error is not None:
+            print(_now(), ": Failed ", chi_filen, "\n", error)
+    return [r for r in results if r[2] is not None].__len__()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='peakpo')
+    subparsers = parser.add_subparsers(dest='command')
+    batch = subparsers.add_parser(
+        'batch', help='process a directory of chi and image files')
+    batch.add_argument('directory')
+    batch.add_argument('--poni', default=None, help='pyFAI PONI file')
+    batch.add_argument('--settings', default=None, help='JSON settings file')
+    batch.add_argument('--workers', type=int, default=None,
+                       help='number of processes, default is number of cpus')
+    batch.add_argument('--checkpoint', default=None,
+                       help='checkpoint file, default is ' +
+                       CHECKPOINT_FILENAME + ' in the directory')
+    batch.add_argument('--restart', action='store_true',
+                       help='ignore the checkpoint and process all files')
+    propagate = subparsers.add_parser(
+        'propagate', help='fit the sections of a dpp to all chi files ' +
+        'in its directory, in order of pressure')
+    propagate.add_argument('dpp')
+    propagate.add_argument('--chains', type=int, default=2,
+                           help='number of chains fitted at the same time')
+    propagate.add_argument('--workers', type=int, default=None,
+                           help='number of processes, default is number ' +
+                           'of cpus')
+    propagate.add_argument('--no-eos', action='store_true',
+                           help='do not move peaks by the JCPDS equation ' +
+                           'of state')
+    propagate.add_argument('--maxwidth', type=float, default=0.3)
+    propagate.add_argument('--centerrange', type=float, default=0.3)
+    args = parser.parse_args(argv)
+    if args.command == 'propagate':
+        n_failed = run_propagate(args.dpp, n_chains=args.chains,
+                                 max_workers=args.workers,
+                                 eos_shift=not args.no_eos,
+                                 maxwidth=args.maxwidth,
+                                 centerrange=args.centerrange)
+        return 1 if n_failed > 0 else 0
+    if args.command != 'batch':
+        parser.print_help()
+        return 2
+    n_failed = run_batch(os.path.abspath(args.directory),
+                         poni_filen=args.poni,
+                         settings=read_settings(args.settings),
+                         max_workers=args.workers,
+                         checkpoint_filen=args.checkpoint,
+                         restart=args.restart)
+    return 1 if n_failed > 0 else 0
@@ -3,6 +3,8 @@ from PyQt5 import QtWidgets
 from utils import get_sorted_filelist, find_from_filelist, readchi, \
     make_filename, writechi, get_directory
 from utils import undo_button_press, get_temp_dir
+from ds_powdiff import bg_cache, get_bg_cache_dir, PatternPrefetcher, \
+    BG_ENGINES
 import datetime
 from .mplcontroller import MplController
 from .cakecontroller import CakeController
@@ -15,13 +17,38 @@ class BasePatternController(object):
         self.widget = widget
         self.plot_ctrl = MplController(self.model, self.widget)
         self.cake_ctrl = CakeController(self.model, self.widget)
+        self.prefetcher = PatternPrefetcher()
         self.connect_channel()
+        self._update_bg_labels_in_widget()
 
     def connect_channel(self):
         self.widget.pushButton_NewBasePtn.clicked.connect(
             self.select_base_ptn)
         self.widget.lineEdit_DiffractionPatternFileName.editingFinished.\
             connect(self.load_new_base_pattern_from_name)
+        self.widget.comboBox_BGEngine.currentIndexChanged.connect(
+            self.change_bg_engine)
+
+    def change_bg_engine(self):
+        """
+        parameters of one engine mean nothing to another, so start from
+        the defaults of the new engine
+        """
+        defaults = BG_ENGINES[self._get_bg_engine_in_widget()].defaults
+        self.widget.spinBox_BGParam0.setValue(defaults[0])
+        self.widget.spinBox_BGParam1.setValue(defaults[1])
+        self.widget.spinBox_BGParam2.setValue(defaults[2])
+        self._update_bg_labels_in_widget()
+
+    def _get_bg_engine_in_widget(self):
+        return list(BG_ENGINES)[self.widget.comboBox_BGEngine.currentIndex()]
+
+    def _update_bg_labels_in_widget(self):
+        engine = BG_ENGINES[self._get_bg_engine_in_widget()]
+        for label, name, default in zip(
+                [self.widget.label_4, self.widget.label_6,
+                 self.widget.label_5], engine.labels, engine.defaults):
+            label.setText('{0:s} ({1:d}):'.format(name, default))
 
     def select_base_ptn(self):
         """
@@ -64,7 +91,9 @@ class BasePatternController(object):
         load and process base pattern.  does not signal to update_graph
         """
         self.model.set_base_ptn(
-            new_filename, self.widget.doubleSpinBox_SetWavelength.value())
+            new_filename, self.widget.doubleSpinBox_SetWavelength.value(),
+            sidecar=self.widget.checkBox_UseTempBGSub.isChecked(),
+            prefetched=self.prefetcher.take(new_filename))
         # self.widget.textEdit_DiffractionPatternFileName.setText(
         #    '1D Pattern: ' + self.model.get_base_ptn_filename())
         self.widget.lineEdit_DiffractionPatternFileName.setText(
@@ -111,7 +140,30 @@ class BasePatternController(object):
             # not sure this is correct.
             # self.cake_ctrl.addremove_cake(update_plot=False)
 
+    def prefetch_neighbors(self, filelist, idx, step, n_files=2):
+        """
+        load n_files patterns on each side of filelist[idx] in the
+        background, step apart as in the file navigation.
+        """
+        filenames = []
+        for i in range(1, n_files + 1):
+            for idx_new in [idx + i * step, idx - i * step]:
+                if (idx_new >= 0) and (idx_new < filelist.__len__()):
+                    filenames.append(filelist[idx_new])
+        self.prefetcher.prefetch(
+            filenames,
+            [self.widget.doubleSpinBox_Background_ROI_min.value(),
+             self.widget.doubleSpinBox_Background_ROI_max.value()],
+            [self.widget.spinBox_BGParam0.value(),
+             self.widget.spinBox_BGParam1.value(),
+             self.widget.spinBox_BGParam2.value()],
+            use_temp=self.widget.checkBox_UseTempBGSub.isChecked(),
+            engine=self._get_bg_engine_in_widget())
+
     def _update_bg_params_in_widget(self):
+        # engine first, as changing it resets the parameters
+        self.widget.comboBox_BGEngine.setCurrentIndex(
+            list(BG_ENGINES).index(self.model.base_ptn.bg_engine))
         self.widget.spinBox_BGParam0.setValue(
             self.model.base_ptn.params_chbg[0])
         self.widget.spinBox_BGParam1.setValue(
@@ -124,6 +176,10 @@ class BasePatternController(object):
             self.model.base_ptn.roi[1])
 
     def _update_bgsub_from_current_values(self):
+        """
+        fitted backgrounds are cached in memory and, if temp files are
+        used, on disk, so going back to a pattern does not refit.
+        """
         x_raw, y_raw = self.model.base_ptn.get_raw()
         if (x_raw.min() >= self.widget.doubleSpinBox_Background_ROI_min.value()) or \
                 (x_raw.max() <= self.widget.doubleSpinBox_Background_ROI_min.value()):
@@ -131,14 +187,22 @@ class BasePatternController(object):
         if (x_raw.max() <= self.widget.doubleSpinBox_Background_ROI_max.value()) or \
                 (x_raw.min() >= self.widget.doubleSpinBox_Background_ROI_max.value()):
             self.widget.doubleSpinBox_Background_ROI_max.setValue(x_raw.max())
+        if self.widget.checkBox_UseTempBGSub.isChecked():
+            cache_dir = get_bg_cache_dir(self.model.get_base_ptn_filename())
+        else:
+            cache_dir = None
         self.model.base_ptn.subtract_bg(
             [self.widget.doubleSpinBox_Background_ROI_min.value(),
                 self.widget.doubleSpinBox_Background_ROI_max.value()],
             [self.widget.spinBox_BGParam0.value(),
                 self.widget.spinBox_BGParam1.value(),
-                self.widget.spinBox_BGParam2.value()], yshift=0)
+                self.widget.spinBox_BGParam2.value()], yshift=0,
+            cache=bg_cache, cache_dir=cache_dir,
+            engine=self._get_bg_engine_in_widget())
         temp_dir = get_temp_dir(self.model.get_base_ptn_filename())
-        self.model.base_ptn.write_temporary_bgfiles(temp_dir)
+        # prefetcher may have written them already
+        if not self.model.base_ptn.temp_files_current(temp_dir):
+            self.model.base_ptn.write_temporary_bgfiles(temp_dir)
 
     def apply_changes_to_graph(self):
         self.plot_ctrl.update()
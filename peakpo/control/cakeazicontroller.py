@@ -75,6 +75,8 @@ class CakeAziController(object):
         if azi_list is None:
             return
         __, __, azi_whole = self.model.diff_img.get_cake()
+        if azi_whole is None:
+            return
         new_azi_list = []
         epsilon = 0.01
         if azi_list.__len__() == 1:
@@ -207,8 +209,7 @@ class CakeAziController(object):
             return None
         # self.produce_cake()
         self.cakemake_ctrl.read_settings()
-        tth = []
-        intensity = []
+        azimuth_ranges = []
         mid_angle = self.widget.spinBox_AziShift.value()
         for azi_i in azi_list:
             azi_conv = []
@@ -226,19 +227,11 @@ class CakeAziController(object):
                     azi_real.append(azi_conv_i - 360)
                 else:
                     azi_real.append(azi_conv_i)
-            tth_i, intensity_i = self.model.diff_img.integrate_to_1d(
-                azimuth_range=(azi_real[0], azi_real[1]))
-            tth.append(tth_i)
-            intensity.append(intensity_i)
-        intensity_merged = np.zeros_like(intensity[0])
-        for tth_i, intensity_i in zip(tth, intensity):
-            if not np.array_equal(tth_i, tth[0]):
-                QtWidgets.QMessageBox.warning(
-                    self.widget, 'Warning',
-                    'Error occured while preparing for azimuthal ' + \
-                    'integration. No output.')
-                return None
-            intensity_merged += intensity_i
+            azimuth_ranges.append((azi_real[0], azi_real[1]))
+        # all ranges share the same tth bins
+        tth, intensity = self.model.diff_img.integrate_to_1d_sectors(
+            azimuth_ranges, cache_dir=self.cakemake_ctrl.get_cache_dir())
+        intensity_merged = np.sum(intensity, axis=0)
         n_azi = azi_list.__len__()
         first_azi = azi_list[0]
         intensity_output = intensity_merged
@@ -254,7 +247,7 @@ class CakeAziController(object):
         preheader_line0 = azi_text + ' \n'
         preheader_line1 = '2-theta\n'
         preheader_line2 = '\n'
-        writechi(filen_chi, tth[0], intensity_output,
+        writechi(filen_chi, tth, intensity_output,
                  preheader=preheader_line0 + preheader_line1 +
                  preheader_line2)
         self._save_cake_marker_file()
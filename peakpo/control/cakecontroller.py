@@ -1,11 +1,14 @@
 import os
 import shutil
-from PyQt5 import QtWidgets
+from PyQt5 import QtWidgets, QtCore
 import numpy as np
 from utils import dialog_savefile, writechi, get_directory, make_filename, \
-    get_temp_dir, extract_filename, extract_extension, InformationBox
+    get_temp_dir, extract_filename, extract_extension, InformationBox, \
+    get_sorted_filelist
 from .mplcontroller import MplController
 from .cakemakecontroller import CakemakeController
+from .taskrunner import get_task_runner
+from ds_cake import hash_file, CakePrecomputer
 from PIL import Image
 import json
 import datetime
@@ -17,10 +20,19 @@ class CakeController(object):
         self.widget = widget
         self.cakemake_ctrl = CakemakeController(self.model, self.widget)
         self.plot_ctrl = MplController(self.model, self.widget)
+        self.precomputer = CakePrecomputer()
+        self.task_runner = get_task_runner(self.widget)
+        self._cake_task = None
+        self.precompute_timer = QtCore.QTimer()
+        self.precompute_timer.timeout.connect(self._show_precompute_progress)
         self.connect_channel()
 
     def connect_channel(self):
         self.widget.pushButton_Info.clicked.connect(self.show_tif_header)
+        self.widget.checkBox_PrecomputeCake.clicked.connect(
+            self.precompute_cakes)
+        self.widget.spinBox_PrecomputeWorkers.valueChanged.connect(
+            self.precompute_cakes)
         self.widget.checkBox_ShowCake.clicked.connect(
             self.addremove_cake)
         self.widget.pushButton_GetPONI.clicked.connect(self.get_poni)
@@ -41,10 +53,7 @@ class CakeController(object):
 
     def update_cake(self):
         if self.model.poni_exist():
-            self.produce_cake()
-            temp_dir = get_temp_dir(self.model.get_base_ptn_filename())
-            self.model.diff_img.write_temp_cakefiles(temp_dir=temp_dir)
-            self._apply_changes_to_graph()
+            self.produce_cake(write_temp=True)
 
     """
     def load_cake_format_file(self):
@@ -91,12 +100,53 @@ class CakeController(object):
 
     def reset_max_cake_scale(self):
         intensity_cake, _, _ = self.model.diff_img.get_cake()
+        if intensity_cake is None:
+            return
         self.widget.spinBox_MaxCakeScale.setValue(intensity_cake.max())
         self._apply_changes_to_graph()
 
     def _apply_changes_to_graph(self):
         self.plot_ctrl.update()
 
+    def precompute_cakes(self):
+        """
+        make temp cakes for the other images in the folder in the
+        background, starting from the files next to the current one
+        """
+        if not (self.widget.checkBox_PrecomputeCake.isChecked() and
+                self.widget.checkBox_UseTempCake.isChecked()):
+            self.precomputer.clear()
+            self._show_precompute_progress()
+            return
+        if (not self.model.poni_exist()) or \
+                (not os.path.exists(self.model.poni)) or \
+                (not self.model.base_ptn_exist()):
+            return
+        filelist = get_sorted_filelist(
+            self.model.chi_path,
+            sorted_by_name=self.widget.radioButton_SortbyNme.isChecked(),
+            search_ext='*.chi', cached=True)
+        self.precomputer.start(
+            filelist, self.model.poni,
+            (self.widget.spinBox_MaskMin.value(),
+             self.widget.spinBox_MaskMax.value()),
+            current=self.model.get_base_ptn_filename(),
+            max_workers=self.widget.spinBox_PrecomputeWorkers.value())
+        if not self.precompute_timer.isActive():
+            self.precompute_timer.start(500)
+
+    def _show_precompute_progress(self):
+        n_finished, n_total, n_failed = self.precomputer.get_progress()
+        if n_total == 0:
+            self.widget.label_CakeQueue.setText('')
+        else:
+            text = 'Cakes: {0:d}/{1:d}'.format(n_finished, n_total)
+            if n_failed > 0:
+                text += ' ({0:d} failed)'.format(n_failed)
+            self.widget.label_CakeQueue.setText(text)
+        if not self.precomputer.is_active():
+            self.precompute_timer.stop()
+
     def show_tif_header(self):
         if not self.model.base_ptn_exist():
             return
@@ -198,15 +248,37 @@ class CakeController(object):
 
     def apply_mask(self):
         self.produce_cake()
-        self._apply_changes_to_graph()
+        self.precompute_cakes()
 
-    def produce_cake(self):
+    def produce_cake(self, write_temp=False):
         """
-        Reprocess to get cake.  Slower re - processing
-        does not signal to update_graph
+        Reprocess to get cake.  Slower re - processing, so the cake is
+        made in a worker thread and the graph is updated when it is ready.
+
+        :param write_temp: write the cake to the temp file when ready
         """
         self._load_new_image()
-        self.cakemake_ctrl.cook()
+        self.cakemake_ctrl.read_settings()
+        diff_img = self.model.diff_img
+        cache_dir = self.cakemake_ctrl.get_cache_dir()
+        # an older cake is not needed any more
+        if self._cake_task is not None:
+            self._cake_task.cancel()
+        self._cake_task = self.task_runner.submit(
+            lambda task: diff_img.make_cake(cache_dir=cache_dir),
+            on_finished=lambda cake: self._finish_cake(
+                diff_img, cake, write_temp),
+            message='Caking ' + os.path.basename(diff_img.img_filename))
+
+    def _finish_cake(self, diff_img, cake, write_temp):
+        if self.model.diff_img is not diff_img:
+            # another image was loaded in the mean time
+            return
+        diff_img.set_cake(*cake)
+        if write_temp:
+            temp_dir = get_temp_dir(self.model.get_base_ptn_filename())
+            diff_img.write_temp_cakefiles(temp_dir=temp_dir)
+        self._apply_changes_to_graph()
 
     def process_temp_cake(self):
         """
@@ -222,25 +294,71 @@ class CakeController(object):
         if self.widget.checkBox_UseTempCake.isChecked():
             #if os.path.exists(temp_dir):
             self._load_new_image()
-            success = self.model.diff_img.read_cake_from_tempfile(
-                temp_dir=temp_dir)
-            if success:
-                print(str(datetime.datetime.now())[:-7], 
-                    ": Load cake image from temporary file.")
-                pass
+            future = self.precomputer.claim(
+                self.model.get_base_ptn_filename())
+            if (future is None) or future.done():
+                self._read_temp_cake(self.model.diff_img, temp_dir)
             else:
-                print(str(datetime.datetime.now())[:-7], 
-                    ": Create new temporary file for cake image.")
-                self._update_temp_cake_files(temp_dir)
+                self._wait_for_precomputed_cake(future, temp_dir)
             #else:
                 #os.makedirs(temp_dir)
                 #self._update_temp_cake_files(temp_dir)
         else:
             self._update_temp_cake_files(temp_dir)
+        self.precompute_cakes()
+
+    def _wait_for_precomputed_cake(self, future, temp_dir):
+        """
+        waiting for a worker caking the current file is faster than
+        caking again.  The temp cake is read when the worker is done,
+        without blocking the GUI.
+        """
+        diff_img = self.model.diff_img
+        if self._cake_task is not None:
+            self._cake_task.cancel()
+        self._cake_task = self.task_runner.watch(
+            future,
+            on_finished=lambda result: self._read_temp_cake(
+                diff_img, temp_dir, update_graph=True),
+            on_failed=lambda text: self._read_temp_cake(
+                diff_img, temp_dir, update_graph=True),
+            message='Caking ' + os.path.basename(diff_img.img_filename))
+
+    def _read_temp_cake(self, diff_img, temp_dir, update_graph=False):
+        """
+        make a new cake if the temp cake cannot be used
+
+        :param update_graph: replot after reading, for a cake read later
+            than the pattern was plotted
+        """
+        if self.model.diff_img is not diff_img:
+            # another image was loaded in the mean time
+            return
+        success = diff_img.read_cake_from_tempfile(
+            temp_dir=temp_dir, poni_hash=self._get_poni_hash(),
+            mask_range=(self.widget.spinBox_MaskMin.value(),
+                        self.widget.spinBox_MaskMax.value()))
+        if success:
+            print(str(datetime.datetime.now())[:-7], 
+                ": Load cake image from temporary file.")
+            if update_graph:
+                self._apply_changes_to_graph()
+        else:
+            print(str(datetime.datetime.now())[:-7], 
+                ": Create new temporary file for cake image.")
+            self._update_temp_cake_files(temp_dir)
+
+    def _get_poni_hash(self):
+        """
+        cakes in temp files made with a different PONI are not used
+        """
+        if (not self.model.poni_exist()) or \
+                (not os.path.exists(self.model.poni)):
+            return None
+        return hash_file(self.model.poni)
 
     def _update_temp_cake_files(self, temp_dir):
-        self.produce_cake()
-        self.model.diff_img.write_temp_cakefiles(temp_dir=temp_dir)
+        self.produce_cake(write_temp=True)
 
     def get_poni(self):
         """
@@ -263,6 +381,7 @@ class CakeController(object):
             if self.model.diff_img_exist():
                 self.produce_cake()
             self._apply_changes_to_graph()
+            self.precompute_cakes()
 
     def load_new_poni_from_name(self):
         if self.widget.lineEdit_PONI.isModified():
@@ -273,6 +392,7 @@ class CakeController(object):
                 if self.model.diff_img_exist():
                     self.produce_cake()
                 self._apply_changes_to_graph()
+                self.precompute_cakes()
             else:
                 QtWidgets.QMessageBox.warning(
                     self.widget, 'Warning', 'The PONI file does not exist.')
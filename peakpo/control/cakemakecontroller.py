@@ -1,6 +1,7 @@
 import os
 from PyQt5 import QtWidgets
 from utils import undo_button_press, dialog_savefile, writechi
+from ds_cake import get_lut_cache_dir
 
 
 class CakemakeController(object):
@@ -14,6 +15,14 @@ class CakemakeController(object):
         self.model.diff_img.set_mask((self.widget.spinBox_MaskMin.value(),
                                       self.widget.spinBox_MaskMax.value()))
 
+    def get_cache_dir(self):
+        """
+        lookup tables are kept on disk only when temp files are used
+        """
+        if self.widget.checkBox_UseTempCake.isChecked():
+            return get_lut_cache_dir(self.model.diff_img.img_filename)
+        return None
+
     def cook(self):
         self.read_settings()
-        self.model.diff_img.integrate_to_cake()
+        self.model.diff_img.integrate_to_cake(cache_dir=self.get_cache_dir())
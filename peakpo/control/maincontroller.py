@@ -23,13 +23,14 @@ from .sessioncontroller import SessionController
 from .peakfitcontroller import PeakFitController
 from .peakfittablecontroller import PeakfitTableController
 from .cakeazicontroller import CakeAziController
+from .taskrunner import get_task_runner
 from utils import dialog_savefile, writechi, extract_extension, \
     convert_wl_to_energy, get_sorted_filelist, find_from_filelist, \
     make_filename, get_directory, get_temp_dir
 # do not change the module structure for ds_jcpds and ds_powdiff for
 # retro compatibility
-from ds_jcpds import UnitCell
-from ds_powdiff import get_DataSection
+from ds_jcpds import UnitCell, ReflectionIndex
+from ds_powdiff import get_DataSection, BG_ENGINES
 
 
 # from utils import readchi, make_filename, writechi
@@ -58,6 +59,9 @@ class MainController(object):
         self.peakfit_ctrl = PeakFitController(self.model, self.widget)
         self.peakfit_table_ctrl = PeakfitTableController(
             self.model, self.widget)
+        self.task_runner = get_task_runner(self.widget)
+        # lines of displayed phases for reading the plot
+        self.reflection_index = ReflectionIndex()
         self.read_setting()
         self.connect_channel()
         #
@@ -236,7 +240,9 @@ class MainController(object):
         if self._temporary_pkpo_exists():
             temp_dir = get_temp_dir(self.model.get_base_ptn_filename())
             temp_chi = os.path.join(temp_dir, '*.chi')
-            for f in glob.glob(temp_chi):
+            # binary sidecars of the chi files, *.chi.npy
+            temp_sidecar = os.path.join(temp_dir, '*.chi.npy')
+            for f in glob.glob(temp_chi) + glob.glob(temp_sidecar):
                 os.remove(f)
 
     def del_temp_cake(self):
@@ -249,8 +255,9 @@ class MainController(object):
             return
         if self._temporary_pkpo_exists():
             temp_dir = get_temp_dir(self.model.get_base_ptn_filename())
-            temp_cake = os.path.join(temp_dir, '*.npy')
-            for f in glob.glob(temp_cake):
+            temp_cake = os.path.join(temp_dir, '*.cake.npy')
+            temp_cake_file = os.path.join(temp_dir, '*.cake')
+            for f in glob.glob(temp_cake) + glob.glob(temp_cake_file):
                 os.remove(f)
 
     def _temporary_pkpo_exists(self):
@@ -342,7 +349,8 @@ class MainController(object):
                 self.widget.doubleSpinBox_Background_ROI_min.value(),
                 self.widget.doubleSpinBox_Background_ROI_max.value())
         preheader_line1 = \
-            '2-theta # BG Params: {0: d}, {1: d}, {2: d} \n'.format(
+            '2-theta # BG Params: {0:s}, {1: d}, {2: d}, {3: d} \n'.format(
+                self.model.base_ptn.bg_engine,
                 self.widget.spinBox_BGParam0.value(),
                 self.widget.spinBox_BGParam1.value(),
                 self.widget.spinBox_BGParam2.value())
@@ -531,6 +539,8 @@ class MainController(object):
         bg_params = [self.widget.spinBox_BGParam0.value(),
                      self.widget.spinBox_BGParam1.value(),
                      self.widget.spinBox_BGParam2.value()]
+        bg_engine = list(BG_ENGINES)[
+            self.widget.comboBox_BGEngine.currentIndex()]
         bg_roi = [self.widget.doubleSpinBox_Background_ROI_min.value(),
                   self.widget.doubleSpinBox_Background_ROI_max.value()]
         if (bg_roi[0] <= self.model.base_ptn.x_raw.min()):
@@ -539,124 +549,78 @@ class MainController(object):
         if (bg_roi[1] >= self.model.base_ptn.x_raw.max()):
             bg_roi[1] = self.model.base_ptn.x_raw.max()
             self.widget.doubleSpinBox_Background_ROI_max.setValue(bg_roi[1])
-        self.model.base_ptn.subtract_bg(bg_roi, bg_params, yshift=0)
+        ptn = self.model.base_ptn
+        print(str(datetime.datetime.now())[:-7], ": Receive BG subtraction")
+        # fit in a worker thread, the pattern is changed when it is done
+        self.task_runner.submit(
+            lambda task: ptn.fit_bg(bg_roi, params=bg_params,
+                                    engine=bg_engine),
+            on_finished=lambda fit: self._finish_bgsub(
+                ptn, fit, bg_roi, bg_params, bg_engine),
+            message='Background subtraction')
+
+    def _finish_bgsub(self, ptn, fit, bg_roi, bg_params, bg_engine):
+        if self.model.base_ptn is not ptn:
+            # another pattern was loaded while fitting
+            return
+        x, y, y_bg = fit
+        ptn.set_bg_from_fit(x, y, y_bg, bg_roi, params=bg_params,
+                            engine=bg_engine)
         temp_dir = get_temp_dir(self.model.get_base_ptn_filename())
         self.model.base_ptn.write_temporary_bgfiles(temp_dir=temp_dir)
-        if self.model.waterfall_exist():
-            print(str(datetime.datetime.now())[:-7],
-                  ": BGfit and BGsub for waterfall patterns even if they are displayed.\n",
-                  "Yes this is a bit of waste.  Future fix needed.")
-            for pattern in self.model.waterfall_ptn:
-                pattern.subtract_bg(bg_roi, bg_params, yshift=0)
         self.plot_new_graph()
+        if self.model.waterfall_exist():
+            if self.widget.checkBox_UseTempBGSub.isChecked():
+                wf_temp_dir = temp_dir
+            else:
+                wf_temp_dir = None
+            self._update_bgsub_waterfall(bg_roi, bg_params, bg_engine,
+                                         wf_temp_dir)
 
-    def apply_pt_to_graph(self):
+    def _update_bgsub_waterfall(self, bg_roi, bg_params, bg_engine,
+                                temp_dir):
+        """
+        fit waterfall patterns in a worker thread, after the base pattern
         """
+        ptn = self.model.base_ptn
+        patterns = list(self.model.waterfall_ptn)
+        self.task_runner.submit(
+            lambda task: self.model.fit_bg_waterfall(
+                patterns, bg_roi, bg_params, temp_dir=temp_dir,
+                bg_engine=bg_engine),
+            on_finished=lambda fits: self._finish_bgsub_waterfall(
+                ptn, fits, bg_roi, bg_params, bg_engine),
+            message='Background subtraction for waterfall')
+
+    def _finish_bgsub_waterfall(self, ptn, fits, bg_roi, bg_params,
+                                bg_engine):
+        if (self.model.base_ptn is not ptn) or \
+                (not ptn.bg_is_current(bg_roi, bg_params, bg_engine)):
+            # another pattern or background was set while fitting
+            return
+        if self.model.set_bg_waterfall(fits, bg_roi, bg_params,
+                                       bg_engine=bg_engine) > 0:
+            self.plot_ctrl.update()
+
+    def apply_pt_to_graph(self):
         if self.model.jcpds_exist():
             self.plot_ctrl.update_jcpds_only()
         else:
-        """
-        self.plot_ctrl.update()
+            self.plot_ctrl.update()
 
     def _find_closestjcpds(self, x):
-        jcount = 0
-        for phase in self.model.jcpds_lst:
-            if phase.display:
-                jcount += 1
-        ucount = 0
-        for phase in self.model.ucfit_lst:
-            if phase.display:
-                ucount += 1
-        if (jcount + ucount) == 0:
+        self.reflection_index.update(
+            self.model.jcpds_lst + self.model.ucfit_lst,
+            self.widget.doubleSpinBox_SetWavelength.value())
+        line = self.reflection_index.find_closest(x)
+        if line is None:
             return ''
-        if jcount != 0:
-            idx_j = []
-            diff_j = []
-            tth_j = []
-            h_j = []
-            k_j = []
-            l_j = []
-            names_j = []
-            dsp_j = []
-            int_j = []
-            for j in self.model.jcpds_lst:
-                if j.display:
-                    i, d, t = j.find_DiffLine(
-                        x, self.widget.doubleSpinBox_SetWavelength.value())
-                    idx_j.append(i)
-                    diff_j.append(d)
-                    tth_j.append(t)
-                    h_j.append(j.DiffLines[i].h)
-                    k_j.append(j.DiffLines[i].k)
-                    l_j.append(j.DiffLines[i].l)
-                    dsp_j.append(j.DiffLines[i].dsp)
-                    int_j.append(j.DiffLines[i].intensity)
-                    names_j.append(j.name)
-        if ucount != 0:
-            idx_u = []
-            diff_u = []
-            tth_u = []
-            h_u = []
-            k_u = []
-            l_u = []
-            names_u = []
-            dsp_u = []
-            int_u = []
-            for u in self.model.ucfit_lst:
-                if u.display:
-                    i, d, t = u.find_DiffLine(
-                        x, self.widget.doubleSpinBox_SetWavelength.value())
-                    idx_u.append(i)
-                    diff_u.append(d)
-                    tth_u.append(t)
-                    h_u.append(u.DiffLines[i].h)
-                    k_u.append(u.DiffLines[i].k)
-                    l_u.append(u.DiffLines[i].l)
-                    dsp_u.append(u.DiffLines[i].dsp)
-                    int_u.append(u.DiffLines[i].intensity)
-                    names_u.append(u.name)
-        if (jcount != 0) and (ucount == 0):
-            idx_min = diff_j.index(min(diff_j))
-            tth_min = tth_j[idx_min]
-            dsp_min = dsp_j[idx_min]
-            int_min = int_j[idx_min]
-            h_min = h_j[idx_min]
-            k_min = k_j[idx_min]
-            l_min = l_j[idx_min]
-            name_min = names_j[idx_min]
-        elif (jcount == 0) and (ucount != 0):
-            idx_min = diff_u.index(min(diff_u))
-            tth_min = tth_u[idx_min]
-            dsp_min = dsp_u[idx_min]
-            int_min = int_u[idx_min]
-            h_min = h_u[idx_min]
-            k_min = k_u[idx_min]
-            l_min = l_u[idx_min]
-            name_min = names_u[idx_min]
-        else:
-            if min(diff_j) <= min(diff_u):
-                idx_min = diff_j.index(min(diff_j))
-                tth_min = tth_j[idx_min]
-                dsp_min = dsp_j[idx_min]
-                int_min = int_j[idx_min]
-                h_min = h_j[idx_min]
-                k_min = k_j[idx_min]
-                l_min = l_j[idx_min]
-                name_min = names_j[idx_min]
-            else:
-                idx_min = diff_u.index(min(diff_u))
-                tth_min = tth_u[idx_min]
-                dsp_min = dsp_u[idx_min]
-                int_min = int_u[idx_min]
-                h_min = h_u[idx_min]
-                k_min = k_u[idx_min]
-                l_min = l_u[idx_min]
-                name_min = names_u[idx_min]
         line1 = '2\u03B8 = {0:.4f} \u00B0, d-sp = {1:.4f} \u212B'.format(
-            float(tth_min), float(dsp_min))
+            float(line['tth']), float(line['dsp']))
         line2 = 'intensity = {0: .0f}, hkl = {1: .0f} {2: .0f} {3: .0f}'. \
-            format(int(int_min), int(h_min), int(k_min), int(l_min))
-        textoutput = name_min + '\n' + line1 + '\n' + line2
+            format(int(line['intensity']), int(line['h']), int(line['k']),
+                   int(line['l']))
+        textoutput = line['name'] + '\n' + line1 + '\n' + line2
         return textoutput
 
     def goto_next_file(self, move):
@@ -677,7 +641,7 @@ class MainController(object):
         filelist_chi = get_sorted_filelist(
             self.model.chi_path,
             sorted_by_name=self.widget.radioButton_SortbyNme.isChecked(),
-            search_ext='*.chi')
+            search_ext='*.chi', cached=True)
 
         idx_chi = find_from_filelist(filelist_chi,
                                      os.path.split(
@@ -723,6 +687,8 @@ class MainController(object):
             self.base_ptn_ctrl._load_a_new_pattern(new_filename_chi)
             # self.model.set_base_ptn_color(self.obj_color)
             self.plot_ctrl.update()
+            self.base_ptn_ctrl.prefetch_neighbors(
+                filelist_chi, idx_chi_new, step)
         else:
             QtWidgets.QMessageBox.warning(self.widget, "Warning",
                                           new_filename_chi +
@@ -733,11 +699,11 @@ class MainController(object):
         filelist_chi = get_sorted_filelist(
             self.model.chi_path,
             sorted_by_name=self.widget.radioButton_SortbyNme.isChecked(),
-            search_ext='*.chi')
+            search_ext='*.chi', cached=True)
         filelist_dpp = get_sorted_filelist(
             self.model.chi_path,
             sorted_by_name=self.widget.radioButton_SortbyNme.isChecked(),
-            search_ext='*.dpp')
+            search_ext='*.dpp', cached=True)
 
         idx_chi = find_from_filelist(filelist_chi,
                                      os.path.split(
@@ -7,9 +7,12 @@ from matplotlib.widgets import MultiCursor
 import matplotlib.transforms as transforms
 # import matplotlib.colors as colors
 import matplotlib.patches as patches
+from matplotlib.collections import LineCollection
 from PyQt5 import QtWidgets
 from PyQt5 import QtCore
-from ds_jcpds import convert_tth
+from ds_powdiff import get_pattern_stack, get_heat_map
+from model import read_saved_pressure
+from utils import make_filename
 
 
 class MplController(object):
@@ -43,7 +46,8 @@ class MplController(object):
             self.obj_color = 'white'
 
     def get_cake_range(self):
-        if self.widget.checkBox_ShowCake.isChecked():
+        if self.widget.checkBox_ShowCake.isChecked() and \
+                (self.widget.mpl.canvas.heat_map is None):
             return self.widget.mpl.canvas.ax_cake.get_xlim(),\
                 self.widget.mpl.canvas.ax_cake.get_ylim()
         else:
@@ -99,19 +103,30 @@ class MplController(object):
         self.widget.setCursor(QtCore.Qt.WaitCursor)
         if limits is None:
             limits = self.widget.mpl.canvas.ax_pattern.axis()
+        heat_map_view = None
         if cake_ylimits is None:
             c_limits = self.widget.mpl.canvas.ax_cake.axis()
             cake_ylimits = c_limits[2:4]
+            # heat map keeps its vertical range, unless zoomed out
+            if self.widget.mpl.canvas.heat_map is not None:
+                heat_map_view = (
+                    self.widget.mpl.canvas.ax_cake.get_ylabel(), cake_ylimits)
         if (not self.model.base_ptn_exist()) and \
                 (not self.model.jcpds_exist()):
             return
-        if self.widget.checkBox_ShowCake.isChecked() and \
-                self.model.diff_img_exist():
+        if self._waterfall_heat_map_on():
+            new_height = self.widget.horizontalSlider_CakeAxisSize.value()
+            self.widget.mpl.canvas.start_update(new_height)
+            cake_ylimits = self._plot_waterfall_heat_map(heat_map_view)
+        # cake may still be in the making in a worker thread
+        elif self.widget.checkBox_ShowCake.isChecked() and \
+                self.model.diff_img_exist() and \
+                (self.model.diff_img.get_cake()[0] is not None):
             new_height = self.widget.horizontalSlider_CakeAxisSize.value()
-            self.widget.mpl.canvas.resize_axes(new_height)
+            self.widget.mpl.canvas.start_update(new_height)
             self._plot_cake()
         else:
-            self.widget.mpl.canvas.resize_axes(1)
+            self.widget.mpl.canvas.start_update(1)
         self._set_nightday_view()
         if self.model.base_ptn_exist():
             if self.widget.checkBox_ShortPlotTitle.isChecked():
@@ -125,6 +140,8 @@ class MplController(object):
             self._plot_diffpattern(gsas_style)
             if self.model.waterfall_exist():
                 self._plot_waterfallpatterns()
+        # cake image and pattern lines from the last update are kept
+        self.widget.mpl.canvas.remove_unused_retained()
         # if self.model.jcpds_exist():
         #    self._plot_jcpds(limits)
         """
@@ -148,15 +165,16 @@ class MplController(object):
                 self.widget.mpl.canvas.ax_pattern.set_ylim(
                     new_low_limit, limits[3])
         if self.widget.checkBox_ShowLargePnT.isChecked():
-            label_p_t = "{0: 5.1f} GPa\n{1: 4.0f} K".\
-                format(self.widget.doubleSpinBox_Pressure.value(),
-                       self.widget.doubleSpinBox_Temperature.value())
-            self.widget.mpl.canvas.ax_pattern.text(
+            label_p_t = self._make_pt_label()
+            pt_label = self.widget.mpl.canvas.ax_pattern.text(
                 0.01, 0.98, label_p_t, horizontalalignment='left',
                 verticalalignment='top',
                 transform=self.widget.mpl.canvas.ax_pattern.transAxes,
                 fontsize=int(
                     self.widget.comboBox_PnTFontSize.currentText()))
+            if self.widget.mpl.canvas.jcpds_layer is not None:
+                self.widget.mpl.canvas.add_blit_artist(pt_label)
+                self.widget.mpl.canvas.jcpds_layer['pt_label'] = pt_label
         xlabel = "Two Theta (degrees), {:6.4f} \u212B".\
             format(self.widget.doubleSpinBox_SetWavelength.value())
         self.widget.mpl.canvas.ax_pattern.set_xlabel(xlabel)
@@ -188,16 +206,30 @@ class MplController(object):
 #            format(x, y,
 #                   self.widget.doubleSpinBox_SetWavelength.value()
 #                   / 2. / np.sin(np.radians(x / 2.)))
-        self.widget.mpl.canvas.ax_cake.format_coord = \
-            lambda x, y: \
-            "\n 2\u03B8={0:.3f}\u00B0, I={1:.4e}, d-sp={2:.4f}\u212B".\
-            format(x, y,
-                   self.widget.doubleSpinBox_SetWavelength.value()
-                   / 2. / np.sin(np.radians(x / 2.)))
+        if self.widget.mpl.canvas.heat_map is not None:
+            ylabel = self.widget.mpl.canvas.ax_cake.get_ylabel()
+            self.widget.mpl.canvas.ax_cake.format_coord = \
+                lambda x, y: \
+                "\n 2\u03B8={0:.3f}\u00B0, {1:s}={2:.2f}".format(x, ylabel, y)
+        else:
+            self.widget.mpl.canvas.ax_cake.format_coord = \
+                lambda x, y: \
+                "\n 2\u03B8={0:.3f}\u00B0, I={1:.4e}, d-sp={2:.4f}\u212B".\
+                format(x, y,
+                       self.widget.doubleSpinBox_SetWavelength.value()
+                       / 2. / np.sin(np.radians(x / 2.)))
         self.widget.mpl.canvas.draw()
+        if self.widget.mpl.canvas.jcpds_layer is not None:
+            self.widget.mpl.canvas.jcpds_layer['signature'] = \
+                self._get_jcpds_signature()
         print(str(datetime.datetime.now())[:-7], 
             ": Plot takes {0:.2f}s".format(time.time() - t_start))
         self.widget.unsetCursor()
+        # old cursor still listens to the canvas events
+        # (before the first plot this is still the QWidget.cursor method)
+        if isinstance(getattr(self.widget, 'cursor', None), MultiCursor):
+            self.widget.cursor.disconnect()
+            del self.widget.cursor
         if self.widget.checkBox_LongCursor.isChecked():
             self.widget.cursor = MultiCursor(
                 self.widget.mpl.canvas,
@@ -206,7 +238,7 @@ class MplController(object):
                 lw=float(
                     self.widget.comboBox_VertCursorThickness.
                     currentText()),
-                ls='--', useblit=False)  # useblit not supported for pyqt5 yet
+                ls='--', useblit=True)
             """
             self.widget.cursor_pattern = Cursor(
                 self.widget.mpl.canvas.ax_pattern, useblit=False,
@@ -289,11 +321,19 @@ class MplController(object):
             int_new[mid_angle:361] = intensity_cake[0:360 - mid_angle]
         else:
             int_new = np.array(intensity_cake_plot)
-        self.widget.mpl.canvas.ax_cake.imshow(
-            int_new, origin="lower",
-            extent=[tth_cake.min(), tth_cake.max(),
-                    chi_cake.min(), chi_cake.max()],
-            aspect="auto", cmap=cmap, clim=climits)  # gray_r
+        extent = [tth_cake.min(), tth_cake.max(),
+                  chi_cake.min(), chi_cake.max()]
+        image = self.widget.mpl.canvas.get_retained('cake')
+        if image is None:
+            self.widget.mpl.canvas.retain(
+                'cake', self.widget.mpl.canvas.ax_cake.imshow(
+                    int_new, origin="lower", extent=extent,
+                    aspect="auto", cmap=cmap, clim=climits))  # gray_r
+        else:
+            image.set_data(int_new)
+            image.set_extent(extent)
+            image.set_cmap(cmap)
+            image.set_clim(climits)
         print(str(datetime.datetime.now())[:-7], 
             ': Cake intensity min, max = ', climits)
         tth_list, azi_list, note_list = self._read_azilist()
@@ -340,148 +380,236 @@ class MplController(object):
         n_displayed_jcpds = len(selected_phases)
         # axisrange = self.widget.mpl.canvas.ax_pattern.axis()
         cakerange = self.widget.mpl.canvas.ax_cake.axis()
-        bar_scale = 1. / 100. * axisrange[3] * \
-            self.widget.horizontalSlider_JCPDSBarScale.value() / 100.
-        pressure = self.widget.doubleSpinBox_Pressure.value()
+        canvas = self.widget.mpl.canvas
+        # keep handles so that update_jcpds_only can move the bars
+        layer_artists = []
         for i, phase in enumerate(selected_phases):
-#            try:
-            phase.cal_dsp(pressure,
-                            self.widget.doubleSpinBox_Temperature.value(),
-                            use_table_for_0GPa=self.widget.checkBox_UseJCPDSTable1bar.isChecked())
-#            except:
-#                QtWidgets.QMessageBox.warning(
-#                    self.widget, "Warning",
-#                    phase.name+" created issues with pressure calculation.")
-#                break
-            tth, inten = phase.get_tthVSint(
-                self.widget.doubleSpinBox_SetWavelength.value())
+            tth, bar_min, bar_max, label = self._get_jcpds_bars(
+                phase, i, n_displayed_jcpds, axisrange)
+            artists = {}
             if self.widget.checkBox_JCPDSinPattern.isChecked():
-                intensity = inten * phase.twk_int
-                if self.widget.checkBox_Intensity.isChecked():
-                    bar_min = np.ones_like(tth) * axisrange[2] + \
-                        self.widget.horizontalSlider_JCPDSBarPosition.\
-                        value() / 100. * axisrange[3]
-                    bar_max = intensity * bar_scale + bar_min
-                else:
-                    data_limits = self._get_data_limits()
-                    starting_intensity = np.ones_like(tth) * data_limits[2] + \
-                        self.widget.horizontalSlider_JCPDSBarPosition.\
-                        value() / 100. * axisrange[3]
-                    bar_max = starting_intensity - \
-                        i * 100. * bar_scale / n_displayed_jcpds
-                    bar_min = starting_intensity - \
-                        (i+0.7) * 100. * bar_scale / n_displayed_jcpds
-                if (pressure == 0.) or (phase.symmetry == 'nosymmetry'):
-                    volume = phase.v
-                else:
-                    volume = phase.v.item()
-                self.widget.mpl.canvas.ax_pattern.vlines(
-                    tth, bar_min, bar_max, colors=phase.color,
-                    label="{0:}, {1:.3f} A^3".format(
-                        phase.name, volume),
-                    lw=float(
-                        self.widget.comboBox_PtnJCPDSBarThickness.
-                        currentText()),
-                    alpha=self.widget.doubleSpinBox_JCPDS_ptn_Alpha.value())
+                artists['bars'] = canvas.add_blit_artist(
+                    canvas.ax_pattern.vlines(
+                        tth, bar_min, bar_max, colors=phase.color,
+                        label=label,
+                        lw=float(
+                            self.widget.comboBox_PtnJCPDSBarThickness.
+                            currentText()),
+                        alpha=self.widget.doubleSpinBox_JCPDS_ptn_Alpha.value()))
                 # hkl
                 if self.widget.checkBox_ShowMillerIndices.isChecked():
                     hkl_list = phase.get_hkl_in_text()
+                    artists['hkl'] = []
                     for j, hkl in enumerate(hkl_list):
-                        self.widget.mpl.canvas.ax_pattern.text(
-                            tth[j], bar_max[j], hkl, color=phase.color,
-                            rotation=90, verticalalignment='bottom',
-                            horizontalalignment='center',
-                            fontsize=int(
-                                self.widget.comboBox_HKLFontSize.currentText()),
-                            alpha=self.widget.doubleSpinBox_JCPDS_ptn_Alpha.value())
+                        artists['hkl'].append(canvas.add_blit_artist(
+                            canvas.ax_pattern.text(
+                                tth[j], bar_max[j], hkl, color=phase.color,
+                                rotation=90, verticalalignment='bottom',
+                                horizontalalignment='center',
+                                fontsize=int(
+                                    self.widget.comboBox_HKLFontSize.currentText()),
+                                alpha=self.widget.doubleSpinBox_JCPDS_ptn_Alpha.value())))
                 # phase.name, phase.v.item()))
             if self.widget.checkBox_ShowCake.isChecked() and \
-                    self.widget.checkBox_JCPDSinCake.isChecked():
-                self.widget.mpl.canvas.ax_cake.vlines(
-                    tth, np.ones_like(tth) * cakerange[2],
-                    np.ones_like(tth) * cakerange[3], colors=phase.color,
-                    lw=float(
-                        self.widget.comboBox_CakeJCPDSBarThickness.currentText()),
-                    alpha=self.widget.doubleSpinBox_JCPDS_cake_Alpha.value())
+                    self.widget.checkBox_JCPDSinCake.isChecked() and \
+                    (canvas.heat_map is None):
+                artists['cake_bars'] = canvas.add_blit_artist(
+                    canvas.ax_cake.vlines(
+                        tth, np.ones_like(tth) * cakerange[2],
+                        np.ones_like(tth) * cakerange[3], colors=phase.color,
+                        lw=float(
+                            self.widget.comboBox_CakeJCPDSBarThickness.currentText()),
+                        alpha=self.widget.doubleSpinBox_JCPDS_cake_Alpha.value()))
                 if self.widget.checkBox_ShowMillerIndices_Cake.isChecked():
                     hkl_list = phase.get_hkl_in_text()
                     trans = transforms.blended_transform_factory(
-                        self.widget.mpl.canvas.ax_cake.transData,
-                        self.widget.mpl.canvas.ax_cake.transAxes)
+                        canvas.ax_cake.transData, canvas.ax_cake.transAxes)
+                    artists['cake_hkl'] = []
                     for j, hkl in enumerate(hkl_list):
-                        self.widget.mpl.canvas.ax_cake.text(
-                            tth[j], 0.99, hkl, color=phase.color,
-                            rotation=90, verticalalignment='top',
-                            transform=trans, horizontalalignment='right',
-                            fontsize=int(
-                                self.widget.comboBox_HKLFontSize.currentText()),
-                            alpha=self.widget.doubleSpinBox_JCPDS_cake_Alpha.value())
+                        artists['cake_hkl'].append(canvas.add_blit_artist(
+                            canvas.ax_cake.text(
+                                tth[j], 0.99, hkl, color=phase.color,
+                                rotation=90, verticalalignment='top',
+                                transform=trans, horizontalalignment='right',
+                                fontsize=int(
+                                    self.widget.comboBox_HKLFontSize.currentText()),
+                                alpha=self.widget.doubleSpinBox_JCPDS_cake_Alpha.value())))
+            layer_artists.append(artists)
+        leg_jcpds = None
         if self.widget.checkBox_JCPDSinPattern.isChecked():
-            leg_jcpds = self.widget.mpl.canvas.ax_pattern.legend(
-                loc=1, prop={'size': 10}, framealpha=0., handlelength=1)
+            leg_jcpds = canvas.add_blit_artist(canvas.ax_pattern.legend(
+                loc=1, prop={'size': 10}, framealpha=0., handlelength=1))
             for line, txt in zip(leg_jcpds.get_lines(), leg_jcpds.get_texts()):
                 txt.set_color(line.get_color())
+        canvas.jcpds_layer = {'phases': selected_phases,
+                              'limits': axisrange,
+                              'cake_limits': cakerange,
+                              'artists': layer_artists,
+                              'legend': leg_jcpds,
+                              'signature': None}
         # print("JCPDS update takes {0:.2f}s at".format(time.time() - t_start),
         #      str(datetime.datetime.now())[:-7])
 
+    def _get_jcpds_bars(self, phase, i, n_displayed_jcpds, axisrange):
+        """
+        calculate JCPDS lines at current pressure and temperature
+        :return: tth, bottom and top of bars, and legend label
+        """
+        pressure = self.widget.doubleSpinBox_Pressure.value()
+        bar_scale = 1. / 100. * axisrange[3] * \
+            self.widget.horizontalSlider_JCPDSBarScale.value() / 100.
+#        try:
+        phase.cal_dsp(pressure,
+                      self.widget.doubleSpinBox_Temperature.value(),
+                      use_table_for_0GPa=self.widget.checkBox_UseJCPDSTable1bar.isChecked())
+#        except:
+#            QtWidgets.QMessageBox.warning(
+#                self.widget, "Warning",
+#                phase.name+" created issues with pressure calculation.")
+        tth, inten = phase.get_tthVSint(
+            self.widget.doubleSpinBox_SetWavelength.value())
+        intensity = inten * phase.twk_int
+        if not self.widget.checkBox_JCPDSinPattern.isChecked():
+            bar_min = None
+            bar_max = None
+        elif self.widget.checkBox_Intensity.isChecked():
+            bar_min = np.ones_like(tth) * axisrange[2] + \
+                self.widget.horizontalSlider_JCPDSBarPosition.\
+                value() / 100. * axisrange[3]
+            bar_max = intensity * bar_scale + bar_min
+        else:
+            data_limits = self._get_data_limits()
+            starting_intensity = np.ones_like(tth) * data_limits[2] + \
+                self.widget.horizontalSlider_JCPDSBarPosition.\
+                value() / 100. * axisrange[3]
+            bar_max = starting_intensity - \
+                i * 100. * bar_scale / n_displayed_jcpds
+            bar_min = starting_intensity - \
+                (i+0.7) * 100. * bar_scale / n_displayed_jcpds
+        label = "{0:}, {1:.3f} A^3".format(phase.name, float(phase.v))
+        return tth, bar_min, bar_max, label
+
+    def _get_jcpds_signature(self):
+        """
+        everything in the plot that update_jcpds_only does not change
+        """
+        canvas = self.widget.mpl.canvas
+        if self.model.base_ptn_exist():
+            base_ptn = (id(self.model.base_ptn), self.model.base_ptn.fname)
+        else:
+            base_ptn = None
+        phases = tuple((id(phase), phase.display, phase.color)
+                       for phase in self.model.jcpds_lst)
+        checkboxes = tuple(
+            checkbox.isChecked() for checkbox in [
+                self.widget.checkBox_JCPDSinPattern,
+                self.widget.checkBox_JCPDSinCake,
+                self.widget.checkBox_ShowCake,
+                self.widget.checkBox_WaterfallHeatMap,
+                self.widget.checkBox_ShowMillerIndices,
+                self.widget.checkBox_ShowMillerIndices_Cake,
+                self.widget.checkBox_Intensity,
+                self.widget.checkBox_ShowLargePnT,
+                self.widget.checkBox_BgSub,
+                self.widget.checkBox_NightView])
+        values = (self.widget.horizontalSlider_JCPDSBarScale.value(),
+                  self.widget.horizontalSlider_JCPDSBarPosition.value(),
+                  self.widget.doubleSpinBox_SetWavelength.value())
+        return (base_ptn, phases, checkboxes, values,
+                tuple(canvas.ax_pattern.axis()), tuple(canvas.ax_cake.axis()))
+
+    def update_jcpds_only(self):
+        """
+        Move JCPDS bars and labels for new pressure and temperature and
+        redraw only them by blitting.  Anything else changed since the
+        last update goes through the full update.
+        """
+        canvas = self.widget.mpl.canvas
+        layer = canvas.jcpds_layer
+        if (layer is None) or \
+                (layer['signature'] != self._get_jcpds_signature()):
+            self.update()
+            return
+        t_start = time.time()
+        n_displayed_jcpds = len(layer['phases'])
+        cakerange = layer['cake_limits']
+        for i, (phase, artists) in enumerate(
+                zip(layer['phases'], layer['artists'])):
+            tth, bar_min, bar_max, label = self._get_jcpds_bars(
+                phase, i, n_displayed_jcpds, layer['limits'])
+            if 'bars' in artists:
+                artists['bars'].set_segments(
+                    np.stack([np.column_stack([tth, bar_min]),
+                              np.column_stack([tth, bar_max])], axis=1))
+            for txt, x, y in zip(artists.get('hkl', []), tth, bar_max):
+                txt.set_position((x, y))
+            if 'cake_bars' in artists:
+                artists['cake_bars'].set_segments(
+                    [[[x, cakerange[2]], [x, cakerange[3]]] for x in tth])
+            for txt, x in zip(artists.get('cake_hkl', []), tth):
+                txt.set_x(x)
+            if layer['legend'] is not None:
+                layer['legend'].get_texts()[i].set_text(label)
+        if layer.get('pt_label') is not None:
+            layer['pt_label'].set_text(self._make_pt_label())
+        if not canvas.update_blit_artists():
+            self.update()
+            return
+        if isinstance(getattr(self.widget, 'cursor', None), MultiCursor):
+            # background of the cursor has old bars
+            self.widget.cursor.clear(None)
+        print(str(datetime.datetime.now())[:-7],
+              ": JCPDS plot takes {0:.2f}s".format(time.time() - t_start))
+
+    def _make_pt_label(self):
+        return "{0: 5.1f} GPa\n{1: 4.0f} K".\
+            format(self.widget.doubleSpinBox_Pressure.value(),
+                   self.widget.doubleSpinBox_Temperature.value())
+
     def _plot_waterfallpatterns(self):
-        if not self.widget.checkBox_ShowWaterfall.isChecked():
+        if (not self.widget.checkBox_ShowWaterfall.isChecked()) or \
+                self._waterfall_heat_map_on():
             return
         # t_start = time.time()
-        # count how many are dispaly
-        i = 0
-        for pattern in self.model.waterfall_ptn:
-            if pattern.display:
-                i += 1
-        if i == 0:
+        displayed = [i for i, pattern in enumerate(self.model.waterfall_ptn)
+                     if pattern.display]
+        if displayed == []:
             return
-        n_display = i
-        j = 0  # this is needed for waterfall gaps
-        # get y_max
-        for pattern in self.model.waterfall_ptn[::-1]:
-            if pattern.display:
-                j += 1
-                """
+        n_display = displayed.__len__()
+        bgsub = self.widget.checkBox_BgSub.isChecked()
+        stack = get_pattern_stack(self.model.waterfall_ptn, bgsub=bgsub)
+        if bgsub:
+            y_base_max = self.model.base_ptn.y_bgsub.max()
+        else:
+            y_base_max = self.model.base_ptn.y_raw.max()
+        if self.widget.checkBox_IntNorm.isChecked():
+            y = stack.normalize(y_base_max, rows=displayed)
+        else:
+            y = None
+        # the last pattern is the lowest
+        ygaps = self.widget.horizontalSlider_WaterfallGaps.value() * \
+            y_base_max * np.arange(n_display, 0, -1) / 100.
+        y = stack.offset(ygaps, y=y, rows=displayed)
+        if self.widget.checkBox_SetToBasePtnLambda.isChecked():
+            x_all = stack.get_x(self.model.base_ptn.wavelength)
+        else:
+            x_all = stack.get_x()
+        lw = float(self.widget.comboBox_WaterfallLineThickness.currentText())
+        show_labels = self.widget.checkBox_ShowWaterfallLabels.isChecked()
+        for j in range(n_display - 1, -1, -1):
+            i = displayed[j]
+            pattern = self.model.waterfall_ptn[i]
+            start, end = stack.bounds[i]
+            x = x_all[i, start:end]
+            self.widget.mpl.canvas.plot_decimated(
+                x, y[j, start:end], key=('waterfall', i),
+                c=pattern.color, lw=lw)
+            if show_labels:
                 self.widget.mpl.canvas.ax_pattern.text(
-                    0.01, 0.97 - n_display * 0.05 + j * 0.05,
+                    (x[-1] - x[0]) * 0.01 + x[0], y[j, start],
                     os.path.basename(pattern.fname),
-                    transform=self.widget.mpl.canvas.ax_pattern.transAxes,
+                    verticalalignment='bottom', horizontalalignment='left',
                     color=pattern.color)
-                """
-                if self.widget.checkBox_BgSub.isChecked():
-                    ygap = self.widget.horizontalSlider_WaterfallGaps.value() * \
-                        self.model.base_ptn.y_bgsub.max() * float(j) / 100.
-                    y_bgsub = pattern.y_bgsub
-                    if self.widget.checkBox_IntNorm.isChecked():
-                        y = y_bgsub / y_bgsub.max() * \
-                            self.model.base_ptn.y_bgsub.max()
-                    else:
-                        y = y_bgsub
-                    x_t = pattern.x_bgsub
-                else:
-                    ygap = self.widget.horizontalSlider_WaterfallGaps.value() * \
-                        self.model.base_ptn.y_raw.max() * float(j) / 100.
-                    if self.widget.checkBox_IntNorm.isChecked():
-                        y = pattern.y_raw / pattern.y_raw.max() *\
-                            self.model.base_ptn.y_raw.max()
-                    else:
-                        y = pattern.y_raw
-                    x_t = pattern.x_raw
-                if self.widget.checkBox_SetToBasePtnLambda.isChecked():
-                    x = convert_tth(x_t, pattern.wavelength,
-                                    self.model.base_ptn.wavelength)
-                else:
-                    x = x_t
-                self.widget.mpl.canvas.ax_pattern.plot(
-                    x, y + ygap, c=pattern.color, lw=float(
-                        self.widget.comboBox_WaterfallLineThickness.
-                        currentText()))
-                if self.widget.checkBox_ShowWaterfallLabels.isChecked():
-                    self.widget.mpl.canvas.ax_pattern.text(
-                        (x[-1] - x[0]) * 0.01 + x[0], y[0] + ygap,
-                        os.path.basename(pattern.fname),
-                        verticalalignment='bottom', horizontalalignment='left',
-                        color=pattern.color)
         """
         self.widget.mpl.canvas.ax_pattern.text(
             0.01, 0.97 - n_display * 0.05,
@@ -490,6 +618,124 @@ class MplController(object):
             color=self.model.base_ptn.color)
         """
 
+    def _waterfall_heat_map_on(self):
+        return self.widget.checkBox_ShowWaterfall.isChecked() and \
+            self.widget.checkBox_WaterfallHeatMap.isChecked() and \
+            self.model.base_ptn_exist() and self.model.waterfall_exist() and \
+            any(pattern.display for pattern in self.model.waterfall_ptn)
+
+    def _get_waterfall_pressures(self, rows):
+        """
+        :return: pressures saved in the dpp files of waterfall patterns,
+            None for patterns without dpp
+        """
+        pressures = []
+        for i in rows:
+            filen_dpp = make_filename(self.model.waterfall_ptn[i].fname, 'dpp')
+            try:
+                pressures.append(read_saved_pressure(filen_dpp))
+            except Exception:
+                pressures.append(None)
+        return pressures
+
+    def _plot_waterfall_heat_map(self, heat_map_view=None):
+        """
+        displayed waterfall patterns as an image in ax_cake, against file
+        index or pressure
+
+        :param heat_map_view: ylabel and ylim of the last heat map, which
+            are kept if the vertical axis is the same
+        :return: ylim of ax_cake
+        """
+        t_start = time.time()
+        rows = [i for i, pattern in enumerate(self.model.waterfall_ptn)
+                if pattern.display]
+        against_pressure = \
+            (self.widget.comboBox_HeatMapYAxis.currentIndex() == 1)
+        if self.widget.checkBox_JCPDSinCake.isChecked():
+            phases = [phase for phase in self.model.jcpds_lst
+                      if phase.display]
+        else:
+            phases = []
+        # pressures are read from dpp files only when they are used
+        if against_pressure or (phases != []):
+            pressures = self._get_waterfall_pressures(rows)
+        else:
+            pressures = None
+        if against_pressure:
+            if None in pressures:
+                print(str(datetime.datetime.now())[:-7],
+                      ": Pressure is not known for all patterns, "
+                      "heat map is shown against file index.")
+                positions = rows
+                ylabel = 'File index'
+            else:
+                positions = pressures
+                ylabel = 'Pressure (GPa)'
+        else:
+            positions = rows
+            ylabel = 'File index'
+        stack = get_pattern_stack(self.model.waterfall_ptn,
+                                  bgsub=self.widget.checkBox_BgSub.isChecked())
+        if self.widget.checkBox_SetToBasePtnLambda.isChecked():
+            wavelength = self.model.base_ptn.wavelength
+        else:
+            wavelength = None
+        heat_map = get_heat_map(
+            stack, rows, positions, wavelength=wavelength,
+            normalize=self.widget.checkBox_IntNorm.isChecked())
+        if self.widget.checkBox_WhiteForPeak.isChecked():
+            cmap = 'gray'
+        else:
+            cmap = 'gray_r'
+        canvas = self.widget.mpl.canvas
+        canvas.show_heat_map(heat_map, cmap=cmap)
+        canvas.ax_cake.set_ylabel(ylabel)
+        if (phases != []) and (None not in pressures):
+            self._plot_jcpds_trajectories(phases, pressures, positions)
+        print(str(datetime.datetime.now())[:-7],
+              ": Heat map of {0:d} patterns takes {1:.2f}s".format(
+                  rows.__len__(), time.time() - t_start))
+        extent = heat_map.get_extent()
+        if (heat_map_view is not None) and (heat_map_view[0] == ylabel):
+            return heat_map_view[1]
+        return extent[2], extent[3]
+
+    def _plot_jcpds_trajectories(self, phases, pressures, positions):
+        """
+        lines of phases from their equations of state at the pressures
+        of the heat map rows.  Not shown against file index if pressure
+        does not change in one direction along the files.
+        """
+        order = np.argsort(positions, kind='stable')
+        p = np.asarray(pressures, dtype=float)[order]
+        y = np.asarray(positions, dtype=float)[order]
+        if (np.diff(p) < 0).any() and (np.diff(p) > 0).any():
+            return
+        # about 50 points along each line
+        i = np.unique(np.linspace(0, p.size - 1, min(p.size, 50)).round().
+                      astype(int))
+        p, y = p[i], y[i]
+        temperature = self.widget.doubleSpinBox_Temperature.value()
+        wavelength = self.widget.doubleSpinBox_SetWavelength.value()
+        use_table = self.widget.checkBox_UseJCPDSTable1bar.isChecked()
+        for phase in phases:
+            tth = []
+            for pressure in p:
+                phase.cal_dsp(pressure, temperature,
+                              use_table_for_0GPa=use_table)
+                tth.append(phase.get_tthVSint(wavelength)[0])
+            tth = np.asarray(tth, dtype=float)
+            self.widget.mpl.canvas.ax_cake.add_collection(LineCollection(
+                [np.column_stack((tth[:, j], y)) for j in range(tth.shape[1])],
+                colors=phase.color,
+                lw=float(
+                    self.widget.comboBox_CakeJCPDSBarThickness.currentText()),
+                alpha=self.widget.doubleSpinBox_JCPDS_cake_Alpha.value()))
+            # back to the pressure of the main JCPDS bars
+            phase.cal_dsp(self.widget.doubleSpinBox_Pressure.value(),
+                          temperature, use_table_for_0GPa=use_table)
+
     def _plot_diffpattern(self, gsas_style=False):
         if self.widget.checkBox_BgSub.isChecked():
             x, y = self.model.base_ptn.get_bgsub()
@@ -498,8 +744,8 @@ class MplController(object):
                     x, y, c=self.model.base_ptn.color, marker='o',
                     linestyle='None', ms=3)
             else:
-                self.widget.mpl.canvas.ax_pattern.plot(
-                    x, y, c=self.model.base_ptn.color,
+                self.widget.mpl.canvas.plot_decimated(
+                    x, y, key='base', c=self.model.base_ptn.color,
                     lw=float(
                         self.widget.comboBox_BasePtnLineThickness.
                         currentText()))
@@ -510,14 +756,15 @@ class MplController(object):
                     x, y, c=self.model.base_ptn.color, marker='o',
                     linestyle='None', ms=3)
             else:
-                self.widget.mpl.canvas.ax_pattern.plot(
-                    x, y, c=self.model.base_ptn.color,
+                self.widget.mpl.canvas.plot_decimated(
+                    x, y, key='base', c=self.model.base_ptn.color,
                     lw=float(
                         self.widget.comboBox_BasePtnLineThickness.
                         currentText()))
             x_bg, y_bg = self.model.base_ptn.get_background()
-            self.widget.mpl.canvas.ax_pattern.plot(
-                x_bg, y_bg, c=self.model.base_ptn.color, ls='--',
+            self.widget.mpl.canvas.plot_decimated(
+                x_bg, y_bg, key='background', c=self.model.base_ptn.color,
+                ls='--',
                 lw=float(
                     self.widget.comboBox_BkgnLineThickness.
                     currentText()))
@@ -1,9 +1,16 @@
 import os
-import dill
+import copy
+import time
+import datetime
 from PyQt5 import QtWidgets
 from .mplcontroller import MplController
 from .peakfittablecontroller import PeakfitTableController
-from utils import make_filename, get_temp_dir
+from .taskrunner import get_task_runner
+from model import PeakPoModel, propagate_sections, \
+    DEFAULT_PROPAGATE_SETTINGS, load_dpp
+from ds_section import FIT_ENGINES
+from ds_powdiff import BG_ENGINES
+from utils import make_filename, get_temp_dir, get_sorted_filelist
 
 
 class PeakFitController(object):
@@ -14,6 +21,7 @@ class PeakFitController(object):
         self.plot_ctrl = MplController(self.model, self.widget)
         self.peakfit_table_ctrl = PeakfitTableController(
             self.model, self.widget)
+        self.task_runner = get_task_runner(self.widget)
         self.connect_channel()
 
     def connect_channel(self):
@@ -39,6 +47,8 @@ class PeakFitController(object):
             self.import_section_from_dpp)
         self.widget.pushButton_PlotSelectedPkFtResults.clicked.connect(
             self._plot_selected_fitting)
+        self.widget.pushButton_PkFtSectionPropagate.clicked.connect(
+            self.propagate_sections)
         # The line below exist in session_ctrl
         # self.widget.pushButton_PkFtSectionSavetoDPP.clicked.coonect
 
@@ -58,11 +68,10 @@ class PeakFitController(object):
 
     def _load_from_dpp(self, filen_dpp):
         '''
-        internal method for reading dilled dpp file
+        internal method for reading dpp file
         '''
         try:
-            with open(filen_dpp, 'rb') as f:
-                model_dpp = dill.load(f)
+            model_dpp = load_dpp(filen_dpp)
         except Exception as inst:
             QtWidgets.QMessageBox.warning(
                 self.widget, "Warning", str(inst))
@@ -183,6 +192,8 @@ class PeakFitController(object):
         idx = self.widget.tableWidget_PkFtSections.selectionModel().\
             selectedRows()[0].row()
         self.model.set_this_section_current(idx)
+        self.widget.comboBox_FitEngine.setCurrentIndex(
+            FIT_ENGINES.index(self.model.current_section.fit_engine))
         self.peakfit_table_ctrl.update_peak_parameters()
         self.peakfit_table_ctrl.update_sections()
         self.peakfit_table_ctrl.update_baseline_constraints()
@@ -344,20 +355,140 @@ class PeakFitController(object):
         order = self.widget.spinBox_BGPolyOrder.value()
         maxwidth = self.widget.doubleSpinBox_MaxFWHM.value()
         centerrange = self.widget.doubleSpinBox_PeakCenterRange.value()
+        self.model.current_section.set_fit_engine(
+            FIT_ENGINES[self.widget.comboBox_FitEngine.currentIndex()])
         self.model.current_section.prepare_for_fitting(order,
                                                        maxwidth, centerrange)
-        success = self.model.current_section.conduct_fitting()
-        if success:
-            QtWidgets.QMessageBox.warning(self.widget, "Information",
-                                          'Fitting finished.')
-            self.plot_ctrl.update()
-            self.peakfit_table_ctrl.update_peak_parameters()
-            self.peakfit_table_ctrl.update_baseline_constraints()
-            self.peakfit_table_ctrl.update_peak_constraints()
-            self.set_tableWidget_PkParams_unsaved()
-        else:
+        # fit a copy in a worker thread, the GUI may change the section
+        # in the mean time
+        section = self.model.current_section
+        section_to_fit = copy.deepcopy(section)
+        n_peaks = section.get_number_of_peaks_in_queue()
+
+        def fit(task):
+            t_last = [time.time()]
+
+            def iter_cb(params, iteration, resid, *args, **kws):
+                if time.time() - t_last[0] > 0.25:
+                    t_last[0] = time.time()
+                    task.report_progress(
+                        'Fitting {0:d} peaks: iteration {1:d}, '
+                        'chi-square {2:.4g}'.format(
+                            n_peaks, iteration, (resid ** 2).sum()))
+                return task.is_cancelled()
+
+            success = section_to_fit.conduct_fitting(iter_cb=iter_cb)
+            return success
+
+        self.widget.pushButton_ConductFitting.setEnabled(False)
+        self.task_runner.submit(
+            fit, message='Fitting {0:d} peaks'.format(n_peaks),
+            on_finished=lambda success: self._finish_fitting(
+                success, section, section_to_fit),
+            on_failed=lambda text: self._finish_fitting(
+                False, section, section_to_fit, error=text),
+            on_cancelled=lambda: print(
+                str(datetime.datetime.now())[:-7], ": Fitting cancelled"),
+            on_done=lambda: self.widget.pushButton_ConductFitting.setEnabled(
+                True))
+
+    def _finish_fitting(self, success, section, section_fitted, error=None):
+        """
+        put the fitted section in the model, if it is still the current
+        section
+        """
+        if error is not None:
+            print(error)
+        if not success:
             QtWidgets.QMessageBox.warning(self.widget, "Information",
                                           'Fitting failed.')
+            return
+        if self.model.current_section is not section:
+            QtWidgets.QMessageBox.warning(
+                self.widget, "Information",
+                'Fitting finished, but the section was changed in the ' +
+                'mean time.  The result is not used.')
+            return
+        self.model.current_section = section_fitted
+        QtWidgets.QMessageBox.warning(self.widget, "Information",
+                                      'Fitting finished.')
+        self.plot_ctrl.update()
+        self.peakfit_table_ctrl.update_peak_parameters()
+        self.peakfit_table_ctrl.update_baseline_constraints()
+        self.peakfit_table_ctrl.update_peak_constraints()
+        self.set_tableWidget_PkParams_unsaved()
+
+    def propagate_sections(self):
+        """
+        fit the sections to all chi files in the folder, each file starting
+        from the result of the file before in pressure
+        """
+        if not self.model.section_list_exist():
+            QtWidgets.QMessageBox.warning(
+                self.widget, "Warning", "Save sections to the list first.")
+            return
+        filelist_chi = get_sorted_filelist(
+            self.model.chi_path,
+            sorted_by_name=self.widget.radioButton_SortbyNme.isChecked(),
+            search_ext='*.chi')
+        reply = QtWidgets.QMessageBox.question(
+            self.widget, 'Question',
+            'Fit {0:d} sections to {1:d} chi files and save the results '
+            'in their dpp files?  Sections overlapping with these in the '
+            'dpp files are replaced.'.format(
+                self.model.get_number_of_section(), filelist_chi.__len__()),
+            QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
+            QtWidgets.QMessageBox.No)
+        if reply == QtWidgets.QMessageBox.No:
+            return
+        # only what propagation needs, copied for the worker thread
+        model = PeakPoModel()
+        model.base_ptn = copy.deepcopy(self.model.base_ptn)
+        model.section_lst = copy.deepcopy(self.model.section_lst)
+        model.jcpds_lst = copy.deepcopy(self.model.jcpds_lst)
+        model.save_pressure(self.widget.doubleSpinBox_Pressure.value())
+        model.save_temperature(self.widget.doubleSpinBox_Temperature.value())
+        settings = dict(DEFAULT_PROPAGATE_SETTINGS)
+        settings.update({
+            'wavelength': self.widget.doubleSpinBox_SetWavelength.value(),
+            'bg_roi': [
+                self.widget.doubleSpinBox_Background_ROI_min.value(),
+                self.widget.doubleSpinBox_Background_ROI_max.value()],
+            'bg_params': [self.widget.spinBox_BGParam0.value(),
+                          self.widget.spinBox_BGParam1.value(),
+                          self.widget.spinBox_BGParam2.value()],
+            'bg_engine': list(BG_ENGINES)[
+                self.widget.comboBox_BGEngine.currentIndex()],
+            'maxwidth': self.widget.doubleSpinBox_MaxFWHM.value(),
+            'centerrange': self.widget.doubleSpinBox_PeakCenterRange.value(),
+            'eos_shift': self.widget.checkBox_PropagateEOS.isChecked(),
+            'temperature': self.widget.doubleSpinBox_Temperature.value()})
+        n_chains = self.widget.spinBox_PropagateChains.value()
+
+        def propagate(task):
+            return propagate_sections(
+                model, filelist_chi, settings=settings, n_chains=n_chains,
+                is_cancelled=task.is_cancelled,
+                report=lambda n_done, n_total: task.report_progress(
+                    'Propagate: {0:d}/{1:d} chains'.format(n_done, n_total),
+                    n_done / n_total))
+
+        self.widget.pushButton_PkFtSectionPropagate.setEnabled(False)
+        self.task_runner.submit(
+            propagate, on_finished=self._finish_propagation,
+            on_done=lambda:
+                self.widget.pushButton_PkFtSectionPropagate.setEnabled(True),
+            message='Propagate sections')
+
+    def _finish_propagation(self, results):
+        failed = [r for r in results if r[2] is not None]
+        for chi_filen, __, error in failed:
+            print(str(datetime.datetime.now())[:-7], ": Failed ", chi_filen,
+                  "\n", error)
+        QtWidgets.QMessageBox.warning(
+            self.widget, "Information",
+            "Sections were fitted to {0:d} files, {1:d} failed.".format(
+                results.__len__() - failed.__len__(), failed.__len__()))
 
     def save_to_xls(self):
         temp_dir = get_temp_dir(self.model.get_base_ptn_filename())
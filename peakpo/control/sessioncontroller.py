@@ -5,13 +5,15 @@ from pkg_resources import add_activation_listener
 import datetime
 import pyFAI
 import zipfile
-import copy
 from PyQt5 import QtWidgets
 from .mplcontroller import MplController
 from .waterfalltablecontroller import WaterfallTableController
 from .jcpdstablecontroller import JcpdsTableController
 from .peakfittablecontroller import PeakfitTableController
 from .cakemakecontroller import CakemakeController
+from .taskrunner import get_task_runner
+from model import dump_dpp, load_dpp, DPP_FILE_VERSION
+from ds_powdiff import BG_ENGINES
 from utils import dialog_savefile, convert_wl_to_energy, get_temp_dir, \
     make_filename, extract_filename
 
@@ -28,6 +30,7 @@ class SessionController(object):
         self.peakfit_table_ctrl = PeakfitTableController(
             self.model, self.widget)
         self.cakemake_ctrl = CakemakeController(self.model, self.widget)
+        self.task_runner = get_task_runner(self.widget)
         self.connect_channel()
 
     def connect_channel(self):
@@ -122,11 +125,10 @@ class SessionController(object):
 
     def _load_dpp(self, filen_dpp, jlistonly=False):
         '''
-        internal method for reading dilled dpp file
+        internal method for reading dpp file, dilled or version 2
         '''
         try:
-            with open(filen_dpp, 'rb') as f:
-                model_dpp = dill.load(f)
+            model_dpp = load_dpp(filen_dpp)
         except Exception as inst:
             QtWidgets.QMessageBox.warning(
                 self.widget, "Warning", str(inst))
@@ -317,6 +319,9 @@ class SessionController(object):
             self.model.session.bg_roi[0])
         self.widget.doubleSpinBox_Background_ROI_max.setValue(
             self.model.session.bg_roi[1])
+        # ppss files are from before background engines
+        self.widget.comboBox_BGEngine.setCurrentIndex(
+            list(BG_ENGINES).index('cheb'))
         self.widget.spinBox_BGParam0.setValue(
             self.model.session.bg_params[0])
         self.widget.spinBox_BGParam1.setValue(
@@ -383,15 +388,32 @@ class SessionController(object):
                     self.widget, "Warning", "JCPDS path does not match.")
                 return False
 
-    def _dump_dpp(self, filen_dpp):
-        with open(filen_dpp, 'wb') as f:
-            # cake cannot be dilled, so I remove it before dill
-            model_dill = copy.deepcopy(self.model)
-            try:
-                dill.dump(model_dill, f)
-            except:
-                model_dill.diff_img = None
-                dill.dump(model_dill, f)
+    def _dump_dpp(self, filen_dpp, then=None, on_finished=None):
+        """
+        snapshot of the model is made here and written in a worker thread
+
+        :param then: called with the filename in the worker thread after
+            writing, for more work on the file
+        :param on_finished: called in the main thread with the return
+            value of then, or the filename
+        :return: task
+        """
+        model_dpp = self.model.make_snapshot()
+
+        def dump(task):
+            dump_dpp(model_dpp, filen_dpp)
+            if then is not None:
+                return then(filen_dpp)
+            return filen_dpp
+
+        def finish(result):
+            print(str(datetime.datetime.now())[:-7], ": Save ", filen_dpp)
+            if on_finished is not None:
+                on_finished(result)
+
+        return self.task_runner.submit(
+            dump, message='Saving ' + os.path.basename(filen_dpp),
+            on_finished=finish)
 
     def _dump_ppss(self, fsession):
         """
@@ -438,37 +460,51 @@ class SessionController(object):
             path, filen = os.path.split(str(fzip))
             fsession_name = '%s.forzip.dpp' % filen
             fsession = os.path.join(path, fsession_name)
-            self._dump_dpp(str(fsession))
             self.widget.textEdit_Jlist.setText('Jlist : ' + str(fsession))
-            zf = zipfile.ZipFile(str(fzip), 'w', zipfile.ZIP_DEFLATED)
-            zf.write(fsession, arcname=fsession_name)
+            # file list is made now, zip is written after the dpp
+            to_zip = []
             if self.model.base_ptn_exist():
                 dum, filen = os.path.split(self.model.base_ptn.fname)
-                zf.write(self.model.base_ptn.fname, arcname=filen)
+                to_zip.append((self.model.base_ptn.fname, filen))
             if self.model.diff_img is not None:
                 dum, filen = os.path.split(self.model.diff_img.img_filename)
-                zf.write(self.model.diff_img.img_filename, arcname=filen)
+                to_zip.append((self.model.diff_img.img_filename, filen))
             path, filen = os.path.split(str(fzip))
             folder_name = extract_filename(fzip) + '-param'
             folder_path = os.path.join(path, folder_name)
             for file in os.listdir(folder_path):
                 full_path = os.path.join(folder_path, file)
+                # binary sidecars are made again from chi files
+                if file.endswith('.chi.npy'):
+                    continue
                 if os.path.isfile(full_path):
-                    zf.write(full_path, arcname=os.path.join(folder_name, file))
+                    to_zip.append(
+                        (full_path, os.path.join(folder_name, file)))
             """
             if self.model.waterfall_exist():
                 for wf in self.model.waterfall_ptn:
                     dum, filen = os.path.split(wf.fname)
                     zf.write(wf.fname, arcname=filen)
             """
-            zf.close()
-            QtWidgets.QMessageBox.warning(
-                self.widget, "Information",
-                "A Zip file was saved for sharing in " + fzip)
 
-            print(str(datetime.datetime.now())[:-7], 
-                    ": Save ", fzip)
-            print("            Because waterfall paths can be complicated, chi and tif files listed in waterfall are not included.")
+            def write_zip(fsession):
+                with zipfile.ZipFile(str(fzip), 'w',
+                                     zipfile.ZIP_DEFLATED) as zf:
+                    zf.write(fsession, arcname=fsession_name)
+                    for full_path, arcname in to_zip:
+                        zf.write(full_path, arcname=arcname)
+                return fzip
+
+            self._dump_dpp(str(fsession), then=write_zip,
+                           on_finished=self._show_zip_saved)
+
+    def _show_zip_saved(self, fzip):
+        QtWidgets.QMessageBox.warning(
+            self.widget, "Information",
+            "A Zip file was saved for sharing in " + fzip)
+        print(str(datetime.datetime.now())[:-7],
+                ": Save ", fzip)
+        print("            Because waterfall paths can be complicated, chi and tif files listed in waterfall are not included.")
 
     def save_dpp_ppss(self):
         # save temp files
@@ -499,8 +535,6 @@ class SessionController(object):
             self.model.save_temperature(
                 self.widget.doubleSpinBox_Temperature.value())
             self._dump_dpp(new_filename)
-            print(str(datetime.datetime.now())[:-7], 
-                    ": Save ", new_filename)
             if self.widget.checkBox_ShowCake.isChecked():
                 self._save_cake_format_file()
                 print(str(datetime.datetime.now())[:-7], 
@@ -520,6 +554,7 @@ class SessionController(object):
                 f.write('Python ver.: ' + sys.version + '\n')
                 f.write("Environment: " + env + '\n')
                 f.write("dill ver.: " + dill.__version__ + '\n')
+                f.write("DPP format ver.: " + str(DPP_FILE_VERSION) + '\n')
                 f.write("pyFAI ver.: " + pyFAI.version + '\n')
             print(str(datetime.datetime.now())[:-7], 
                     ": Save ", filen)
@@ -571,6 +606,9 @@ class SessionController(object):
         '''
         this is to read from session file and put to the table
         '''
+        # engine first, as changing it resets the parameters
+        self.widget.comboBox_BGEngine.setCurrentIndex(
+            list(BG_ENGINES).index(self.model.base_ptn.bg_engine))
         self.widget.spinBox_BGParam0.setValue(
             self.model.base_ptn.params_chbg[0])
         self.widget.spinBox_BGParam1.setValue(
@@ -0,0 +1,238 @@
+import datetime
+import threading
+import traceback
+from PyQt5 import QtCore
+
+
+class TaskCancelled(Exception):
+    """
+    raise in a task function to stop it early
+    """
+    pass
+
+
+class TaskSignals(QtCore.QObject):
+    """
+    signals of a task.  Made in the main thread, so that slots connected
+    to them run in the main thread also when emitted from a worker.
+    """
+    progress = QtCore.pyqtSignal(str, float)
+    finished = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+    cancelled = QtCore.pyqtSignal()
+    done = QtCore.pyqtSignal()
+
+
+class Task(QtCore.QRunnable):
+    """
+    runs fn(task) in a worker thread.  fn can call task.report_progress
+    and should check task.is_cancelled() where it can stop.
+    """
+
+    def __init__(self, fn, message=''):
+        super(Task, self).__init__()
+        self.setAutoDelete(False)
+        self.fn = fn
+        self.message = message
+        self.signals = TaskSignals()
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def report_progress(self, message, fraction=-1.):
+        """
+        :param fraction: between 0 and 1, negative if not known
+        """
+        self.signals.progress.emit(message, fraction)
+
+    def run(self):
+        try:
+            result = self.fn(self)
+        except TaskCancelled:
+            self.signals.cancelled.emit()
+        except Exception:
+            self.signals.failed.emit(traceback.format_exc())
+        else:
+            if self.is_cancelled():
+                self.signals.cancelled.emit()
+            else:
+                self.signals.finished.emit(result)
+        self.signals.done.emit()
+
+
+class FutureTask(object):
+    """
+    task for a concurrent.futures future made elsewhere, such as by the
+    cake precomputer.  No thread waits for it, signals are emitted from
+    the thread which completes the future.
+    """
+
+    def __init__(self, future, message=''):
+        self.future = future
+        self.message = message
+        self.signals = TaskSignals()
+        self._cancel_event = threading.Event()
+        self._emitted = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        # called here at once if the future is done already
+        self.future.add_done_callback(self._on_done)
+
+    def cancel(self):
+        """
+        the future is left running, only its result is ignored
+        """
+        self._cancel_event.set()
+        self._emit_once(self.signals.cancelled)
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def _on_done(self, future):
+        if future.cancelled():
+            self._emit_once(self.signals.cancelled)
+        elif future.exception() is not None:
+            error = future.exception()
+            self._emit_once(self.signals.failed, ''.join(
+                traceback.format_exception(type(error), error,
+                                           error.__traceback__)))
+        else:
+            self._emit_once(self.signals.finished, future.result())
+
+    def _emit_once(self, signal, *args):
+        with self._lock:
+            if self._emitted:
+                return
+            self._emitted = True
+        signal.emit(*args)
+        self.signals.done.emit()
+
+
+class TaskRunner(QtCore.QObject):
+    """
+    Runs heavy jobs of the controllers in worker threads and shows them
+    in the status bar of the main window with a cancel button.  Results
+    come back to the callbacks in the main thread, where the model and
+    plot can be changed safely.
+    """
+
+    def __init__(self, widget, max_threads=2):
+        super(TaskRunner, self).__init__()
+        self.widget = widget
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        self._tasks = []
+        self.widget.pushButton_CancelTask.clicked.connect(self.cancel_all)
+
+    def submit(self, fn, on_finished=None, on_failed=None,
+               on_cancelled=None, on_done=None, message=''):
+        """
+        :param fn: function to run, called with the task as the only
+            argument
+        :param on_finished: called with the return value of fn
+        :param on_failed: called with the traceback text.  If None, the
+            traceback is printed
+        :param on_cancelled: called without arguments
+        :param on_done: called without arguments after any of the above
+        :param message: shown in the status bar while running
+        :return: task
+        """
+        task = Task(fn, message=message)
+        self._connect(task, on_finished, on_failed, on_cancelled, on_done,
+                      message)
+        self.pool.start(task)
+        return task
+
+    def watch(self, future, on_finished=None, on_failed=None,
+              on_cancelled=None, on_done=None, message=''):
+        """
+        same as submit for a concurrent.futures future made elsewhere.
+        The callbacks come in the main thread when the future is done,
+        without a worker thread waiting for it.
+
+        :return: FutureTask
+        """
+        task = FutureTask(future, message=message)
+        self._connect(task, on_finished, on_failed, on_cancelled, on_done,
+                      message)
+        task.start()
+        return task
+
+    def _connect(self, task, on_finished, on_failed, on_cancelled, on_done,
+                 message):
+        if on_finished is not None:
+            task.signals.finished.connect(on_finished)
+        if on_failed is None:
+            task.signals.failed.connect(
+                lambda text, message=message: self._print_failure(
+                    message, text))
+        else:
+            task.signals.failed.connect(on_failed)
+        if on_cancelled is not None:
+            task.signals.cancelled.connect(on_cancelled)
+        task.signals.progress.connect(self._show_progress)
+        # all slots are connected before the task starts, a short task
+        # may emit before submit returns
+        if on_done is not None:
+            task.signals.done.connect(on_done)
+        task.signals.done.connect(lambda task=task: self._remove(task))
+        self._tasks.append(task)
+        self._show_status()
+
+    def is_busy(self):
+        return self._tasks != []
+
+    def cancel_all(self):
+        # watched tasks are removed at once when cancelled
+        for task in list(self._tasks):
+            task.cancel()
+        self.widget.label_TaskStatus.setText('Cancelling...')
+
+    def wait(self, msecs=-1):
+        """
+        block until all tasks finish, for closing the program
+        """
+        return self.pool.waitForDone(msecs)
+
+    def _print_failure(self, message, text):
+        print(str(datetime.datetime.now())[:-7], ": Failed ", message,
+              "\n", text)
+
+    def _remove(self, task):
+        if task in self._tasks:
+            self._tasks.remove(task)
+        self._show_status()
+
+    def _show_status(self):
+        busy = self.is_busy()
+        self.widget.label_TaskStatus.setVisible(busy)
+        self.widget.progressBar_Task.setVisible(busy)
+        self.widget.pushButton_CancelTask.setVisible(busy)
+        if not busy:
+            return
+        messages = [task.message for task in self._tasks if task.message]
+        self.widget.label_TaskStatus.setText(', '.join(messages))
+        # busy indicator until a task tells how far it is
+        self.widget.progressBar_Task.setRange(0, 0)
+
+    def _show_progress(self, message, fraction):
+        self.widget.label_TaskStatus.setText(message)
+        if fraction < 0.:
+            self.widget.progressBar_Task.setRange(0, 0)
+        else:
+            self.widget.progressBar_Task.setRange(0, 100)
+            self.widget.progressBar_Task.setValue(int(fraction * 100))
+
+
+def get_task_runner(widget):
+    """
+    one runner for the main window, shared by all controllers
+    """
+    if getattr(widget, 'task_runner', None) is None:
+        widget.task_runner = TaskRunner(widget)
+    return widget.task_runner
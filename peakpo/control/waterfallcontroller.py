@@ -5,7 +5,10 @@ from PyQt5 import QtCore
 from PyQt5 import QtGui
 from .mplcontroller import MplController
 from .waterfalltablecontroller import WaterfallTableController
-from utils import convert_wl_to_energy, get_directory, get_temp_dir
+from .taskrunner import get_task_runner
+from utils import convert_wl_to_energy, get_directory, get_temp_dir, \
+    get_sorted_filelist
+from ds_powdiff import BG_ENGINES
 
 
 class WaterfallController(object):
@@ -16,11 +19,14 @@ class WaterfallController(object):
         self.waterfall_table_ctrl = \
             WaterfallTableController(self.model, self.widget)
         self.plot_ctrl = MplController(self.model, self.widget)
+        self.task_runner = get_task_runner(self.widget)
         self.connect_channel()
 
     def connect_channel(self):
         self.widget.pushButton_MakeBasePtn.clicked.connect(self.make_base_ptn)
         self.widget.pushButton_AddPatterns.clicked.connect(self.add_patterns)
+        self.widget.pushButton_AddDirectory.clicked.connect(
+            self.add_directory)
         self.widget.pushButton_CleanPatterns.clicked.connect(
             self.erase_waterfall_list)
         self.widget.pushButton_RemovePatterns.clicked.connect(
@@ -35,6 +41,10 @@ class WaterfallController(object):
             self._apply_changes_to_graph)
         self.widget.checkBox_ShowWaterfall.clicked.connect(
             self._apply_changes_to_graph)
+        self.widget.checkBox_WaterfallHeatMap.clicked.connect(
+            self._apply_changes_to_graph)
+        self.widget.comboBox_HeatMapYAxis.currentIndexChanged.connect(
+            self._apply_changes_to_graph)
         self.widget.pushButton_CheckAllWaterfall.clicked.connect(
             self.check_all_waterfall)
         self.widget.pushButton_UncheckAllWaterfall.clicked.connect(
@@ -65,7 +75,10 @@ class WaterfallController(object):
         bg_params = [self.widget.spinBox_BGParam0.value(),
                      self.widget.spinBox_BGParam1.value(),
                      self.widget.spinBox_BGParam2.value()]
-        self.model.base_ptn.get_chbg(bg_roi, bg_params, yshift=0)
+        bg_engine = list(BG_ENGINES)[
+            self.widget.comboBox_BGEngine.currentIndex()]
+        self.model.base_ptn.get_chbg(bg_roi, bg_params, yshift=0,
+                                     engine=bg_engine)
         # self.model.load_associated_img()
         self.widget.checkBox_ShowCake.setChecked(False)
         self.model.replace_a_waterfall(old_base_ptn, i)
@@ -150,12 +163,72 @@ class WaterfallController(object):
                     temp_dir = get_temp_dir(self.model.get_base_ptn_filename())
                 else:
                     temp_dir = None
+                bg_engine = list(BG_ENGINES)[
+                    self.widget.comboBox_BGEngine.currentIndex()]
                 self.model.append_a_waterfall_ptn(
-                    filename, wavelength, bg_roi, bg_params, temp_dir=temp_dir)
+                    filename, wavelength, bg_roi, bg_params, temp_dir=temp_dir,
+                    bg_engine=bg_engine)
             self.waterfall_table_ctrl.update()
             self._apply_changes_to_graph()
         return
 
+    def add_directory(self):
+        """
+        add all chi files in a directory, for example for a heat map of a
+        long series.  They are shown in the graph.
+        """
+        if not self.model.base_ptn_exist():
+            QtWidgets.QMessageBox.warning(
+                self.widget, "Warning",
+                "Pick a base pattern first.")
+            return
+        path = QtWidgets.QFileDialog.getExistingDirectory(
+            self.widget, "Choose a directory", self.model.chi_path,
+            QtWidgets.QFileDialog.ShowDirsOnly)
+        if path == '':
+            return
+        files = get_sorted_filelist(
+            path, sorted_by_name=self.widget.radioButton_SortbyNme.isChecked(),
+            search_ext='*.chi')
+        existing = set(ptn.fname for ptn in self.model.waterfall_ptn)
+        files = [f for f in files if f not in existing]
+        if files == []:
+            return
+        self._add_directory(files)
+
+    def _add_directory(self, files):
+        wavelength = self.widget.doubleSpinBox_SetWavelength.value()
+        bg_roi = [self.widget.doubleSpinBox_Background_ROI_min.value(),
+                  self.widget.doubleSpinBox_Background_ROI_max.value()]
+        bg_params = [self.widget.spinBox_BGParam0.value(),
+                     self.widget.spinBox_BGParam1.value(),
+                     self.widget.spinBox_BGParam2.value()]
+        if self.widget.checkBox_UseTempBGSub.isChecked():
+            temp_dir = get_temp_dir(self.model.get_base_ptn_filename())
+        else:
+            temp_dir = None
+        bg_engine = list(BG_ENGINES)[
+            self.widget.comboBox_BGEngine.currentIndex()]
+        self.task_runner.submit(
+            lambda task: self.model.make_waterfall_ptns(
+                files, wavelength, bg_roi, bg_params, temp_dir=temp_dir,
+                bg_engine=bg_engine, display=True,
+                is_cancelled=task.is_cancelled,
+                report=lambda i, n: task.report_progress(
+                    'Reading {0:d} of {1:d} files'.format(i, n), i / n)),
+            on_finished=self._finish_add_directory,
+            message='Adding {0:d} files to waterfall'.format(files.__len__()))
+
+    def _finish_add_directory(self, patterns):
+        if patterns is None:
+            return
+        # the list may have changed while reading
+        existing = set(ptn.fname for ptn in self.model.waterfall_ptn)
+        self.model.waterfall_ptn.extend(
+            [ptn for ptn in patterns if ptn.fname not in existing])
+        self.waterfall_table_ctrl.update()
+        self._apply_changes_to_graph()
+
     def add_base_pattern_to_waterfall(self):
         if not self.model.base_ptn_exist():
             QtWidgets.QMessageBox.warning(
@@ -177,8 +250,11 @@ class WaterfallController(object):
             #temp_dir = os.path.join(self.model.chi_path, 'temporary_pkpo')
         else:
             temp_dir = None
+        bg_engine = list(BG_ENGINES)[
+            self.widget.comboBox_BGEngine.currentIndex()]
         self.model.append_a_waterfall_ptn(
-            filename, wavelength, bg_roi, bg_params, temp_dir=temp_dir)
+            filename, wavelength, bg_roi, bg_params, temp_dir=temp_dir,
+            bg_engine=bg_engine)
         self.waterfall_table_ctrl.update()
         self._apply_changes_to_graph()
 
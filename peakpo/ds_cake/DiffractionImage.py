@@ -1,43 +1,86 @@
 import os
 import time
-from PIL import Image
-import fabio
+from concurrent.futures import ThreadPoolExecutor
 import numpy.ma as ma
 import numpy as np
-import pyFAI
 import matplotlib.pyplot as plt
 import datetime
-from utils import make_filename, extract_extension
+from utils import make_filename
+from .integratorcache import integrator_cache, hash_file
+from .cakefile import read_cake, write_cake, read_cake_header
+from .imagefile import read_image
 
 
 class DiffImg(object):
     def __init__(self):
         self.img_filename = None
         self.poni = None
-        self.img = None
+        self.poni_hash = None
+        self._img = None
         self.intensity = None
         self.tth = None
         self.intensity_cake = None
         self.tth_cake = None
         self.chi_cake = None
-        self.mask = None
+        self._mask = None
+        self.mask_range = None
+
+    def __setstate__(self, state):
+        # sessions saved before lazy loading keep decoded arrays
+        for name in ['img', 'mask']:
+            if name in state:
+                state['_' + name] = state.pop(name)
+        state.setdefault('_img', None)
+        state.setdefault('_mask', None)
+        state.setdefault('mask_range', None)
+        state.setdefault('poni_hash', None)
+        self.__dict__.update(state)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # a memory map cannot be saved, keep the data as before
+        if isinstance(state.get('_img'), np.memmap):
+            state['_img'] = np.array(state['_img'])
+        return state
 
     def load(self, img_filename):
+        """
+        image is decoded only when it is needed, see img
+        """
         self.img_filename = img_filename
-        if extract_extension(self.img_filename) == 'tif':
-            data = Image.open(self.img_filename)
-        elif extract_extension(self.img_filename) == 'tiff':
-            data = Image.open(self.img_filename)
-        elif extract_extension(self.img_filename) == 'mar3450':
-            data_fabio = fabio.open(img_filename)
-            data = data_fabio.data
-        elif extract_extension(self.img_filename) == 'cbf':
-            data_fabio = fabio.open(img_filename)
-            data = data_fabio.data
-        self.img = np.array(data)[::-1]
+        self._img = None
+        self._mask = None
         print(str(datetime.datetime.now())[:-7], 
                 ": Load ", self.img_filename)
 
+    @property
+    def img(self):
+        """
+        image flipped upside down, decoded at the first use
+        """
+        if (self._img is None) and (self.img_filename is not None):
+            t_start = time.time()
+            # the flip is a view, no copy is made
+            self._img = read_image(self.img_filename)[::-1]
+            print(str(datetime.datetime.now())[:-7],
+                  ": Decode image takes {0:.2f}s".format(
+                      time.time() - t_start))
+        return self._img
+
+    @img.setter
+    def img(self, img):
+        self._img = img
+        self._mask = None
+
+    @property
+    def mask(self):
+        if (self._mask is None) and (self.mask_range is not None) and \
+                (self.img is not None):
+            masked = ma.masked_where(
+                (self.img <= self.mask_range[0]) |
+                (self.img >= self.mask_range[1]), self.img)
+            self._mask = masked.mask
+        return self._mask
 
     def histogram(self):
         if self.img is None:
@@ -53,7 +96,9 @@ class DiffImg(object):
         f.show()
 
     def set_calibration(self, poni_filename):
-        self.poni = pyFAI.load(poni_filename)
+        # the same integrator for the same PONI keeps its cached arrays
+        self.poni = integrator_cache.get_integrator(poni_filename)
+        self.poni_hash = hash_file(poni_filename)
         print(str(datetime.datetime.now())[:-7], 
             ": Load ", poni_filename)
 
@@ -89,33 +134,121 @@ class DiffImg(object):
             ": Two theta max for integration = {:.3f} ".format(tth_max))
         return tth_max
 
-    def integrate_to_1d(self, **kwargs):
+    def _get_table(self, npt, radial_range, cache_dir=None):
+        # mask changes with the image, so it is applied in integration
+        return integrator_cache.get_table(
+            self.poni, self.img.shape, npt, radial_range, cache_dir=cache_dir)
+
+    def integrate_to_1d(self, cache_dir=None, **kwargs):
+        """
+        :param cache_dir: directory to keep the lookup table on disk
+        :param kwargs: azimuth_range or other options for pyFAI integrate1d
+        """
+        if list(kwargs.keys()) == ['azimuth_range']:
+            tth, intensities = self.integrate_to_1d_sectors(
+                [kwargs['azimuth_range']], cache_dir=cache_dir)
+            return tth, intensities[0]
         n_azi_pnts = self.calculate_n_azi_pnts()  # * 2 reduced number for Mar345 data
         radial_range = (0., self.calculate_max_twotheta())
-        tth, intensity = self.poni.integrate1d(
-            self.img, n_azi_pnts, radial_range=radial_range,
-            mask=self.mask, unit="2th_deg", polarization_factor=0.99,
-            method='csr', **kwargs)
+        if kwargs != {}:
+            tth, intensity = self.poni.integrate1d(
+                self.img, n_azi_pnts, radial_range=radial_range,
+                mask=self.mask, unit="2th_deg", polarization_factor=0.99,
+                method='csr', **kwargs)
+            return tth, intensity
+        table = self._get_table(n_azi_pnts, radial_range, cache_dir=cache_dir)
         """
         self.tth = tth
         self.intensity = intensity
         """
-        return tth, intensity
+        return table.radial, table.integrate(self.img, mask=self.mask)
 
-    def integrate_to_cake(self, **kwargs):
+    def integrate_to_1d_sectors(self, azimuth_ranges, max_workers=None,
+                                cache_dir=None):
+        """
+        Integrate several azimuthal sectors with one lookup table.
+        Result for each sector is the same as pyFAI integrate1d with
+        azimuth_range, but the pixel-to-bin table is made only once and
+        the sectors are integrated in parallel.
+
+        :param azimuth_ranges: list of (azi_min, azi_max) in degrees,
+            between -180 and 180.  azi_min > azi_max for a sector crossing
+            180 degrees
+        :param max_workers: number of threads, None for default
+        :param cache_dir: directory to keep the lookup table on disk
+        :return: tth, list of intensity for each sector
+        """
         t_start = time.time()
-        n_azi_pnts = self.calculate_n_azi_pnts() * 2
+        n_azi_pnts = self.calculate_n_azi_pnts()
         radial_range = (0., self.calculate_max_twotheta())
-        intensity_cake, tth_cake, chi_cake = self.poni.integrate2d(
-            self.img, n_azi_pnts, 360, unit="2th_deg", method='csr',
-            radial_range=radial_range, polarization_factor=0.99, mask=self.mask,
-            **kwargs)
-        print(str(datetime.datetime.now())[:-7], 
-            ": Caking takes {0:.2f}s".format(time.time() - t_start))
+        table = self._get_table(n_azi_pnts, radial_range, cache_dir=cache_dir)
+        lut = table.get_lut_csc()
+        chi, d_chi = table.get_chi(self.poni, self.img.shape)
+        signal_norm = table.get_signal_norm(self.img, mask=self.mask)
+
+        def integrate_sector(azimuth_range):
+            azi_min, azi_max = azimuth_range
+            shifts = [0.]
+            if azi_max < azi_min:
+                azi_max += 360.
+                shifts.append(360.)
+            # pyFAI takes pixels touching the range
+            in_sector = np.zeros(chi.size, dtype=bool)
+            for shift in shifts:
+                in_sector |= (chi + shift + d_chi >= azi_min) & \
+                    (chi + shift - d_chi <= azi_max)
+            i_pixels = np.flatnonzero(in_sector)
+            sum_signal, sum_norm = lut[:, i_pixels].dot(
+                signal_norm[i_pixels]).T
+            intensity = np.zeros(n_azi_pnts)
+            np.divide(sum_signal, sum_norm, out=intensity,
+                      where=(sum_norm != 0.))
+            return intensity
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            intensities = list(executor.map(integrate_sector, azimuth_ranges))
+        print(str(datetime.datetime.now())[:-7],
+              ": Integration of {0:d} sectors takes {1:.2f}s".format(
+                  len(intensities), time.time() - t_start))
+        return table.radial, intensities
+
+    def integrate_to_cake(self, cache_dir=None, **kwargs):
+        """
+        :param cache_dir: directory to keep the lookup table on disk
+        :param kwargs: other options for pyFAI integrate2d
+        """
+        self.set_cake(*self.make_cake(cache_dir=cache_dir, **kwargs))
+
+    def set_cake(self, intensity_cake, tth_cake, chi_cake):
         self.intensity_cake = intensity_cake
         self.tth_cake = tth_cake
         self.chi_cake = chi_cake
 
+    def make_cake(self, cache_dir=None, **kwargs):
+        """
+        same as integrate_to_cake but the cake is returned, not stored.
+        For worker threads, as the cake appears at once with set_cake.
+
+        :return: intensity_cake, tth_cake, chi_cake
+        """
+        t_start = time.time()
+        n_azi_pnts = self.calculate_n_azi_pnts() * 2
+        radial_range = (0., self.calculate_max_twotheta())
+        if kwargs != {}:
+            intensity_cake, tth_cake, chi_cake = self.poni.integrate2d(
+                self.img, n_azi_pnts, 360, unit="2th_deg", method='csr',
+                radial_range=radial_range, polarization_factor=0.99,
+                mask=self.mask, **kwargs)
+        else:
+            table = self._get_table((n_azi_pnts, 360), radial_range,
+                                    cache_dir=cache_dir)
+            intensity_cake = table.integrate(self.img, mask=self.mask)
+            tth_cake = table.radial
+            chi_cake = table.azimuthal
+        print(str(datetime.datetime.now())[:-7], 
+            ": Caking takes {0:.2f}s".format(time.time() - t_start))
+        return intensity_cake, tth_cake, chi_cake
+
     def get_pattern(self):
         if self.tth is None:
             return None, None
@@ -129,11 +262,15 @@ class DiffImg(object):
             return self.intensity_cake, self.tth_cake, self.chi_cake
 
     def set_mask(self, range):
-        if self.img is None:
+        """
+        mask is made from the image when it is needed
+        """
+        if (self._img is None) and (self.img_filename is None):
             return False
-        masked = ma.masked_where(
-            (self.img <= range[0]) | (self.img >= range[1]), self.img)
-        self.mask = masked.mask
+        if (self.mask_range is None) or \
+                (list(self.mask_range) != list(range)):
+            self._mask = None
+        self.mask_range = list(range)
 
     def write_to_npy(self, chi_filen_wo_ext_in_temp):
         """
@@ -143,7 +280,30 @@ class DiffImg(object):
         f_chi = chi_filen_wo_ext_in_temp + '.chi.cake.npy'
         f_int = chi_filen_wo_ext_in_temp + '.int.cake.npy'
 
-    def read_cake_from_tempfile(self, temp_dir=None):
+    def read_cake_from_tempfile(self, temp_dir=None, poni_hash=None,
+                                mask_range=None):
+        """
+        :param poni_hash: if given, cakes made with a different PONI are
+            not used
+        :param mask_range: if given, cakes made with a different mask are
+            not used
+        :return: True if cake was read from the temp file
+        """
+        cake_filen = self.make_temp_cake_filename(temp_dir=temp_dir)
+        if os.path.exists(cake_filen):
+            try:
+                intensity, tth, chi, metadata = read_cake(cake_filen)
+            except (OSError, ValueError, KeyError) as inst:
+                print(str(datetime.datetime.now())[:-7],
+                      ": Cannot read ", cake_filen, inst)
+                return False
+            if not _same_conditions(metadata, poni_hash, mask_range):
+                return False
+            self.intensity_cake = intensity
+            self.tth_cake = tth
+            self.chi_cake = chi
+            return True
+        # three npy files from older versions, made without the metadata
         tth_filen, azi_filen, int_filen = \
             self.make_temp_filenames(temp_dir=temp_dir)
         if os.path.exists(tth_filen) and os.path.exists(azi_filen) and \
@@ -155,7 +315,30 @@ class DiffImg(object):
         else:
             return False
 
+    def temp_cake_is_current(self, temp_dir, poni_hash=None,
+                             mask_range=None):
+        """
+        return True if the temp cake was made with the same PONI and mask.
+        Only the header is read.
+        """
+        cake_filen = self.make_temp_cake_filename(temp_dir=temp_dir)
+        if not os.path.exists(cake_filen):
+            return False
+        try:
+            metadata = read_cake_header(cake_filen)['metadata']
+        except (OSError, ValueError, KeyError):
+            return False
+        return _same_conditions(metadata, poni_hash, mask_range)
+
+    def make_temp_cake_filename(self, temp_dir=None):
+        if not os.path.exists(temp_dir):
+            os.makedirs(temp_dir)
+        return make_filename(self.img_filename, 'cake', temp_dir=temp_dir)
+
     def make_temp_filenames(self, temp_dir=None):
+        """
+        filenames of the cake in older versions
+        """
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
         tth_filen = make_filename(self.img_filename, 'tth.cake.npy',
@@ -166,11 +349,43 @@ class DiffImg(object):
                                   temp_dir=temp_dir)
         return tth_filen, azi_filen, int_filen
 
-    def write_temp_cakefiles(self, temp_dir):
+    def write_temp_cakefiles(self, temp_dir, compression=None,
+                             max_error=None):
+        """
+        :param compression: None, 'zlib' or 'zlib-quantized'.  Cakes
+            without compression are memory-mapped when they are read.
+        :param max_error: largest intensity error for 'zlib-quantized'
+        """
+        if self.intensity_cake is None:
+            return
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
-        tth_filen, azi_filen, int_filen = self.make_temp_filenames(
-            temp_dir=temp_dir)
-        np.save(tth_filen, self.tth_cake)
-        np.save(azi_filen, self.chi_cake)
-        np.save(int_filen, self.intensity_cake)
+        cake_filen = self.make_temp_cake_filename(temp_dir=temp_dir)
+        # cake read from the same file, which cannot be replaced while
+        # mapped on Windows
+        if isinstance(self.intensity_cake, np.memmap) and \
+                (self.intensity_cake.filename == os.path.abspath(cake_filen)):
+            return
+        metadata = {'poni_hash': getattr(self, 'poni_hash', None),
+                    'mask_range': getattr(self, 'mask_range', None),
+                    'image': os.path.basename(self.img_filename)}
+        write_cake(cake_filen,
+                   self.intensity_cake, self.tth_cake, self.chi_cake,
+                   metadata=metadata, compression=compression,
+                   max_error=max_error)
+        # older files would be out of date
+        for filen in self.make_temp_filenames(temp_dir=temp_dir):
+            if os.path.exists(filen):
+                os.remove(filen)
+
+
+def _same_conditions(metadata, poni_hash, mask_range):
+    """
+    compare temp cake metadata with the PONI and mask, None to skip
+    """
+    if (poni_hash is not None) and (metadata.get('poni_hash') != poni_hash):
+        return False
+    if (mask_range is not None) and \
+            (metadata.get('mask_range') != list(mask_range)):
+        return False
+    return True
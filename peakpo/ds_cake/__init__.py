@@ -1 +1,6 @@
 from .DiffractionImage import DiffImg
+from .integratorcache import integrator_cache, IntegratorCache, \
+    get_lut_cache_dir, hash_file
+from .imagefile import read_image
+from .cakefile import read_cake, write_cake, read_cake_header
+from .precompute import CakePrecomputer, make_temp_cake
@@ -0,0 +1,172 @@
+"""
+One file for a cake: two theta, azimuthal angles and intensity with the
+conditions it was made with.
+
+    magic (8 bytes), header length (uint32), json header, data
+
+Intensity is saved in float32.  Without compression it is read through
+a memory map.  With compression, intensity is saved in chunks of rows,
+each compressed with zlib after the bytes are shuffled, either as it is
+('zlib', lossless) or rounded to steps of 2 * max_error ('zlib-quantized').
+Quantized steps are int32, nan is saved as _NAN_STEP.  Cakes with values
+out of the int32 range of steps or with inf are saved with 'zlib'.
+"""
+import json
+import zlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utils import write_replace
+
+CAKE_MAGIC = b'PKPOCAKE'
+CAKE_FILE_VERSION = 1
+COMPRESSIONS = [None, 'zlib', 'zlib-quantized']
+# data start at a multiple of this, for memory mapping
+_ALIGN = 64
+_CHUNK_ROWS = 16
+# quantized step for nan bins, out of the range used for numbers
+_NAN_STEP = -2 ** 31
+
+
+def _shuffle(data):
+    """
+    bytes of the same significance next to each other, which zlib
+    compresses better for numbers
+    """
+    return data.view(np.uint8).reshape(-1, data.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(buffer, dtype):
+    dtype = np.dtype(dtype)
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(
+        dtype.itemsize, -1).T.copy().view(dtype).ravel()
+
+
+def _can_quantize(intensity, max_error):
+    """
+    :return: True if all finite values fit in int32 steps of 2 * max_error
+    """
+    if np.isinf(intensity).any():
+        return False
+    finite = intensity[~np.isnan(intensity)]
+    if finite.size == 0:
+        return True
+    return np.abs(finite).max() / (2. * max_error) < 2 ** 31 - 1
+
+
+def write_cake(filename, intensity, tth, chi, metadata=None,
+               compression=None, max_error=None):
+    """
+    :param intensity: cake, (n_chi, n_tth)
+    :param tth: two theta in degrees
+    :param chi: azimuthal angles in degrees
+    :param metadata: dict to save with the cake, should be json
+        serializable
+    :param compression: one of COMPRESSIONS
+    :param max_error: largest error in intensity for 'zlib-quantized'
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression: ' + str(compression))
+    if (compression == 'zlib-quantized') and \
+            ((max_error is None) or (max_error <= 0.)):
+        raise ValueError('zlib-quantized needs a positive max_error')
+    intensity = np.ascontiguousarray(intensity, dtype='<f4')
+    if (compression == 'zlib-quantized') and \
+            (not _can_quantize(intensity, max_error)):
+        print(str(datetime.datetime.now())[:-7],
+              ": Cake intensity is out of range for zlib-quantized "
+              "with max_error {0:g}, saved with zlib.".format(max_error))
+        compression = 'zlib'
+        max_error = None
+    tth = np.ascontiguousarray(tth, dtype='<f8')
+    chi = np.ascontiguousarray(chi, dtype='<f8')
+    blocks = [tth.tobytes(), chi.tobytes()]
+    chunks = []
+    if compression is None:
+        blocks.append(intensity.tobytes())
+    else:
+        for i in range(0, intensity.shape[0], _CHUNK_ROWS):
+            rows = intensity[i:i + _CHUNK_ROWS]
+            if compression == 'zlib-quantized':
+                nan = np.isnan(rows)
+                rows = np.rint(np.where(nan, 0., rows) /
+                               (2. * max_error)).astype('<i4')
+                rows[nan] = _NAN_STEP
+            blocks.append(zlib.compress(_shuffle(rows), 6))
+            chunks.append(blocks[-1].__len__())
+    offsets = np.cumsum([0] + [b.__len__() for b in blocks])
+    header = {'version': CAKE_FILE_VERSION,
+              'shape': list(intensity.shape),
+              'n_tth': int(tth.size), 'n_chi': int(chi.size),
+              'compression': compression,
+              'max_error': max_error,
+              'nan_step': _NAN_STEP if compression == 'zlib-quantized'
+              else None,
+              'chunk_rows': _CHUNK_ROWS,
+              'chunks': chunks,
+              'offsets': [int(o) for o in offsets[:-1]],
+              'metadata': {} if metadata is None else metadata}
+    header_bytes = json.dumps(header).encode()
+    data_start = CAKE_MAGIC.__len__() + 4 + header_bytes.__len__()
+    header_bytes += b' ' * (-data_start % _ALIGN)
+    with write_replace(filename) as f:
+        f.write(CAKE_MAGIC)
+        f.write(np.uint32(header_bytes.__len__()).tobytes())
+        f.write(header_bytes)
+        for block in blocks:
+            f.write(block)
+
+
+def read_cake_header(filename):
+    """
+    :return: header dict with the start of data in 'data_start'
+    """
+    with open(filename, 'rb') as f:
+        if f.read(CAKE_MAGIC.__len__()) != CAKE_MAGIC:
+            raise ValueError('Not a cake file: ' + filename)
+        n_bytes = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(n_bytes).decode())
+        header['data_start'] = f.tell()
+    if header['version'] > CAKE_FILE_VERSION:
+        raise ValueError('Cake file from a newer version: ' + filename)
+    return header
+
+
+def read_cake(filename, max_workers=None):
+    """
+    :return: intensity, tth, chi, metadata.  intensity is a read-only
+        memory map for files without compression.
+    """
+    header = read_cake_header(filename)
+    start = header['data_start']
+    offsets = header['offsets']
+    shape = tuple(header['shape'])
+    tth = np.fromfile(filename, dtype='<f8', count=header['n_tth'],
+                      offset=start + offsets[0])
+    chi = np.fromfile(filename, dtype='<f8', count=header['n_chi'],
+                      offset=start + offsets[1])
+    if header['compression'] is None:
+        intensity = np.memmap(filename, dtype='<f4', mode='r',
+                              offset=start + offsets[2], shape=shape)
+        return intensity, tth, chi, header['metadata']
+    with open(filename, 'rb') as f:
+        f.seek(start + offsets[2])
+        chunks = [f.read(n) for n in header['chunks']]
+    quantized = (header['compression'] == 'zlib-quantized')
+    dtype = '<i4' if quantized else '<f4'
+
+    def decompress(chunk):
+        # zlib releases the GIL, chunks are decompressed in parallel
+        return _unshuffle(zlib.decompress(chunk), dtype)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        rows = list(executor.map(decompress, chunks))
+    intensity = np.concatenate(rows).reshape(shape)
+    if quantized:
+        nan_step = header.get('nan_step')
+        steps = intensity
+        intensity = (steps * (2. * header['max_error'])).astype(np.float32)
+        # files written before nan_step was added have no nan
+        if nan_step is not None:
+            intensity[steps == nan_step] = np.nan
+    return intensity, tth, chi, header['metadata']
@@ -0,0 +1,69 @@
+import numpy as np
+from PIL import Image
+import fabio
+from utils import extract_extension
+
+# PIL raw modes which are the same in memory as a numpy dtype
+_TIFF_DTYPES = {'L': 'u1', 'I;8': 'u1', 'I;8S': 'i1',
+                'I;16': '<u2', 'I;16B': '>u2',
+                'I;16S': '<i2', 'I;16BS': '>i2',
+                'I;32': '<u4', 'I;32B': '>u4',
+                'I;32S': '<i4', 'I;32BS': '>i4', 'I': '=i4',
+                'F;32F': '<f4', 'F;32BF': '>f4', 'F': '=f4',
+                'F;64F': '<f8', 'F;64BF': '>f8'}
+
+
+def _memmap_tiff(filename, tiff):
+    """
+    memory-map an uncompressed tiff, in which rows of all strips follow
+    each other in the file
+
+    :return: read-only array, None if the file cannot be mapped
+    """
+    width, height = tiff.size
+    tiles = tiff.tile
+    if tiles.__len__() == 0:
+        return None
+    rawmode = tiles[0][3][0] if isinstance(tiles[0][3], tuple) \
+        else tiles[0][3]
+    if rawmode not in _TIFF_DTYPES:
+        return None
+    dtype = np.dtype(_TIFF_DTYPES[rawmode])
+    row_bytes = width * dtype.itemsize
+    offset = tiles[0][2]
+    y_next = 0
+    for codec, extents, tile_offset, args in tiles:
+        if not isinstance(args, tuple):
+            args = (args,)
+        stride = args[1] if args.__len__() > 1 else 0
+        orientation = args[2] if args.__len__() > 2 else 1
+        if (codec != 'raw') or (args[0] != rawmode) or \
+                (stride not in (0, row_bytes)) or (orientation != 1) or \
+                (tuple(extents) != (0, y_next, width, extents[3])) or \
+                (tile_offset != offset + y_next * row_bytes):
+            return None
+        y_next = extents[3]
+    if y_next != height:
+        return None
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=(height, width))
+
+
+def read_image(filename):
+    """
+    read a detector image without copying, if possible.  Uncompressed
+    tiff files are memory-mapped, others are decoded with fabio or PIL.
+
+    :return: 2d array as stored in the file
+    """
+    extension = extract_extension(filename)
+    if extension in ['tif', 'tiff']:
+        with Image.open(filename) as tiff:
+            data = _memmap_tiff(filename, tiff)
+            if data is None:
+                data = np.asarray(tiff)
+        return data
+    elif extension in ['mar3450', 'cbf']:
+        # compressed formats, fabio has to decode
+        return fabio.open(filename).data
+    raise ValueError('Unsupported image format: ' + filename)
@@ -0,0 +1,241 @@
+import os
+import hashlib
+import threading
+import numpy as np
+import pyFAI
+from pyFAI import units
+from scipy import sparse
+from utils import MemoryLRU, write_replace, touch_cache_file, \
+    evict_cache_files
+
+# bump this when the table format or integration changes
+LUT_CACHE_VERSION = 1
+# same polarization factor as in the rest of PeakPo
+POLARIZATION_FACTOR = 0.99
+
+
+def hash_file(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def get_geometry_key(ai):
+    """
+    content address of the calibration in an azimuthal integrator.
+    Works also for integrators restored from old PPSS/DPP files, which
+    do not know their PONI file.
+    """
+    geometry = [ai.dist, ai.poni1, ai.poni2, ai.rot1, ai.rot2, ai.rot3,
+                ai.pixel1, ai.pixel2, ai.wavelength, ai.detector.name,
+                ai.detector.max_shape]
+    return hashlib.sha1(repr(geometry).encode()).hexdigest()
+
+
+def make_lut_key(ai, shape, npt, radial_range, mask):
+    """
+    :param npt: number of radial points, or (n_radial, n_azimuthal) for cake
+    :return: hex digest string
+    """
+    h = hashlib.sha1()
+    h.update('{0};{1};{2};{3:.8f},{4:.8f};{5:d}'.format(
+        get_geometry_key(ai), tuple(shape), npt, float(radial_range[0]),
+        float(radial_range[1]), LUT_CACHE_VERSION).encode())
+    if mask is not None:
+        h.update(np.packbits(np.ascontiguousarray(mask, dtype=bool)))
+    return h.hexdigest()
+
+
+def get_lut_cache_dir(filename):
+    """
+    disk cache is shared by all images in the same directory
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), 'lutcache')
+
+
+class IntegrationTable(object):
+    """
+    pyFAI CSR lookup table (bbox pixel splitting) and what else is needed
+    to integrate with it: I = (lut . img) / (lut . norm)
+    """
+
+    def __init__(self, lut, radial, azimuthal, norm):
+        """
+        :param lut: scipy sparse matrix, (n_bins, n_pixels)
+        :param radial: two theta of the bins in degrees
+        :param azimuthal: azimuthal angle of the bins in degrees, None for 1d
+        :param norm: solid angle times polarization for each pixel
+        """
+        self.lut = lut
+        self.radial = radial
+        self.azimuthal = azimuthal
+        self.norm = norm
+        self._lut_csc = None
+        self._chi = None
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return self.lut.data.nbytes + self.lut.indices.nbytes + \
+            self.lut.indptr.nbytes + self.norm.nbytes
+
+    def get_signal_norm(self, img, mask=None):
+        """
+        :param mask: pixels to exclude.  The same as a table made with
+            the mask, so one table can be used for all masks
+        :return: (n_pixels, 2) array of signal and norm
+        """
+        signal_norm = np.column_stack((img.ravel(), self.norm))
+        # masked_where gives a scalar False when nothing is masked
+        if (mask is not None) and np.any(mask):
+            signal_norm[np.ravel(mask)] = 0.
+        return signal_norm
+
+    def integrate(self, img, mask=None):
+        """
+        :return: intensity, flat for 1d, (n_azimuthal, n_radial) for cake
+        """
+        sum_signal, sum_norm = self.lut.dot(
+            self.get_signal_norm(img, mask=mask)).T
+        intensity = np.zeros(sum_signal.size)
+        np.divide(sum_signal, sum_norm, out=intensity,
+                  where=(sum_norm != 0.))
+        if self.azimuthal is None:
+            return intensity
+        return intensity.reshape(
+            self.radial.size, self.azimuthal.size).T
+
+    def get_lut_csc(self):
+        """
+        columns of pixels are taken from csc for sector integration
+        """
+        with self._lock:
+            if self._lut_csc is None:
+                self._lut_csc = self.lut.tocsc()
+            return self._lut_csc
+
+    def get_chi(self, ai, shape):
+        """
+        :return: azimuthal angle of pixel centers and half widths in degrees
+        """
+        with self._lock:
+            if self._chi is None:
+                chi = np.rad2deg(ai.array_from_unit(
+                    shape, "center", units.CHI_DEG, scale=False)).ravel()
+                d_chi = np.rad2deg(ai.array_from_unit(
+                    shape, "delta", units.CHI_DEG, scale=False)).ravel()
+                self._chi = (chi, d_chi)
+            return self._chi
+
+
+class IntegratorCache(object):
+    """
+    Keeps pyFAI integrators loaded from PONI files and the lookup tables
+    made with them.  Tables are keyed by make_lut_key and kept in memory up
+    to max_bytes and, if cache_dir is given, in <cache_dir>/<key>.lut.npz
+    up to max_disk_bytes for each directory.
+    """
+
+    def __init__(self, max_bytes=1024 * 2 ** 20,
+                 max_disk_bytes=2048 * 2 ** 20):
+        self.max_disk_bytes = max_disk_bytes
+        self._integrators = {}
+        self._tables = MemoryLRU(max_bytes)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._tables.__len__()
+
+    def clear(self):
+        with self._lock:
+            self._integrators.clear()
+        self._tables.clear()
+
+    def get_integrator(self, poni_filename):
+        """
+        load a PONI file only once for the same content
+        """
+        key = hash_file(poni_filename)
+        with self._lock:
+            if key not in self._integrators:
+                self._integrators[key] = pyFAI.load(poni_filename)
+            return self._integrators[key]
+
+    def get_table(self, ai, shape, npt, radial_range, mask=None,
+                  cache_dir=None):
+        """
+        :param npt: number of radial points, or (n_radial, n_azimuthal) for
+            cake
+        :return: IntegrationTable
+        """
+        key = make_lut_key(ai, shape, npt, radial_range, mask)
+        table = self._tables.get(key)
+        if table is not None:
+            return table
+        if cache_dir is not None:
+            table = self._read_table(key, cache_dir)
+        if table is None:
+            table = self._make_table(ai, shape, npt, radial_range, mask)
+            if cache_dir is not None:
+                self._write_table(key, table, cache_dir)
+        self._tables.put(key, table)
+        return table
+
+    def _make_table(self, ai, shape, npt, radial_range, mask):
+        if isinstance(npt, tuple):
+            unit = ("2th_deg", "chi_deg")
+        else:
+            unit = "2th_deg"
+        engine = ai.setup_sparse_integrator(
+            shape, npt, mask=mask, pos0_range=radial_range, unit=unit,
+            split='bbox', algo='CSR')
+        n_bins = int(np.prod(npt))
+        lut = sparse.csr_matrix(engine.lut, shape=(n_bins, int(np.prod(shape))))
+        if isinstance(npt, tuple):
+            radial = np.rad2deg(engine.bin_centers0)
+            azimuthal = np.rad2deg(engine.bin_centers1)
+        else:
+            radial = np.rad2deg(engine.bin_centers)
+            azimuthal = None
+        norm = (ai.solidAngleArray(shape) *
+                ai.polarization(shape, POLARIZATION_FACTOR)).ravel().\
+            astype(np.float64)
+        return IntegrationTable(lut, radial, azimuthal, norm)
+
+    def _make_filename(self, key, cache_dir):
+        return os.path.join(cache_dir, key + '.lut.npz')
+
+    def _read_table(self, key, cache_dir):
+        filen = self._make_filename(key, cache_dir)
+        if not os.path.exists(filen):
+            return None
+        try:
+            with np.load(filen) as f:
+                lut = sparse.csr_matrix(
+                    (f['data'], f['indices'], f['indptr']),
+                    shape=tuple(f['shape']))
+                azimuthal = f['azimuthal'] if f['azimuthal'].size else None
+                table = IntegrationTable(lut, f['radial'], azimuthal,
+                                         f['norm'])
+        except (OSError, ValueError, KeyError):
+            return None
+        touch_cache_file(filen)
+        return table
+
+    def _write_table(self, key, table, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        with write_replace(self._make_filename(key, cache_dir)) as f:
+            np.savez(f, data=table.lut.data, indices=table.lut.indices,
+                     indptr=table.lut.indptr,
+                     shape=np.array(table.lut.shape),
+                     radial=table.radial,
+                     azimuthal=(np.zeros(0) if table.azimuthal is None
+                                else table.azimuthal),
+                     norm=table.norm)
+        evict_cache_files(os.path.join(cache_dir, '*.lut.npz'),
+                          self.max_disk_bytes)
+
+
+# shared by all images
+integrator_cache = IntegratorCache()
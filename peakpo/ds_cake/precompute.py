@@ -0,0 +1,167 @@
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import find_associated_image, get_temp_dir
+from .DiffractionImage import DiffImg
+from .integratorcache import hash_file, get_lut_cache_dir
+
+
+def make_temp_cake(chi_filename, poni_filename, mask_range,
+                   compression=None, max_error=None):
+    """
+    make the temp cake for the image of a chi file the same way as
+    CakeController, unless the temp cake is current already
+
+    :return: temp cake filename, None if the chi file has no image
+    """
+    img_filename = find_associated_image(chi_filename)
+    if img_filename is None:
+        return None
+    temp_dir = get_temp_dir(chi_filename)
+    diff_img = DiffImg()
+    diff_img.load(img_filename)
+    if diff_img.temp_cake_is_current(
+            temp_dir, poni_hash=hash_file(poni_filename),
+            mask_range=mask_range):
+        return diff_img.make_temp_cake_filename(temp_dir=temp_dir)
+    diff_img.set_calibration(poni_filename)
+    diff_img.set_mask(mask_range)
+    diff_img.integrate_to_cake(cache_dir=get_lut_cache_dir(img_filename))
+    diff_img.write_temp_cakefiles(temp_dir, compression=compression,
+                                  max_error=max_error)
+    return diff_img.make_temp_cake_filename(temp_dir=temp_dir)
+
+
+class CakePrecomputer(object):
+    """
+    Make temp cakes for all images in a folder in worker threads, so that
+    moving to another file only reads a cake.  Files wait in a queue
+    nearest to the current file first and only max_workers of them are
+    given to the threads at a time, so the queue can be reordered when
+    the user moves to another file.
+    """
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=16)
+        self._queue = []
+        self._running = {}
+        self._job = None
+        self._job_id = 0
+        self._poni_filename = None
+        self._mask_range = None
+        self.n_total = 0
+        self.n_done = 0
+        self.n_failed = 0
+        self._lock = threading.Lock()
+
+    def start(self, chi_filenames, poni_filename, mask_range, current=None,
+              max_workers=None):
+        """
+        start a new queue, or only reorder the queue if nothing has
+        changed since the last start
+
+        :param chi_filenames: chi files in the order of navigation
+        :param current: chi file the user looks at, caked first
+        """
+        if max_workers is not None:
+            self.max_workers = max_workers
+        job = (tuple(chi_filenames), hash_file(poni_filename),
+               tuple(mask_range))
+        with self._lock:
+            if job != self._job:
+                self._job = job
+                self._job_id += 1
+                self._poni_filename = poni_filename
+                self._mask_range = list(mask_range)
+                self._queue = list(chi_filenames)
+                self.n_total = self._queue.__len__()
+                self.n_done = 0
+                self.n_failed = 0
+                print(str(datetime.datetime.now())[:-7],
+                      ": Precompute cakes for {0:d} files".format(
+                          self.n_total))
+        self.prioritize(current)
+        self._fill()
+
+    def prioritize(self, chi_filename):
+        """
+        sort the queue by distance from chi_filename in the navigation
+        order
+        """
+        with self._lock:
+            if (self._job is None) or (chi_filename not in self._job[0]):
+                return
+            position = {f: i for i, f in enumerate(self._job[0])}
+            i_current = position[chi_filename]
+            self._queue.sort(key=lambda f: abs(position[f] - i_current))
+
+    def claim(self, chi_filename):
+        """
+        take a file out of the queue, because the GUI cakes it now
+
+        :return: future if a worker is caking the file already, None
+            otherwise
+        """
+        with self._lock:
+            if chi_filename in self._queue:
+                self._queue.remove(chi_filename)
+                self.n_total -= 1
+            return self._running.get(chi_filename)
+
+    def _fill(self):
+        with self._lock:
+            # one file first, so that the lookup table is made only once
+            if self.n_done + self.n_failed == 0:
+                n_workers = 1
+            else:
+                n_workers = self.max_workers
+            while (self._running.__len__() < n_workers) and \
+                    (self._queue != []):
+                chi_filename = self._queue.pop(0)
+                future = self._executor.submit(
+                    make_temp_cake, chi_filename, self._poni_filename,
+                    self._mask_range)
+                self._running[chi_filename] = future
+                future.add_done_callback(
+                    lambda f, filename=chi_filename, job_id=self._job_id:
+                    self._on_done(f, filename, job_id))
+
+    def _on_done(self, future, chi_filename, job_id):
+        with self._lock:
+            if self._running.get(chi_filename) is future:
+                del self._running[chi_filename]
+            # a file of an older queue frees a worker only
+            if job_id != self._job_id:
+                pass
+            elif future.exception() is None:
+                self.n_done += 1
+            else:
+                self.n_failed += 1
+                print(str(datetime.datetime.now())[:-7],
+                      ": Precompute cake failed for ", chi_filename,
+                      future.exception())
+        self._fill()
+
+    def is_active(self):
+        with self._lock:
+            return (self._queue != []) or (self._running != {})
+
+    def get_progress(self):
+        """
+        :return: number of files finished, total and failed
+        """
+        with self._lock:
+            return self.n_done + self.n_failed, self.n_total, self.n_failed
+
+    def clear(self):
+        """
+        stop giving files to the workers, files being caked are finished
+        """
+        with self._lock:
+            self._queue = []
+            self._job = None
+            self._job_id += 1
+            self.n_total = 0
+            self.n_done = 0
+            self.n_failed = 0
@@ -3,3 +3,4 @@ from .jcpds import Session
 from .jcpds import UnitCell
 from .jcpds import DiffractionLine
 from .xrd import convert_tth
+from .reflectionindex import ReflectionIndex
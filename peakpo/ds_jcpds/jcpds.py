@@ -7,10 +7,70 @@ from pymatgen.analysis.diffraction.xrd import XRDCalculator
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from .jcpds_dioptas import jcpds, jcpds_reflection
 import datetime
+from collections import OrderedDict
 from scipy import interpolate
 
 # import numpy.ma as ma
 
+# number of (P, T, b/a, c/a, ...) results kept for each card
+DSP_MEMO_SIZE = 64
+# number of EOS inversion tables kept, one for each (v0, k0, k0p, alpha)
+EOS_TABLE_CACHE_SIZE = 64
+
+
+class EOSTable(object):
+    """
+    V(P) of the 3rd order Birch-Murnaghan equation tabulated on a dense
+    volume grid.  Inversion is a linear interpolation followed by Newton
+    steps, which agrees with bm3_v within its root finding tolerance.
+    """
+
+    def __init__(self, v0, k0, k0p, min_strain=0.3, n_pts=2048):
+        self.v0 = v0
+        self.k0 = k0
+        self.k0p = k0p
+        v = np.linspace(v0, v0 * min_strain, n_pts)
+        p = bm3_p(v, v0, k0, k0p)
+        # keep only the part where P increases monotonically
+        i_bad = np.nonzero(np.diff(p) <= 0.)[0]
+        if i_bad.size != 0:
+            v = v[:i_bad[0] + 1]
+            p = p[:i_bad[0] + 1]
+        self.v = v
+        self.p = p
+
+    def get_v(self, pressure, n_newton=2):
+        """
+        :return: volume, or None if pressure is out of the table
+        """
+        if (self.p.size < 2) or (pressure < self.p[0]) or \
+                (pressure > self.p[-1]):
+            return None
+        i = min(max(int(np.searchsorted(self.p, pressure)), 1),
+                self.p.size - 1)
+        dv_dp = (self.v[i] - self.v[i - 1]) / (self.p[i] - self.p[i - 1])
+        v = self.v[i - 1] + (pressure - self.p[i - 1]) * dv_dp
+        for j in range(n_newton):
+            v -= (bm3_p(v, self.v0, self.k0, self.k0p) - pressure) * dv_dp
+        return v
+
+
+_eos_tables = OrderedDict()
+
+
+def get_eos_table(v0, k0, k0p, thermal_expansion):
+    """
+    shared by all cards, so tweaking back and forth reuses tables
+    """
+    key = (v0, k0, k0p, thermal_expansion)
+    if key in _eos_tables:
+        _eos_tables.move_to_end(key)
+    else:
+        _eos_tables[key] = EOSTable(v0, k0, k0p)
+        if _eos_tables.__len__() > EOS_TABLE_CACHE_SIZE:
+            _eos_tables.popitem(last=False)
+    return _eos_tables[key]
+
 
 class DiffractionLine:
     """
@@ -343,8 +403,18 @@ class JCPDS(object):
         else:
             if self.symmetry == 'nosymmetry':
                 self.v = self.v0
+            elif pressure_st <= 1.e-5:
+                # same as bm3_v
+                self.v = self.v0
             else:
                 # print(pressure_st, self.v0, self.k0, self.k0p)
+                # tweaks change v0, k0, k0p, so a new table is made then
+                v_temp = get_eos_table(
+                    self.v0, self.k0, self.k0p,
+                    self.thermal_expansion).get_v(pressure_st)
+                if v_temp is not None:
+                    self.v = v_temp
+                    return
                 try:
                     v_temp = bm3_v(pressure_st, self.v0, self.k0, self.k0p,
                                 min_strain=0.3)
@@ -373,39 +443,43 @@ class JCPDS(object):
         # angles are always set to original values, so no need to reset
         # self.alpha = self.alpha0;
         # self.beta = self.beta0; self.gamma = self.gamma0
-        self._cal_v(pressure, temperature)
         if b_a is None:
             b_a = self.b0 / self.a0
         if c_a is None:
             c_a = self.c0 / self.a0
-
-        if (((pressure == 0.0) and (temperature == 300.) and (use_table_for_0GPa))
-                or (self.symmetry == 'nosymmetry')):
-            # p = 0 GPa, resetting to uc0 is necessary
-            self.v = self.v0
-            self.a = self.a0
-            self.b = self.b0
-            self.c = self.c0
-            for dl in self.DiffLines:
-                dsp = dl.dsp0
-                dl.dsp = dsp
-#            DLines = self.get_DiffractionLines()
-#            for dl in DLines:
-#                dsp = dl.dsp0
-#                dl.dsp = dsp
+        h, k, l, dsp0, intensity = self._get_line_arrays()
+        # tweaks change k0, k0p, v0, and thermal_expansion, so they are
+        # in the key too
+        key = (pressure, temperature, b_a, c_a, use_table_for_0GPa,
+               self.symmetry, self.v0, self.k0, self.k0p,
+               self.thermal_expansion, self.a0, self.b0, self.c0,
+               self.alpha0, self.beta0, self.gamma0)
+        if key in self._dsp_memo:
+            self._dsp_memo.move_to_end(key)
+            self.v, self.a, self.b, self.c, dsp = self._dsp_memo[key]
         else:
-            self._cal_UCPatPT(b_a, c_a)
-            DLines = self.get_DiffractionLines()
-#            a = self.a; b = self.b; c = self.c;
-#            alpha = self.alpha; beta = self.beta; gamma = self.gamma
-            for dl in DLines:
-                dsp = cal_dspacing(self.symmetry, dl.h, dl.k, dl.l,
+            self._cal_v(pressure, temperature)
+            if (((pressure == 0.0) and (temperature == 300.) and
+                    (use_table_for_0GPa)) or (self.symmetry == 'nosymmetry')):
+                # p = 0 GPa, resetting to uc0 is necessary
+                self.v = self.v0
+                self.a = self.a0
+                self.b = self.b0
+                self.c = self.c0
+                dsp = dsp0
+            else:
+                self._cal_UCPatPT(b_a, c_a)
+                # all lines at once
+                dsp = cal_dspacing(self.symmetry, h, k, l,
                                    self.a, self.b, self.c,
                                    self.alpha, self.beta, self.gamma)
-                dl.dsp = dsp
-            # the code worked without the following line, perhaps
-            # due to the referencing or copy issue in python list
-            self.DiffLines = DLines[:]
+            self._dsp_memo[key] = (self.v, self.a, self.b, self.c, dsp)
+            if self._dsp_memo.__len__() > DSP_MEMO_SIZE:
+                self._dsp_memo.popitem(last=False)
+        self._dsp = dsp
+        # DiffLines are still used by tables, peak fitting, and ucfit
+        for dl, d in zip(self.DiffLines, np.asarray(dsp).tolist()):
+            dl.dsp = d
         """
         elif ((pressure == 0.0) and (temperature == 300.)) and (not use_table_for_0GPa):
             self._cal_UCPatPT(b_a, c_a)
@@ -429,6 +503,24 @@ class JCPDS(object):
         """
         return self.DiffLines
 
+    def _get_line_arrays(self):
+        """
+        Returns h, k, l, dsp0, and intensity of DiffLines as arrays.
+        They are made again only when DiffLines is replaced, for example
+        by read_file.  Cards from old PPSS/DPP files get them here too.
+        """
+        if (getattr(self, '_line_src', None) is not self.DiffLines) or \
+                (self._line_arrays[0].size != self.DiffLines.__len__()):
+            self._line_arrays = tuple(
+                np.array([getattr(dl, attr) for dl in self.DiffLines],
+                         dtype=float)
+                for attr in ['h', 'k', 'l', 'dsp0', 'intensity'])
+            self._line_src = self.DiffLines
+            self._dsp_memo = OrderedDict()
+            self._dsp = None
+            self._tth_memo = None
+        return self._line_arrays
+
     def get_tthVSint(self, wavelength):
         """
         Returns twoth and intensity for bar plots in PyPeakPo
@@ -436,6 +528,16 @@ class JCPDS(object):
         If P, T, b_a, c_a have changed, run cal_dsp first for update
         """
 #        self.cal_dsp(pressure, temperature, b_a, c_a)
+        if (getattr(self, '_line_src', None) is self.DiffLines) and \
+                (self._dsp is not None) and \
+                (np.size(self._dsp) == self.DiffLines.__len__()):
+            if (self._tth_memo is None) or \
+                    (self._tth_memo[0] != wavelength) or \
+                    (self._tth_memo[1] is not self._dsp):
+                tth = 2. * np.degrees(np.arcsin(wavelength / 2. / self._dsp))
+                self._tth_memo = (wavelength, self._dsp, tth)
+            # copies, so that callers cannot change the memo
+            return self._tth_memo[2].copy(), self._line_arrays[4].copy()
         DLines = self.get_DiffractionLines()
 
         dsp = []
@@ -0,0 +1,103 @@
+import numpy as np
+
+
+def _get_dsp_token(phase):
+    """
+    changes when d-spacings of the phase change.  JCPDS keeps the array
+    of its last cal_dsp, the same object for the same conditions.
+    """
+    dsp = getattr(phase, '_dsp', None)
+    if isinstance(dsp, np.ndarray) and \
+            (getattr(phase, '_line_src', None) is phase.DiffLines):
+        return dsp
+    return tuple(dl.dsp for dl in phase.DiffLines)
+
+
+def _same_token(token, old_token):
+    if isinstance(token, np.ndarray) or isinstance(old_token, np.ndarray):
+        return token is old_token
+    return token == old_token
+
+
+class ReflectionIndex(object):
+    """
+    Diffraction lines of all displayed phases, sorted by two theta, for
+    finding the line closest to a position with searchsorted.  Made again
+    only when the wavelength, the displayed phases or their d-spacings
+    change, that is after a change of pressure, temperature or tweaks.
+    """
+
+    def __init__(self):
+        self._key = None
+        self.tth = np.zeros(0)
+        self._lines = None
+        self._names = []
+
+    def _make_key(self, phases, wavelength):
+        return (wavelength,
+                [(phase, _get_dsp_token(phase)) for phase in phases])
+
+    def _is_current(self, key):
+        if (self._key is None) or (self._key[0] != key[0]) or \
+                (self._key[1].__len__() != key[1].__len__()):
+            return False
+        for (phase, token), (old_phase, old_token) in \
+                zip(key[1], self._key[1]):
+            if (phase is not old_phase) or \
+                    (not _same_token(token, old_token)):
+                return False
+        return True
+
+    def update(self, phases, wavelength):
+        """
+        :param phases: JCPDS or UnitCell, only displayed ones are used.
+            For lines at the same two theta, the first phase is taken.
+        """
+        phases = [phase for phase in phases if phase.display]
+        key = self._make_key(phases, wavelength)
+        if self._is_current(key):
+            return
+        tth, lines, i_phase = [], [], []
+        for i, phase in enumerate(phases):
+            if phase.DiffLines == []:
+                continue
+            tth.append(np.asarray(phase.get_tthVSint(wavelength)[0],
+                                  dtype=float))
+            lines.append(np.array(
+                [[dl.dsp, dl.intensity, dl.h, dl.k, dl.l]
+                 for dl in phase.DiffLines], dtype=float))
+            i_phase.append(np.full(phase.DiffLines.__len__(), i))
+        if tth == []:
+            self.tth = np.zeros(0)
+            self._lines = np.zeros((0, 6))
+        else:
+            tth = np.concatenate(tth)
+            lines = np.column_stack(
+                (np.concatenate(lines), np.concatenate(i_phase)))
+            # lines out of reach of the wavelength have nan two theta
+            finite = np.isfinite(tth)
+            order = np.argsort(tth[finite], kind='stable')
+            self.tth = tth[finite][order]
+            self._lines = lines[finite][order]
+        self._names = [phase.name for phase in phases]
+        self._key = key
+
+    def __len__(self):
+        return self.tth.size
+
+    def find_closest(self, tth_c):
+        """
+        :return: dict of name, tth, dsp, intensity, h, k, l of the line
+            closest to tth_c, None if there is no line
+        """
+        if self.tth.size == 0:
+            return None
+        i = np.searchsorted(self.tth, tth_c)
+        if (i == self.tth.size) or \
+                ((i > 0) and (tth_c - self.tth[i - 1] <= self.tth[i] - tth_c)):
+            i -= 1
+        # first of the lines at the same two theta
+        i = np.searchsorted(self.tth, self.tth[i])
+        dsp, intensity, h, k, l, i_phase = self._lines[i]
+        return {'name': self._names[int(i_phase)], 'tth': self.tth[i],
+                'dsp': dsp, 'intensity': intensity, 'h': h, 'k': k, 'l': l}
@@ -2,14 +2,18 @@ import numpy as np
 import os
 import time
 import datetime
-from utils import writechi, readchi, make_filename
-from .background import fit_bg_cheb_auto
+from utils import writechi, readchi, make_filename, get_directory, \
+    read_xy_with_sidecar
+from .background import BG_ENGINES, get_bg_engine
+from .bgcache import make_bg_key
 
 
 class Pattern(object):
     """
     This modified from the same object in ds_* modules
     """
+    # patterns from older versions do not have it
+    bg_engine = 'cheb'
 
     def __init__(self, filename=None):
         if filename is None:
@@ -23,14 +27,22 @@ class Pattern(object):
         self.x_bg = None
         self.y_bg = None
         self.params_chbg = [20, 10, 20]
+        self.bg_engine = 'cheb'
 
-    def read_file(self, fname):
+    def read_file(self, fname, sidecar=False):
         """
         read a chi file and get raw xy
+
+        :param sidecar: keep a binary copy in the -param directory and
+            memory-map it in later reads
         """
         if fname.endswith('.chi'):
-            data = np.loadtxt(fname, skiprows=4)
-            twotheta, intensity = data.T
+            if sidecar:
+                twotheta, intensity = read_xy_with_sidecar(
+                    fname, sidecar_filen=self._make_sidecar_filename(fname))
+            else:
+                data = np.loadtxt(fname, skiprows=4)
+                twotheta, intensity = data.T
         else:
             raise ValueError('Only support CHI, MSA, and EDS formats')
         # set file name information
@@ -39,6 +51,10 @@ class Pattern(object):
         self.x_raw = twotheta
         self.y_raw = intensity
 
+    def _make_sidecar_filename(self, fname):
+        return os.path.join(get_directory(fname, '-param'),
+                            os.path.basename(fname) + '.npy')
+
     def _get_section(self, x, y, roi):
         if roi[0] >= x.min() and roi[1] <= x.max():
             i_roimin = np.abs(x - roi[0]).argmin()
@@ -60,15 +76,76 @@ class Pattern(object):
         else:
             return self._get_section(self.x_raw, self.y_raw, roi)
 
-    def _get_bg(self, roi, params=None, yshift=0.):
-        if params is not None:
-            self.params_chbg = params
+    def set_bg_engine(self, bg_engine):
+        """
+        :param bg_engine: one of BG_ENGINES.  Parameters are not changed,
+            set them for the engine with the next fit
+        """
+        get_bg_engine(bg_engine)
+        self.bg_engine = bg_engine
+
+    def make_bg_key(self, roi, params=None, engine=None):
+        """
+        content address of the background for the raw data, roi, params
+        and engine
+        """
+        if params is None:
+            params = self.params_chbg
+        if engine is None:
+            engine = self.bg_engine
+        return make_bg_key(self.x_raw, self.y_raw, roi, params, engine)
+
+    def fit_bg(self, roi, params=None, cache=None, cache_dir=None,
+               engine=None):
+        """
+        fit background without changing the pattern, so that it can run
+        in a worker thread
+
+        :param engine: background engine, current one of the pattern
+            if None
+        :return: x, raw y and fitted background in roi
+        """
+        if params is None:
+            params = self.params_chbg
+        if engine is None:
+            engine = self.bg_engine
+        fit = get_bg_engine(engine).fit
         x, y = self._get_section(self.x_raw, self.y_raw, roi)
+        if cache is not None:
+            key = self.make_bg_key(roi, params, engine)
+            y_bg = cache.get(key, cache_dir=cache_dir)
+            if (y_bg is not None) and (y_bg.size == x.size):
+                print(str(datetime.datetime.now())[:-7],
+                      ": Bgsub from cache")
+                return x, y, y_bg
         t_start = time.time()
-        y_bg = fit_bg_cheb_auto(x, y, self.params_chbg[0],
-                                self.params_chbg[1], self.params_chbg[2])
+        y_bg = fit(x, y, params)
         print(str(datetime.datetime.now())[:-7], 
             ": Bgsub takes {0:.2f}s".format(time.time() - t_start))
+        if cache is not None:
+            cache.put(key, y_bg, cache_dir=cache_dir)
+        return x, y, y_bg
+
+    def _get_bg(self, roi, params=None, yshift=0., cache=None,
+                cache_dir=None, engine=None):
+        if params is not None:
+            self.params_chbg = params
+        if engine is not None:
+            self.set_bg_engine(engine)
+        x, y, y_bg = self.fit_bg(roi, cache=cache, cache_dir=cache_dir)
+        self.set_bg_from_fit(x, y, y_bg, roi)
+
+    def set_bg_from_fit(self, x, y, y_bg, roi, params=None, engine=None):
+        """
+        set background from a fit made elsewhere, such as a process pool
+        :param x: x of the section in roi
+        :param y: raw y of the section in roi
+        :param y_bg: fitted background for x
+        """
+        if params is not None:
+            self.params_chbg = params
+        if engine is not None:
+            self.set_bg_engine(engine)
         self.x_bg = x
         self.x_bgsub = x
         y_bgsub = y - y_bg
@@ -80,9 +157,30 @@ class Pattern(object):
         self.y_bg = y_bg
         self.roi = roi
 
-    def subtract_bg(self, roi, params=None, yshift=10.):
+    def bg_is_current(self, roi, params, engine=None):
+        """
+        return True if the background was fitted with the same roi and
+        params, and engine if it is given
+        """
+        if (getattr(self, 'y_bg', None) is None) or \
+                (getattr(self, 'roi', None) is None):
+            return False
+        if (engine is not None) and (engine != self.bg_engine):
+            return False
+        # roi in temp files is written with 5 decimals
+        return np.allclose(self.roi, roi, rtol=0., atol=1.e-5) and \
+            (list(self.params_chbg) == list(params))
+
+    def subtract_bg(self, roi, params=None, yshift=10., cache=None,
+                    cache_dir=None, engine=None):
+        """
+        :param cache: BackgroundCache to look up and store the fit
+        :param cache_dir: directory for the disk part of the cache
+        :param engine: background engine, current one if None
+        """
         print(str(datetime.datetime.now())[:-7], ": Receive BG subtraction")
-        self._get_bg(roi, params=params, yshift=yshift)
+        self._get_bg(roi, params=params, yshift=yshift, cache=cache,
+                     cache_dir=cache_dir, engine=engine)
 
     def get_raw(self):
         return self.x_raw, self.y_raw
@@ -96,46 +194,79 @@ class Pattern(object):
     def get_bg(self):
         return self.x_bg, self.y_bg
 
-    def set_bg(self, x_bg, y_bg, x_bgsub, y_bgsub, roi, bg_params):
+    def set_bg(self, x_bg, y_bg, x_bgsub, y_bgsub, roi, bg_params,
+               bg_engine='cheb'):
+        # the same x in both temp files, keep it once
+        if np.array_equal(x_bg, x_bgsub):
+            x_bg = x_bgsub
         self.x_bg = x_bg
         self.y_bg = y_bg
         self.x_bgsub = x_bgsub
         self.y_bgsub = y_bgsub
         self.roi = roi
         self.params_chbg = bg_params
+        self.set_bg_engine(bg_engine)
 
-    def get_chbg(self, roi, params=None, chiout=False, yshift=10.):
+    def get_chbg(self, roi, params=None, chiout=False, yshift=10.,
+                 cache=None, cache_dir=None, engine=None):
         """
         subtract background from raw data for a roi and then store in
         chbg xy
         """
-        self._get_bg(roi, params=params, yshift=yshift)
+        self._get_bg(roi, params=params, yshift=yshift, cache=cache,
+                     cache_dir=cache_dir, engine=engine)
 
         if chiout:
+            bg_label = "2-theta, " + self.bg_engine.upper() + " BG:" + \
+                ' '.join(map(str, self.params_chbg)) + "\n\n"
             # write background file
             f_bg = os.path.splitext(self.fname)[0] + '.bg.chi'
-            text = "Background\n" + "2-theta, CHEB BG:" + \
-                ' '.join(map(str, self.params_chbg)) + "\n\n"
+            text = "Background\n" + bg_label
             writechi(f_bg, self.x_bgsub, self.y_bg, preheader=text)
             # write background subtracted file
             f_bgsub = os.path.splitext(self.fname)[0] + '.bgsub.chi'
             text = "Background subtracted diffraction pattern\n" + \
-                "2-theta, CHEB BG:" + ' '.join(map(str, self.params_chbg)) + "\n\n"
+                bg_label
             writechi(f_bgsub, self.x_bgsub, self.y_bgsub, preheader=text)
 
-    def read_bg_from_tempfile(self, temp_dir=None):
+    def read_bg_from_tempfile(self, temp_dir=None, roi=None, params=None,
+                              engine=None):
+        """
+        :param roi: if given, temp files made with a different roi are
+            not used
+        :param params: if given, temp files made with different bg params
+            are not used
+        :param engine: if given, temp files made with a different
+            background engine are not used
+        :return: True if background was read from the temp files
+        """
         bgsub_filen, bg_filen = self.make_temp_filenames(temp_dir=temp_dir)
-        if os.path.exists(bgsub_filen) and os.path.exists(bg_filen):
-            roi, bg_params, x_bgsub, y_bgsub = readchi(bgsub_filen)
-            __, __, x_bg, y_bg = readchi(bg_filen)
-            self.set_bg(x_bg, y_bg, x_bgsub, y_bgsub, roi, bg_params)
-            return True
-        else:
+        if not (os.path.exists(bgsub_filen) and os.path.exists(bg_filen)):
+            return False
+        roi_file, bg_params, x_bgsub, y_bgsub = readchi(
+            bgsub_filen, sidecar=True)
+        if (roi is not None) and \
+                (not np.allclose(roi_file, roi, rtol=0., atol=1.e-5)):
+            return False
+        if (params is not None) and (list(bg_params) != list(params)):
             return False
+        bg_engine = _read_bg_engine(bgsub_filen)
+        if (bg_engine not in BG_ENGINES) or \
+                ((engine is not None) and (bg_engine != engine)):
+            return False
+        # files made before the key was added cannot be checked
+        # against the raw data
+        key = _read_bg_key(bgsub_filen)
+        if (key is not None) and (self.x_raw is not None) and \
+                (key != self.make_bg_key(roi_file, bg_params, bg_engine)):
+            return False
+        __, __, x_bg, y_bg = readchi(bg_filen, sidecar=True)
+        self.set_bg(x_bg, y_bg, x_bgsub, y_bgsub, roi_file, bg_params,
+                    bg_engine=bg_engine)
+        return True
 
     def make_temp_filenames(self, temp_dir=None):
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
+        os.makedirs(temp_dir, exist_ok=True)
         bgsub_filen = make_filename(self.fname, 'bgsub.chi',
                                     temp_dir=temp_dir)
         bg_filen = make_filename(self.fname, 'bg.chi',
@@ -149,24 +280,66 @@ class Pattern(object):
         else:
             return False
 
+    def temp_files_current(self, temp_dir):
+        """
+        return True if temp files exist for the current background
+        """
+        if (self.x_raw is None) or (not self.temp_files_exist(temp_dir)):
+            return False
+        bgsub_filen, bg_filen = self.make_temp_filenames(temp_dir=temp_dir)
+        key = self.make_bg_key(self.roi)
+        return (_read_bg_key(bgsub_filen) == key) and \
+            (_read_bg_key(bg_filen) == key)
+
     def write_temporary_bgfiles(self, temp_dir):
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
+        os.makedirs(temp_dir, exist_ok=True)
         bgsub_filen, bg_filen = self.make_temp_filenames(temp_dir=temp_dir)
         x_bgsub, y_bgsub = self.get_bgsub()
         x_bg, y_bg = self.get_bg()
         preheader_line0 = \
             '# BG ROI: {0: .5f}, {1: .5f} \n'.format(self.roi[0], self.roi[1])
-        preheader_line1 = \
-            '# BG Params: {0: d}, {1: d}, {2: d} \n'.format(
-                self.params_chbg[0], self.params_chbg[1], self.params_chbg[2])
-        preheader_line2 = '\n'
+        # engine name has no digits, older versions read only the numbers
+        preheader_line1 = '# BG Params: {0:s}, {1:s} \n'.format(
+            self.bg_engine, ', '.join(str(p) for p in self.params_chbg))
+        # readers skip this line, so older versions still read the file
+        if self.x_raw is None:
+            preheader_line2 = '\n'
+        else:
+            preheader_line2 = '# BG Key: {0:s} \n'.format(
+                self.make_bg_key(self.roi))
         writechi(bgsub_filen, x_bgsub, y_bgsub, preheader=preheader_line0 +
                  preheader_line1 + preheader_line2)
         writechi(bg_filen, x_bg, y_bg, preheader=preheader_line0 +
                  preheader_line1 + preheader_line2)
 
 
+def _read_bg_key(filen):
+    """
+    read background key from the third line of a temporary chi file
+    """
+    with open(filen) as f:
+        for i in range(3):
+            line = f.readline()
+    if line.startswith('# BG Key:'):
+        return line.split(':')[1].strip()
+    return None
+
+
+def _read_bg_engine(filen):
+    """
+    read background engine from the second line of a temporary chi file.
+    files made before engines were added are for cheb.
+    """
+    with open(filen) as f:
+        for i in range(2):
+            line = f.readline()
+    words = line.replace(':', ' ').replace(',', ' ').split()
+    if (words[:3] == ['#', 'BG', 'Params']) and (words.__len__() > 3) and \
+            words[3].isalpha():
+        return words[3]
+    return 'cheb'
+
+
 class PatternPeakPo(Pattern):
     '''
     Do not update this.
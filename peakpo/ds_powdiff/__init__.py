@@ -1,2 +1,9 @@
 from .DiffractionPattern import PatternPeakPo
 from .powdiff import get_DataSection
+from .batch import subtract_bg_batch, fit_bg_batch, write_bg_batch
+from .prefetch import PatternPrefetcher
+from .patternstack import PatternStack, get_pattern_stack
+from .heatmap import HeatMap, get_heat_map
+from .background import BG_ENGINES
+from .bgcache import bg_cache, BackgroundCache, make_bg_key, \
+    get_bg_cache_dir
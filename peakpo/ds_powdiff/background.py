@@ -1,8 +1,65 @@
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
 import numpy as np
+from scipy.linalg import solveh_banded
+
+# number of Chebyshev projectors kept, one for each x grid and order
+CHEB_PROJECTOR_CACHE_SIZE = 16
+_cheb_projectors = OrderedDict()
+_cheb_projectors_lock = threading.Lock()
+
+
+def get_grid_key(x):
+    """
+    :return: hex digest of x, the same for patterns on the same grid
+    """
+    return hashlib.sha1(
+        np.ascontiguousarray(x, dtype=np.float64).tobytes()).hexdigest()
+
+
+def get_cheb_projector(x, n_cheborder):
+    """
+    orthonormal basis of the Chebyshev polynomials up to n_cheborder on x,
+    so that the least-squares fit of y on x is q.dot(q.T.dot(y)).
+    Patterns from the same detector and roi have the same x, so q is
+    made only once for them.
+
+    :return: q, read-only (x.size, n_cheborder + 1) array
+    """
+    key = (get_grid_key(x), int(n_cheborder))
+    with _cheb_projectors_lock:
+        if key in _cheb_projectors:
+            _cheb_projectors.move_to_end(key)
+            return _cheb_projectors[key]
+    x = np.asarray(x, dtype=np.float64)
+    x_cheb = 2. * (x - x[0]) / (x[-1] - x[0]) - 1.
+    q, r = np.linalg.qr(
+        np.polynomial.chebyshev.chebvander(x_cheb, int(n_cheborder)))
+    q.setflags(write=False)
+    with _cheb_projectors_lock:
+        _cheb_projectors[key] = q
+        while _cheb_projectors.__len__() > CHEB_PROJECTOR_CACHE_SIZE:
+            _cheb_projectors.popitem(last=False)
+    return q
+
+
+def fit_cheb(x, y, n_cheborder):
+    """
+    least-squares Chebyshev fit evaluated on x, the same as chebfit and
+    then chebval
+
+    :param y: one pattern, or (n_patterns, x.size) array for many
+        patterns on the same x, fitted in one matrix multiply
+    :return: fitted y in the shape of y
+    """
+    q = get_cheb_projector(x, n_cheborder)
+    y = np.asarray(y, dtype=np.float64)
+    return q.dot(q.T.dot(y.T)).T
 
 
 def fit_bg_cheb_auto(x, y_obs, n_points=20, n_iteration=10, n_cheborder=20,
-                     accurate=True):
+                     accurate=True, smooth_method='running'):
     """
     this returns cheb parameter for fitted background
     best for synchrotron XRD is:
@@ -13,20 +70,229 @@ def fit_bg_cheb_auto(x, y_obs, n_points=20, n_iteration=10, n_cheborder=20,
     :param n_iteration:
     :param n_cheborder:
     :param accurate:
+    :param smooth_method: engine for Bruckner smoothing, see smooth_bruckner
     """
-    y_bg_smooth = smooth_bruckner(x, y_obs, n_points, n_iteration)
+    y_bg_smooth = smooth_bruckner(x, y_obs, n_points, n_iteration,
+                                  method=smooth_method)
 
+    if accurate:
+        return fit_cheb(x, y_bg_smooth, n_cheborder)
     # get cheb input parameters
     x_cheb = 2. * (x - x[0]) / (x[-1] - x[0]) - 1.
-    cheb_parameters = np.polynomial.chebyshev.chebfit(
-        x_cheb, y_bg_smooth, n_cheborder)
-    if accurate:
-        return np.polynomial.chebyshev.chebval(x_cheb, cheb_parameters)
+    return np.polynomial.chebyshev.chebfit(x_cheb, y_bg_smooth, n_cheborder)
+
+
+def fit_bg_snip(x, y_obs, n_points=30, n_smooth=0, lls=True):
+    """
+    SNIP background (statistics-sensitive non-linear iterative peak
+    clipping).  Each pass clips the pattern to the average of the two
+    points p apart, for p from 1 to n_points, so the cost is
+    n_points passes over the data.
+
+    :param x: x, not used but kept for the same call as other engines
+    :param y_obs: observed y, or (n_patterns, n_data) array
+    :param n_points: half width of the widest clipping window in points,
+        about the full width of the broadest peak
+    :param n_smooth: half width of a moving average applied before
+        clipping, 0 for none
+    :param lls: clip in log-log-sqrt scale, which keeps weak peaks on a
+        high background from being clipped into the background
+    :return: background in the shape of y_obs
+    """
+    y = np.array(y_obs, dtype=np.float64)
+    if n_smooth > 0:
+        y = _moving_average(y, int(n_smooth))
+    if lls:
+        y_min = y.min(axis=-1, keepdims=True)
+        v = np.log(np.log(np.sqrt(y - y_min + 1.) + 1.) + 1.)
+    else:
+        v = y
+    n_data = v.shape[-1]
+    for p in range(1, min(int(n_points), (n_data - 1) // 2) + 1):
+        avg = 0.5 * (v[..., :-2 * p] + v[..., 2 * p:])
+        np.minimum(v[..., p:-p], avg, out=v[..., p:-p])
+    if lls:
+        return (np.exp(np.exp(v) - 1.) - 1.) ** 2 - 1. + y_min
+    return v
+
+
+def _moving_average(y, n):
+    """
+    average over 2n + 1 points, ends averaged over the points available
+    """
+    w = 2 * n + 1
+    pad = [(0, 0)] * (y.ndim - 1) + [(n, n)]
+    c = np.cumsum(np.pad(y, pad, mode='edge'), axis=-1)
+    c = np.concatenate((np.zeros(c.shape[:-1] + (1,)), c), axis=-1)
+    return (c[..., w:] - c[..., :-w]) / w
+
+
+def fit_bg_als(x, y_obs, lam=1.e6, p=1.e-3, n_iter=10):
+    """
+    asymmetric least squares background (Eilers and Boelens).  Smooth
+    curve z minimizing sum(w (y - z)^2) + lam sum((second difference
+    of z)^2), with weight p for points above z and 1 - p for points
+    below.  Each iteration solves a banded system in linear time.
+
+    :param x: x, not used but kept for the same call as other engines
+    :param y_obs: observed y
+    :param lam: smoothness, larger for a stiffer background.  Scales
+        with the square of the number of points per peak width
+    :param p: asymmetry, 0.001 to 0.05
+    :param n_iter: number of weight updates
+    :return: background
+    """
+    y = np.asarray(y_obs, dtype=np.float64)
+    n_data = y.size
+    if n_data < 5:
+        return np.full(n_data, y.min())
+    # lam * D.T D for second differences, upper banded form
+    ab = np.zeros((3, n_data))
+    ab[0, 2:] = lam
+    ab[1, 1:] = -4. * lam
+    ab[1, 1] = ab[1, -1] = -2. * lam
+    ab[2, :] = 6. * lam
+    ab[2, 0] = ab[2, -1] = lam
+    ab[2, 1] = ab[2, -2] = 5. * lam
+    diag = ab[2].copy()
+    w = np.ones(n_data)
+    z = y
+    for i in range(int(n_iter)):
+        ab[2] = diag + w
+        z = solveh_banded(ab, w * y, check_finite=False)
+        w_new = np.where(y > z, p, 1. - p)
+        if np.array_equal(w_new, w):
+            break
+        w = w_new
+    return z
+
+
+def _fit_bg_cheb(x, y_obs, params):
+    return fit_bg_cheb_auto(x, y_obs, params[0], params[1], params[2])
+
+
+def _fit_bg_snip(x, y_obs, params):
+    return fit_bg_snip(x, y_obs, params[0], params[1], bool(params[2]))
+
+
+def _fit_bg_als(x, y_obs, params):
+    return fit_bg_als(x, y_obs, 10. ** params[0], 10. ** -params[1],
+                      params[2])
+
+
+# fit(x, y_obs, params) returns the background.  Every engine takes three
+# numbers, which are the three spin boxes of the background tab.
+BGEngine = namedtuple('BGEngine', ['fit', 'defaults', 'labels'])
+BG_ENGINES = OrderedDict([
+    ('cheb', BGEngine(_fit_bg_cheb, [20, 10, 20],
+                      ['N Points', 'N Iteration', 'N Order'])),
+    ('snip', BGEngine(_fit_bg_snip, [30, 0, 1],
+                      ['N Points', 'N Smooth', 'LLS (0/1)'])),
+    ('als', BGEngine(_fit_bg_als, [6, 3, 10],
+                     ['log10 Lambda', '-log10 P', 'N Iteration']))])
+
+
+def get_bg_engine(name):
+    """
+    :param name: one of BG_ENGINES
+    """
+    if name not in BG_ENGINES:
+        raise ValueError('Unknown background engine: ' + str(name))
+    return BG_ENGINES[name]
+
+
+def smooth_bruckner(x, y_obs, n_smooth, n_iter, method='running'):
+    """
+    Bruckner smoothing for background estimation
+
+    :param x: x, not used but kept for compatibility
+    :param y_obs: observed y
+    :param n_smooth: half width of the averaging window in data points
+    :param n_iter: number of smoothing iterations
+    :param method: 'running' (default) updates the window sum
+        incrementally and reproduces the legacy output within floating
+        point tolerance, 'vectorized' averages over the whole pattern at
+        once with cumsum (fastest, but each pass uses the values from the
+        previous pass so the result is slightly different),
+        'legacy' is the original implementation kept for regression checks
+    :return: smoothed y
+    """
+    if method == 'legacy':
+        return _smooth_bruckner_legacy(x, y_obs, n_smooth, n_iter)
+    n = n_smooth
+    n_data = y_obs.size
+    y = _pad_and_clip(y_obs, n)
+    # the legacy loop never touches the last 2n + 2 points, keep it that way
+    i_start = n
+    i_end = n_data - n - 2
+    if i_end <= i_start:
+        return y[n:n + n_data]
+    if method == 'running':
+        y = _smooth_running(y, n, n_iter, i_start, i_end)
+    elif method == 'vectorized':
+        y = _smooth_vectorized(y, n, n_iter, i_start, i_end)
     else:
-        return cheb_parameters
+        raise ValueError('Unknown smoothing method: ' + str(method))
+    return y[n:n + n_data]
+
+
+def _pad_and_clip(y_obs, n):
+    """
+    pad both ends by n points and clip values above the cutoff
+    """
+    n_data = y_obs.size
+    y = np.empty(n_data + n + n)
+    y[n:n + n_data] = y_obs
+    y[0:n].fill(y_obs[n])
+    y[n + n_data:n_data + n + n].fill(y_obs[-1])
+    y_avg = np.average(y)
+    y_min = np.min(y)
+    y_c = y_avg + 2. * (y_avg - y_min)
+    np.minimum(y, y_c, out=y)
+    return y
+
+
+def _smooth_running(y, n, n_iter, i_start, i_end):
+    """
+    In-place sweep as in the legacy code: points on the left of the window
+    are already updated in the same pass.  The window sum is updated with
+    scalar operations instead of averaging a new slice for every point.
+    """
+    w = 2 * n + 1
+    yl = y.tolist()
+    for j in range(n_iter):
+        s = sum(yl[i_start - n:i_start + n + 1])
+        for i, i_add, i_sub in zip(range(i_start, i_end),
+                                   range(i_start + n + 1, i_end + n + 1),
+                                   range(i_start - n, i_end - n)):
+            avg = s / w
+            old = yl[i]
+            if avg < old:
+                yl[i] = avg
+                s += avg - old + yl[i_add] - yl[i_sub]
+            else:
+                s += yl[i_add] - yl[i_sub]
+    return np.asarray(yl)
+
+
+def _smooth_vectorized(y, n, n_iter, i_start, i_end):
+    """
+    Each pass averages with the values from the previous pass, so the whole
+    pass is a single cumsum moving average.
+    """
+    w = 2 * n + 1
+    c = np.empty(y.size + 1)
+    c[0] = 0.
+    for j in range(n_iter):
+        np.cumsum(y, out=c[1:])
+        # avg[k] is the average of the window centered at k + n
+        avg = (c[w:] - c[:-w]) / w
+        np.minimum(y[i_start:i_end], avg[i_start - n:i_end - n],
+                   out=y[i_start:i_end])
+    return y
 
 
-def smooth_bruckner(x, y_obs, n_smooth, n_iter):
+def _smooth_bruckner_legacy(x, y_obs, n_smooth, n_iter):
     y_original = y_obs
 
     n_data = y_obs.size
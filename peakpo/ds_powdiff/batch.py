@@ -0,0 +1,152 @@
+import os
+import copy
+import time
+import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+import numpy as np
+from .background import smooth_bruckner, fit_cheb, get_grid_key, \
+    get_bg_engine
+from .bgcache import get_bg_cache_dir
+
+
+def _smooth_bg_worker(args):
+    """
+    top level function so that it can be sent to a process pool.
+    For cheb only the smoothing is done here, the Chebyshev fit is
+    done for all patterns at once.  Other engines return the background.
+    """
+    x, y, params, engine = args
+    if engine == 'cheb':
+        return smooth_bruckner(x, y, params[0], params[1])
+    return get_bg_engine(engine).fit(x, y, params)
+
+
+def fit_cheb_by_grid(xs, ys, n_cheborder):
+    """
+    Chebyshev fit of many patterns, one matrix multiply for all patterns
+    on the same x
+
+    :return: list of fitted y
+    """
+    groups = OrderedDict()
+    for i, x in enumerate(xs):
+        groups.setdefault(get_grid_key(x), []).append(i)
+    y_fits = [None] * xs.__len__()
+    for i_group in groups.values():
+        stack = fit_cheb(xs[i_group[0]],
+                         np.vstack([ys[i] for i in i_group]), n_cheborder)
+        for i, y_fit in zip(i_group, stack):
+            y_fits[i] = y_fit
+    return y_fits
+
+
+def subtract_bg_batch(patterns, roi, params, temp_dir=None, force=False,
+                      max_workers=None, cache=None, engine='cheb'):
+    """
+    Fit and subtract background for many patterns at once.
+
+    :param patterns: list of Pattern objects with raw data loaded
+    :param roi: background roi, [min, max]
+    :param params: background parameters for the engine, such as
+        [n_points, n_iter, cheb order] for cheb
+    :param temp_dir: if given, temporary bg and bgsub files are written here
+    :param force: refit even if roi and params have not changed
+    :param max_workers: number of processes, None for number of cpus
+    :param cache: BackgroundCache to look up before fitting.  Disk part of
+        the cache is used only with temp_dir
+    :param engine: background engine, see BG_ENGINES
+    :return: number of patterns refitted
+    """
+    fits = fit_bg_batch(patterns, roi, params, force=force,
+                        max_workers=max_workers, cache=cache,
+                        cache_on_disk=(temp_dir is not None), engine=engine)
+    for ptn, x, y, y_bg in fits:
+        ptn.set_bg_from_fit(x, y, y_bg, roi, params=list(params),
+                            engine=engine)
+    if temp_dir is not None:
+        write_bg_batch(fits, roi, params, temp_dir, max_workers=max_workers,
+                       engine=engine)
+    return fits.__len__()
+
+
+def fit_bg_batch(patterns, roi, params, force=False, max_workers=None,
+                 cache=None, cache_on_disk=False, engine='cheb'):
+    """
+    Fit background for many patterns at once without changing them, so
+    that it can be done in a worker thread.  See subtract_bg_batch for
+    the arguments.
+
+    :param cache_on_disk: use the disk part of the cache
+    :return: list of pattern, x and raw y of the roi, and background, for
+        Pattern.set_bg_from_fit.  Patterns already fitted with the same
+        roi, params and engine are left out, unless force.
+    """
+    t_start = time.time()
+    if force:
+        to_fit = list(patterns)
+    else:
+        to_fit = [ptn for ptn in patterns
+                  if not ptn.bg_is_current(roi, params, engine)]
+    if to_fit == []:
+        return []
+    sections = [ptn._get_section(ptn.x_raw, ptn.y_raw, roi) for ptn in to_fit]
+    y_bgs = [None] * len(to_fit)
+    if cache is not None:
+        keys = [ptn.make_bg_key(roi, params, engine) for ptn in to_fit]
+        cache_dirs = [get_bg_cache_dir(ptn.fname) if cache_on_disk else None
+                      for ptn in to_fit]
+        for i, (key, cache_dir) in enumerate(zip(keys, cache_dirs)):
+            y_bg = cache.get(key, cache_dir=cache_dir)
+            if (y_bg is not None) and (y_bg.size == sections[i][0].size):
+                y_bgs[i] = y_bg
+    i_jobs = [i for i, y_bg in enumerate(y_bgs) if y_bg is None]
+    jobs = [(sections[i][0], sections[i][1], params, engine) for i in i_jobs]
+    y_smooths = None
+    if len(jobs) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                y_smooths = list(executor.map(_smooth_bg_worker, jobs))
+        except (BrokenProcessPool, OSError) as inst:
+            print(str(datetime.datetime.now())[:-7],
+                  ": Process pool failed, fit one by one: ", inst)
+    if y_smooths is None:
+        y_smooths = [_smooth_bg_worker(job) for job in jobs]
+    if engine == 'cheb':
+        # smoothing is for each pattern, Chebyshev fit for all at once
+        y_fits = fit_cheb_by_grid([job[0] for job in jobs], y_smooths,
+                                  params[2])
+    else:
+        y_fits = y_smooths
+    for i, y_bg in zip(i_jobs, y_fits):
+        y_bgs[i] = y_bg
+        if cache is not None:
+            cache.put(keys[i], y_bg, cache_dir=cache_dirs[i])
+    print(str(datetime.datetime.now())[:-7],
+          ": Bgsub for {0:d} of {1:d} patterns ({2:d} fitted) "
+          "takes {3:.2f}s".format(len(to_fit), len(patterns), len(jobs),
+                                  time.time() - t_start))
+    return [(ptn, x, y, y_bg)
+            for ptn, (x, y), y_bg in zip(to_fit, sections, y_bgs)]
+
+
+def write_bg_batch(fits, roi, params, temp_dir, max_workers=None,
+                   engine='cheb'):
+    """
+    write temporary bg and bgsub files for fits from fit_bg_batch.  Files
+    are written from copies of the patterns, which are not changed.
+    """
+    if fits == []:
+        return
+    fitted = []
+    for ptn, x, y, y_bg in fits:
+        ptn_copy = copy.copy(ptn)
+        ptn_copy.set_bg_from_fit(x, y, y_bg, roi, params=list(params),
+                                 engine=engine)
+        fitted.append(ptn_copy)
+    os.makedirs(temp_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # list() to raise any error from writing here
+        list(executor.map(
+            lambda ptn: ptn.write_temporary_bgfiles(temp_dir), fitted))
@@ -0,0 +1,96 @@
+import os
+import hashlib
+import numpy as np
+from utils import MemoryLRU, write_replace, touch_cache_file, \
+    evict_cache_files
+
+# bump this when the background algorithm changes so old entries are not used
+BG_CACHE_VERSION = 1
+
+
+def make_bg_key(x, y, roi, params, engine='cheb'):
+    """
+    make a content address for a background fit
+
+    :param x: raw x
+    :param y: raw y
+    :param roi: background roi, [min, max]
+    :param params: background parameters
+    :param engine: background engine, see BG_ENGINES
+    :return: hex digest string
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+    # roi is saved with 5 decimals in temp files, so keys should agree
+    # with the values read back from there
+    text = '{0:.5f},{1:.5f};{2};{3:d}'.format(
+        float(roi[0]), float(roi[1]), ','.join(str(p) for p in params),
+        BG_CACHE_VERSION)
+    # keys of cheb stay the same as before other engines were added
+    if engine != 'cheb':
+        text += ';' + engine
+    h.update(text.encode())
+    return h.hexdigest()
+
+
+def get_bg_cache_dir(filename):
+    """
+    disk cache is shared by all patterns in the same directory
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), 'bgcache')
+
+
+class BackgroundCache(object):
+    """
+    LRU cache of fitted backgrounds keyed by make_bg_key.
+    Entries are kept in memory up to max_bytes and, if cache_dir is given,
+    in <cache_dir>/<key>.bg.npy up to max_disk_bytes for each directory.
+    As the key includes the raw data, a hit is never stale.
+    """
+
+    def __init__(self, max_bytes=128 * 2 ** 20, max_disk_bytes=256 * 2 ** 20):
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = MemoryLRU(max_bytes)
+
+    def __len__(self):
+        return self._memory.__len__()
+
+    def clear(self):
+        self._memory.clear()
+
+    def get(self, key, cache_dir=None):
+        """
+        :return: y_bg or None
+        """
+        y_bg = self._memory.get(key)
+        if (y_bg is not None) or (cache_dir is None):
+            return y_bg
+        filen = self._make_filename(key, cache_dir)
+        if not os.path.exists(filen):
+            return None
+        try:
+            y_bg = np.load(filen)
+        except (OSError, ValueError):
+            return None
+        touch_cache_file(filen)
+        self._memory.put(key, y_bg)
+        return y_bg
+
+    def put(self, key, y_bg, cache_dir=None):
+        self._memory.put(key, y_bg)
+        if cache_dir is None:
+            return
+        # may be called from several threads at the same time
+        os.makedirs(cache_dir, exist_ok=True)
+        with write_replace(self._make_filename(key, cache_dir)) as f:
+            np.save(f, y_bg)
+        evict_cache_files(os.path.join(cache_dir, '*.bg.npy'),
+                          self.max_disk_bytes)
+
+    def _make_filename(self, key, cache_dir):
+        return os.path.join(cache_dir, key + '.bg.npy')
+
+
+# shared by base pattern and waterfall patterns
+bg_cache = BackgroundCache()
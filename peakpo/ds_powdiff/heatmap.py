@@ -0,0 +1,198 @@
+import numpy as np
+
+# columns of the coarsest level of a heat map
+_MIN_COLUMNS = 64
+# values used for the color scale
+_N_CLIM_SAMPLES = 10 ** 6
+
+# last heat map, as [key, heat_map]
+_heat_map = [None, None]
+
+
+def _make_key(stack, rows, positions, wavelength, normalize):
+    return (stack, tuple(rows), tuple(positions), wavelength, normalize)
+
+
+def _same_key(key, old_key):
+    return (old_key is not None) and (key[0] is old_key[0]) and \
+        (key[1:] == old_key[1:])
+
+
+def get_heat_map(stack, rows, positions, wavelength=None, normalize=False):
+    """
+    heat map of rows of a stack, made again only when the stack or any of
+    the arguments have changed.  See HeatMap for the arguments.
+    """
+    key = _make_key(stack, rows, positions, wavelength, normalize)
+    if not _same_key(key, _heat_map[0]):
+        _heat_map[1] = HeatMap(stack, rows, positions,
+                               wavelength=wavelength, normalize=normalize)
+        _heat_map[0] = key
+    return _heat_map[1]
+
+
+def _pool_columns(z):
+    """
+    :return: z with half the columns, maximum of each pair
+    """
+    if z.shape[1] % 2 == 1:
+        z = np.column_stack((z, np.full(z.shape[0], np.nan, dtype=z.dtype)))
+    with np.errstate(invalid='ignore'):
+        return np.fmax(z[:, 0::2], z[:, 1::2])
+
+
+def _make_edges(y):
+    """
+    :return: boundaries between sorted positions, half way to the
+        neighbours, so that each row covers the positions closest to it
+    """
+    if y.size == 1:
+        return np.array([y[0] - 0.5, y[0] + 0.5])
+    mid = (y[1:] + y[:-1]) / 2.
+    first = y[0] - (mid[0] - y[0])
+    last = y[-1] + (y[-1] - mid[-1])
+    if first == y[0]:
+        first -= 0.5
+    if last == y[-1]:
+        last += 0.5
+    return np.concatenate(([first], mid, [last]))
+
+
+class HeatMap(object):
+    """
+    Rows of a PatternStack as an image of intensity against two theta and
+    a position, such as file index or pressure, for series too long to
+    be plotted as lines.  Columns are kept at several resolutions, each
+    with the maximum of two columns of the one before, so that narrow
+    peaks stay in the image when it is zoomed out.  get_image returns
+    only the part in view at about the resolution of the screen, so that
+    the image drawn is small for any number of rows.  The two theta grid
+    of the stack is taken as evenly spaced.
+    """
+
+    def __init__(self, stack, rows, positions, wavelength=None,
+                 normalize=False):
+        """
+        :param stack: PatternStack
+        :param rows: indices of rows of the stack in the image
+        :param positions: vertical position of each row.  Rows at the
+            same position are shown as their maximum.
+        :param wavelength: to convert two theta of all rows to, None to
+            keep the original ones
+        :param normalize: scale each row to its maximum
+        """
+        rows = np.asarray(rows, dtype=int)
+        positions = np.asarray(positions, dtype=float)
+        order = np.argsort(positions, kind='stable')
+        rows = rows[order]
+        self.y = positions[order]
+        self.x = np.asarray(stack.x, dtype=float)
+        z = np.array(stack.y[rows], dtype=np.float32)
+        if wavelength is not None:
+            for j, i in enumerate(rows):
+                if stack.wavelengths[i] == wavelength:
+                    continue
+                x, y = stack.get_row(i, wavelength)
+                z[j] = np.interp(self.x, x, y, left=np.nan, right=np.nan)
+        if normalize:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                z /= np.nanmax(z, axis=1)[:, None]
+        self._edges = _make_edges(self.y)
+        if self.x.size > 1:
+            self._dx = (self.x[-1] - self.x[0]) / (self.x.size - 1)
+        else:
+            self._dx = 1.
+        self._levels = [z]
+        while self._levels[-1].shape[1] > _MIN_COLUMNS:
+            self._levels.append(_pool_columns(self._levels[-1]))
+        self.clim = self._make_clim()
+
+    def __len__(self):
+        return self.y.size
+
+    def _make_clim(self):
+        """
+        :return: color limits from percentiles of intensity, the same at
+            any zoom so that colors do not change
+        """
+        for z in self._levels:
+            if z.size <= _N_CLIM_SAMPLES:
+                break
+        if not np.isfinite(z).any():
+            return 0., 1.
+        vmin, vmax = np.nanpercentile(z, [1., 99.5])
+        if vmax <= vmin:
+            vmax = vmin + 1.
+        return float(vmin), float(vmax)
+
+    def get_extent(self):
+        """
+        :return: extent of the whole image, as for imshow
+        """
+        return [self.x[0] - self._dx / 2., self.x[-1] + self._dx / 2.,
+                self._edges[0], self._edges[-1]]
+
+    def get_image(self, x_lim, y_lim, width=None, height=None):
+        """
+        :param x_lim: two theta range in view
+        :param y_lim: range of positions in view
+        :param width: size of the view in pixels, None for the full
+            resolution of the data
+        :param height: size of the view in pixels, None for the full
+            resolution of the data
+        :return: image and extent for imshow with origin lower, None if
+            nothing is in view
+        """
+        x_min, x_max = sorted(x_lim)
+        y_min, y_max = sorted(y_lim)
+        y_min = max(y_min, self._edges[0])
+        y_max = min(y_max, self._edges[-1])
+        x0 = self.x[0] - self._dx / 2.
+        c_min = (x_min - x0) / self._dx
+        c_max = (x_max - x0) / self._dx
+        if (y_max <= y_min) or (c_max <= 0) or (c_min >= self.x.size):
+            return None
+        # a level with about one column for each pixel
+        level = 0
+        if width is not None:
+            n_columns = min(c_max, self.x.size) - max(c_min, 0)
+            while (level < self._levels.__len__() - 1) and \
+                    (n_columns / 2 ** (level + 1) >= width):
+                level += 1
+        z = self._levels[level]
+        f = 2 ** level
+        i_min = max(int(np.floor(c_min / f)), 0)
+        i_max = min(int(np.ceil(c_max / f)), z.shape[1])
+        z = z[:, i_min:i_max]
+        # one image row for each pixel, made of the data rows in it or
+        # the nearest data row if there is none
+        if height is None:
+            n_rows = self._get_n_rows(y_min, y_max)
+        else:
+            n_rows = max(int(height), 1)
+        bounds = np.linspace(y_min, y_max, n_rows + 1)
+        start = np.searchsorted(self.y, bounds[:-1], side='left')
+        end = np.searchsorted(self.y, bounds[1:], side='left')
+        end[-1] = np.searchsorted(self.y, bounds[-1], side='right')
+        filled = end > start
+        image = np.empty((n_rows, z.shape[1]), dtype=z.dtype)
+        if filled.any():
+            with np.errstate(invalid='ignore'):
+                image[filled] = np.fmax.reduceat(
+                    z[:end[filled][-1]], start[filled], axis=0)
+        if not filled.all():
+            mid = (bounds[:-1] + bounds[1:])[~filled] / 2.
+            nearest = np.searchsorted(self._edges, mid, side='right') - 1
+            image[~filled] = z[np.clip(nearest, 0, self.y.size - 1)]
+        extent = [x0 + i_min * f * self._dx, x0 + i_max * f * self._dx,
+                  y_min, y_max]
+        return image, extent
+
+    def _get_n_rows(self, y_min, y_max):
+        """
+        :return: rows to show every data row in the range, at most 8192
+        """
+        gaps = np.diff(self._edges)
+        gaps = gaps[gaps > 0]
+        n_rows = int(np.ceil((y_max - y_min) / gaps.min()))
+        return min(max(n_rows, 1), 8192)
@@ -0,0 +1,173 @@
+from collections import OrderedDict
+import numpy as np
+from ds_jcpds import convert_tth
+from .background import get_grid_key
+
+# last stack for each of bgsub and raw data
+_stacks = {}
+
+
+def _get_xy(pattern, bgsub):
+    # raw data for patterns without background subtraction
+    if bgsub and (pattern.x_bgsub is not None):
+        return pattern.x_bgsub, pattern.y_bgsub
+    return pattern.x_raw, pattern.y_raw
+
+
+def _make_key(patterns, bgsub):
+    """
+    arrays are compared by identity, fitting background or reading a file
+    always makes new arrays
+    """
+    return [(pattern,) + tuple(_get_xy(pattern, bgsub)) +
+            (pattern.wavelength,) for pattern in patterns]
+
+
+def _same_key(key, old_key):
+    if key.__len__() != old_key.__len__():
+        return False
+    for item, old_item in zip(key, old_key):
+        if any(a is not b for a, b in zip(item[:3], old_item[:3])) or \
+                (item[3] != old_item[3]):
+            return False
+    return True
+
+
+def get_pattern_stack(patterns, bgsub=True):
+    """
+    stack of the patterns, made again only when a pattern, its data or
+    its wavelength has changed
+
+    :param patterns: list of Pattern, such as model.waterfall_ptn
+    :param bgsub: stack background subtracted data instead of raw data
+    :return: PatternStack
+    """
+    key = _make_key(patterns, bgsub)
+    stack = _stacks.get(bgsub)
+    if (stack is None) or (not _same_key(key, stack.key)):
+        stack = PatternStack(patterns, bgsub=bgsub)
+        stack.key = key
+        _stacks[bgsub] = stack
+    return stack
+
+
+def _make_grid(xs):
+    """
+    :return: x shared by most of the patterns, so that only the others
+        are interpolated.  If no two patterns are on the same grid, the
+        whole range with the finest step.
+    """
+    counts = OrderedDict()
+    for i, x in enumerate(xs):
+        counts.setdefault(get_grid_key(x), []).append(i)
+    i_grid = max(counts.values(), key=len)
+    if (i_grid.__len__() > 1) or (xs.__len__() == 1):
+        return np.array(xs[i_grid[0]], dtype=float)
+    x_min = min(x[0] for x in xs)
+    x_max = max(x[-1] for x in xs)
+    step = min(np.median(np.diff(x)) for x in xs)
+    n = int(np.ceil((x_max - x_min) / step)) + 1
+    return x_min + np.arange(n) * step
+
+
+class PatternStack(object):
+    """
+    Series of patterns as rows of one array on a shared two theta grid.
+    Patterns on a different grid are interpolated to the shared one and
+    are nan outside of their own range, which is kept in bounds.  Rows,
+    maxima and axes converted to another wavelength are kept, so that
+    redraws do not compute them again.  Arrays are read-only, operations
+    return new arrays.
+    """
+
+    def __init__(self, patterns, bgsub=True):
+        """
+        :param patterns: list of Pattern with data
+        :param bgsub: stack background subtracted data instead of raw data
+        """
+        self.key = None
+        xys = [_get_xy(pattern, bgsub) for pattern in patterns]
+        self.wavelengths = np.array(
+            [pattern.wavelength for pattern in patterns], dtype=float)
+        if xys == []:
+            self.x = np.zeros(0)
+            self.y = np.zeros((0, 0))
+            self.bounds = np.zeros((0, 2), dtype=int)
+        else:
+            self.x = _make_grid([x for x, y in xys])
+            self.y = np.full((xys.__len__(), self.x.size), np.nan)
+            self.bounds = np.empty((xys.__len__(), 2), dtype=int)
+            for i, (x, y) in enumerate(xys):
+                if (x.size == self.x.size) and np.array_equal(x, self.x):
+                    self.y[i] = y
+                    self.bounds[i] = 0, self.x.size
+                    continue
+                start = np.searchsorted(self.x, x[0], side='left')
+                end = np.searchsorted(self.x, x[-1], side='right')
+                self.y[i, start:end] = np.interp(self.x[start:end], x, y)
+                self.bounds[i] = start, end
+        self.y_max = np.array([self.y[i, start:end].max()
+                               if end > start else np.nan
+                               for i, (start, end) in enumerate(self.bounds)])
+        for a in [self.x, self.y, self.bounds, self.y_max, self.wavelengths]:
+            a.setflags(write=False)
+        self._x_converted = {}
+
+    def __len__(self):
+        return self.y.shape[0]
+
+    def get_row(self, i, wavelength=None):
+        """
+        :param wavelength: to convert x to, None for the original one
+        :return: x and y of a pattern in its own range, views of the stack
+        """
+        start, end = self.bounds[i]
+        return self.get_x(wavelength)[i, start:end], self.y[i, start:end]
+
+    def get_x(self, wavelength=None):
+        """
+        :param wavelength: to convert x of each row to, None for the
+            original one
+        :return: read-only (n_patterns, n_points) array
+        """
+        if wavelength is None:
+            return np.broadcast_to(self.x, self.y.shape)
+        if wavelength not in self._x_converted:
+            x = np.empty(self.y.shape)
+            for wl in np.unique(self.wavelengths):
+                x[self.wavelengths == wl] = convert_tth(self.x, wl, wavelength)
+            x.setflags(write=False)
+            self._x_converted[wavelength] = x
+        return self._x_converted[wavelength]
+
+    def _select(self, a, rows):
+        return a if rows is None else a[rows]
+
+    def normalize(self, y_max=1., rows=None):
+        """
+        :param y_max: maximum of every row after scaling
+        :param rows: indices of rows, all if None
+        :return: rows scaled to the same maximum
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._select(self.y, rows) / \
+                self._select(self.y_max, rows)[:, None] * y_max
+
+    def offset(self, offsets, y=None, rows=None):
+        """
+        :param offsets: one value for each row
+        :param y: rows from normalize or subtract, stacked y if None
+        :return: rows shifted by offsets
+        """
+        if y is None:
+            y = self._select(self.y, rows)
+        return y + np.asarray(offsets, dtype=float)[:, None]
+
+    def subtract(self, x_ref, y_ref, rows=None):
+        """
+        :param x_ref: x of a reference pattern, such as the base pattern
+        :param y_ref: y of the reference pattern
+        :return: rows minus the reference, nan out of its range
+        """
+        y_ref = np.interp(self.x, x_ref, y_ref, left=np.nan, right=np.nan)
+        return self._select(self.y, rows) - y_ref
@@ -0,0 +1,98 @@
+import os
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import get_directory
+from .DiffractionPattern import PatternPeakPo
+from .bgcache import bg_cache, get_bg_cache_dir
+
+
+def _get_file_stamp(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _load_pattern(filename, roi, params, use_temp, engine='cheb'):
+    """
+    read a pattern and get its background the same way as the base
+    pattern is processed, so that the later load finds everything cached.
+    """
+    stamp = _get_file_stamp(filename)
+    ptn = PatternPeakPo()
+    ptn.read_file(filename, sidecar=use_temp)
+    temp_dir = get_directory(filename, '-param')
+    if use_temp:
+        # this also makes the sidecars of the temp files
+        if os.path.exists(temp_dir) and \
+                ptn.temp_files_exist(temp_dir=temp_dir) and \
+                ptn.read_bg_from_tempfile(temp_dir=temp_dir):
+            return ptn, stamp
+        cache_dir = get_bg_cache_dir(filename)
+    else:
+        cache_dir = None
+    ptn.get_chbg(roi, params=params, yshift=0, cache=bg_cache,
+                 cache_dir=cache_dir, engine=engine)
+    # base pattern always writes temp files, do it here already
+    if not ptn.temp_files_current(temp_dir):
+        ptn.write_temporary_bgfiles(temp_dir)
+    return ptn, stamp
+
+
+class PatternPrefetcher(object):
+    """
+    Load neighboring patterns in worker threads while the user looks at
+    the current one.  Raw data go to take() and background fits go to
+    bg_cache and the sidecar files.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, filenames, roi, params, use_temp=False,
+                 engine='cheb'):
+        """
+        :param filenames: files to load, the nearest first
+        :param roi: background roi
+        :param params: background parameters
+        :param engine: background engine
+        :param use_temp: use temp files and sidecars as in the base pattern
+        """
+        with self._lock:
+            # forget files that are no longer neighbors
+            for filename in list(self._futures.keys()):
+                if filename not in filenames:
+                    self._futures.pop(filename).cancel()
+            for filename in filenames:
+                if filename in self._futures:
+                    continue
+                self._futures[filename] = self._executor.submit(
+                    _load_pattern, filename, list(roi), list(params),
+                    use_temp, engine)
+
+    def take(self, filename):
+        """
+        :return: prefetched pattern with raw data, or None if it is not
+            available or the file has changed since
+        """
+        with self._lock:
+            future = self._futures.pop(filename, None)
+        if (future is None) or future.cancel():
+            return None
+        try:
+            # already running, waiting is faster than starting again
+            ptn, stamp = future.result()
+            if stamp != _get_file_stamp(filename):
+                return None
+        except Exception as inst:
+            print(str(datetime.datetime.now())[:-7],
+                  ": Prefetch failed for ", filename, inst)
+            return None
+        return ptn
+
+    def clear(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
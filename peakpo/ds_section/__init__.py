@@ -1 +1,2 @@
-from .section import Section
+from .section import Section, FIT_ENGINES
+from .fitresult import FitResult
@@ -0,0 +1,91 @@
+"""
+Compact record of a fit result, kept in sections instead of the lmfit
+ModelResult.  Holds only numbers and arrays, so sections are cheap to
+copy and to save in DPP files.
+"""
+from collections import OrderedDict, namedtuple
+import numpy as np
+from .pvoigtfit import PVoigtModel
+
+ParamRecord = namedtuple('ParamRecord',
+                         ['name', 'value', 'stderr', 'vary', 'min', 'max',
+                          'expr'])
+
+
+def _read_only(a):
+    a = np.array(a, dtype=float)
+    a.setflags(write=False)
+    return a
+
+
+class FitResult(object):
+    """
+    same attributes as lmfit ModelResult which PeakPo uses: params[name]
+    with value, stderr and vary, best_fit, chisqr, redchi, aic, bic and
+    eval_components.  Made once after fitting and not changed after.
+    """
+    __slots__ = ('params', 'var_names', 'covar', 'x', 'best_fit',
+                 'chisqr', 'redchi', 'aic', 'bic', 'ndata', 'nvarys',
+                 'nfev', 'success', 'message')
+
+    def __init__(self, out):
+        """
+        :param out: lmfit ModelResult or PVoigtFitResult
+        """
+        params = OrderedDict()
+        for name, par in out.params.items():
+            params[name] = ParamRecord(
+                name, float(par.value),
+                None if par.stderr is None else float(par.stderr),
+                bool(par.vary), float(par.min), float(par.max), par.expr)
+        self._set('params', params)
+        self._set('var_names', list(out.var_names))
+        covar = getattr(out, 'covar', None)
+        self._set('covar', None if covar is None else _read_only(covar))
+        self._set('x', _read_only(out.userkws['x']))
+        self._set('best_fit', _read_only(out.best_fit))
+        for key in ['chisqr', 'redchi', 'aic', 'bic']:
+            self._set(key, float(getattr(out, key)))
+        for key in ['ndata', 'nvarys', 'nfev']:
+            self._set(key, int(getattr(out, key)))
+        self._set('success', bool(out.success))
+        self._set('message', str(out.message))
+
+    def _set(self, key, value):
+        object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('FitResult cannot be changed')
+
+    def __deepcopy__(self, memo):
+        # nothing in it changes
+        return self
+
+    def __copy__(self):
+        return self
+
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __setstate__(self, state):
+        for key in self.__slots__:
+            value = state.get(key)
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+            self._set(key, value)
+
+    def eval_components(self, x=None):
+        """
+        same functions as the lmfit models, evaluated from the parameters
+
+        :return: dict of baseline and peaks keyed by prefix, as lmfit
+        """
+        if x is None:
+            x = self.x
+        poly_order = [name for name in self.params
+                      if name.startswith('b_c')].__len__() - 1
+        n_peaks = [name for name in self.params
+                   if name.endswith('_center')].__len__()
+        model = PVoigtModel(poly_order, n_peaks)
+        values = np.array([self.params[name].value for name in model.names])
+        return model.eval_components(values, np.asarray(x, dtype=float))
@@ -0,0 +1,236 @@
+"""
+Fitting of a polynomial baseline and pseudo-Voigt peaks in one NumPy
+kernel with an analytic Jacobian.  Same functions, parameter names and
+bounds as the lmfit models made in Section.prepare_for_fitting, so the
+result can be used in place of an lmfit ModelResult.
+"""
+from collections import OrderedDict
+import numpy as np
+from scipy.optimize import least_squares
+
+_TINY = 1.e-15
+_K_GAUSS = np.sqrt(2. * np.log(2.))
+_PEAK_PARAMS = ['amplitude', 'center', 'sigma', 'fraction']
+
+
+class FitStopped(Exception):
+    pass
+
+
+def get_pvoigt_profiles(x, amplitude, center, sigma, fraction):
+    """
+    pseudo-Voigt of lmfit: Gaussian and Lorentzian with the same FWHM,
+    2 * sigma
+
+    :param amplitude, center, sigma, fraction: arrays, one per peak
+    :return: (n_peaks, n_x) array of profiles and tuple of the parts for
+        the Jacobian
+    """
+    u = x[np.newaxis, :] - center[:, np.newaxis]
+    s = np.maximum(sigma, _TINY)[:, np.newaxis]
+    s_g = s / _K_GAUSS
+    u2 = u * u
+    g1 = np.exp(-u2 / (2. * s_g * s_g)) / (np.sqrt(2. * np.pi) * s_g)
+    l1 = s / (np.pi * (u2 + s * s))
+    a = amplitude[:, np.newaxis]
+    eta = fraction[:, np.newaxis]
+    profiles = a * ((1. - eta) * g1 + eta * l1)
+    return profiles, (u, u2, s, s_g, g1, l1, a, eta)
+
+
+def get_pvoigt_jacobian(parts):
+    """
+    :return: derivatives of the profiles by amplitude, center, sigma and
+        fraction, each (n_peaks, n_x)
+    """
+    u, u2, s, s_g, g1, l1, a, eta = parts
+    d_amplitude = (1. - eta) * g1 + eta * l1
+    d_center = a * ((1. - eta) * g1 * u / (s_g * s_g) +
+                    eta * l1 * 2. * u / (u2 + s * s))
+    d_sigma = a * ((1. - eta) * g1 * (u2 / (s_g * s_g) - 1.) / s +
+                   eta * (u2 - s * s) / (np.pi * (u2 + s * s) ** 2))
+    d_fraction = a * (l1 - g1)
+    return d_amplitude, d_center, d_sigma, d_fraction
+
+
+class PVoigtModel(object):
+    """
+    polynomial baseline with prefix b_ and pseudo-Voigt peaks with
+    prefixes p0_, p1_, ..., in the order of Section.prepare_for_fitting
+    """
+
+    def __init__(self, poly_order, n_peaks):
+        self.poly_order = poly_order
+        self.n_peaks = n_peaks
+        self.names = ['b_c{0:d}'.format(i) for i in range(poly_order + 1)]
+        for i in range(n_peaks):
+            self.names += ['p{0:d}_{1:s}'.format(i, p) for p in _PEAK_PARAMS]
+
+    def _split(self, values):
+        n_b = self.poly_order + 1
+        return values[:n_b], values[n_b:].reshape(self.n_peaks, 4).T
+
+    def eval_components(self, values, x):
+        baseline, (amplitude, center, sigma, fraction) = self._split(values)
+        components = OrderedDict()
+        components['b_'] = np.polynomial.polynomial.polyval(x, baseline) * \
+            np.ones_like(x)
+        if self.n_peaks > 0:
+            profiles, __ = get_pvoigt_profiles(x, amplitude, center, sigma,
+                                               fraction)
+            for i in range(self.n_peaks):
+                components['p{0:d}_'.format(i)] = profiles[i]
+        return components
+
+    def eval(self, values, x):
+        return self.eval_and_jacobian(values, x, jacobian=False)[0]
+
+    def eval_and_jacobian(self, values, x, jacobian=True):
+        """
+        :return: model and (n_x, n_params) Jacobian, None if not asked
+        """
+        baseline, (amplitude, center, sigma, fraction) = self._split(values)
+        powers = x[:, np.newaxis] ** np.arange(self.poly_order + 1)
+        y = powers.dot(baseline)
+        if self.n_peaks == 0:
+            return y, (powers if jacobian else None)
+        profiles, parts = get_pvoigt_profiles(x, amplitude, center, sigma,
+                                              fraction)
+        y = y + profiles.sum(axis=0)
+        if not jacobian:
+            return y, None
+        # columns in the order of names: amplitude, center, sigma,
+        # fraction for each peak
+        d_peaks = np.stack(get_pvoigt_jacobian(parts), axis=1)
+        return y, np.hstack((powers, d_peaks.reshape(-1, x.size).T))
+
+
+class PVoigtFitResult(object):
+    """
+    the parts of lmfit ModelResult which PeakPo uses
+    """
+
+    def __init__(self, model, params, x, data, success=True, message='',
+                 nfev=0):
+        self.model = model
+        self.params = params
+        self.x = x
+        self.userkws = {'x': x}
+        self.data = data
+        self.var_names = []
+        self.covar = None
+        values = np.array([params[name].value for name in model.names])
+        self.best_fit = model.eval(values, x)
+        self.residual = self.best_fit - data
+        self.ndata = data.size
+        self.nvarys = [p for p in params.values() if p.vary].__len__()
+        self.nfree = self.ndata - self.nvarys
+        self.chisqr = float((self.residual ** 2).sum())
+        self.redchi = self.chisqr / max(1, self.nfree)
+        _neg2_log_likel = self.ndata * np.log(
+            max(self.chisqr, _TINY) / self.ndata)
+        self.aic = _neg2_log_likel + 2. * self.nvarys
+        self.bic = _neg2_log_likel + np.log(self.ndata) * self.nvarys
+        self.success = success
+        self.aborted = not success
+        self.message = message
+        self.nfev = nfev
+
+    def _get_values(self):
+        return np.array([self.params[name].value
+                         for name in self.model.names])
+
+    def eval(self, x=None):
+        if x is None:
+            x = self.x
+        return self.model.eval(self._get_values(), x)
+
+    def eval_components(self, x=None):
+        """
+        :return: dict of baseline and peaks keyed by prefix, as lmfit
+        """
+        if x is None:
+            x = self.x
+        return self.model.eval_components(self._get_values(), x)
+
+
+def fit_pvoigt(x, data, params, poly_order, n_peaks, iter_cb=None,
+               max_nfev=None):
+    """
+    :param params: lmfit Parameters from Section.prepare_for_fitting, for
+        initial values, bounds and vary.  Not changed.
+    :param iter_cb: called as lmfit does, iter_cb(params, iteration,
+        residual).  Fitting stops if it returns True.
+    :return: PVoigtFitResult with a copy of params at the solution
+    """
+    model = PVoigtModel(poly_order, n_peaks)
+    x = np.asarray(x, dtype=float)
+    data = np.asarray(data, dtype=float)
+    params = params.copy()
+    values = np.array([params[name].value for name in model.names],
+                      dtype=float)
+    lower = np.array([params[name].min for name in model.names])
+    upper = np.array([params[name].max for name in model.names])
+    free = np.array([params[name].vary and (lower[i] < upper[i])
+                     for i, name in enumerate(model.names)])
+    # start inside bounds, as lmfit does
+    values = np.clip(values, lower, upper)
+    n_calls = [0]
+
+    def _values(v_free):
+        v = values.copy()
+        v[free] = v_free
+        return v
+
+    def residual(v_free):
+        n_calls[0] += 1
+        y = model.eval(_values(v_free), x) - data
+        if iter_cb is not None:
+            for name, v in zip(model.names, _values(v_free)):
+                params[name].value = v
+            if iter_cb(params, n_calls[0], y):
+                raise FitStopped()
+        return y
+
+    def jacobian(v_free):
+        return model.eval_and_jacobian(_values(v_free), x)[1][:, free]
+
+    success = True
+    message = 'Fit succeeded.'
+    nfev = 0
+    if free.any():
+        try:
+            out = least_squares(
+                residual, values[free], jac=jacobian,
+                bounds=(lower[free], upper[free]), method='trf',
+                x_scale='jac', max_nfev=max_nfev)
+            values[free] = out.x
+            nfev = out.nfev
+            message = out.message
+            success = out.status > 0
+            jac = out.jac
+        except FitStopped:
+            success = False
+            message = 'Fit stopped.'
+            jac = None
+    for name, v in zip(model.names, values):
+        params[name].value = v
+        params[name].stderr = None
+        params[name].correl = None
+    # fwhm and height of the peaks follow by expressions
+    params.update_constraints()
+    result = PVoigtFitResult(model, params, x, data, success=success,
+                             message=message, nfev=nfev)
+    result.var_names = list(np.array(model.names)[free])
+    if success and free.any() and (result.nfree > 0):
+        # covariance scaled by reduced chi-square, as lmfit
+        try:
+            covar = np.linalg.inv(jac.T.dot(jac)) * result.redchi
+        except np.linalg.LinAlgError:
+            covar = None
+        if covar is not None:
+            result.covar = covar
+            stderr = np.sqrt(np.abs(np.diag(covar)))
+            for name, err in zip(np.array(model.names)[free], stderr):
+                params[name].stderr = float(err)
+    return result
@@ -2,9 +2,18 @@ import numpy as np
 import datetime
 import copy
 from lmfit.models import PolynomialModel, PseudoVoigtModel
+from .pvoigtfit import fit_pvoigt
+from .fitresult import FitResult
+
+# lmfit: composite lmfit model, numerical Jacobian
+# pvoigt: all peaks in one NumPy kernel with analytic Jacobian
+FIT_ENGINES = ['lmfit', 'pvoigt']
 
 
 class Section(object):
+    # class attribute, so that sections from old dpp files have it
+    fit_engine = 'lmfit'
+
     def __init__(self):
         self.x = None
         self.y_bgsub = None
@@ -12,6 +21,7 @@ class Section(object):
         self.timestamp = None
         self.baseline_in_queue = []  # list of dict, value, constraints
         self.parameters = None
+        self.fit_model = None
         self.fit_result = None
         self.peaks_in_queue = []  # list of dic, value, constraints
         self.peakinfo = {}
@@ -155,10 +165,47 @@ class Section(object):
         self.peakinfo = peakinfo
         self.fit_model = mod
 
-    def conduct_fitting(self):
-        out = self.fit_model.fit(
-            self.y_bgsub, self.parameters, x=self.x)
-        self.fit_result = copy.deepcopy(out)
+    def set_fit_engine(self, fit_engine):
+        """
+        :param fit_engine: one of FIT_ENGINES
+        """
+        if fit_engine not in FIT_ENGINES:
+            raise ValueError('Unknown fit engine: ' + str(fit_engine))
+        self.fit_engine = fit_engine
+
+    def conduct_fitting(self, iter_cb=None):
+        """
+        :param iter_cb: called by lmfit at every iteration, stops the fit
+            if it returns True
+        :return: True if fitting finished
+        """
+        # lmfit sets aborted also for other reasons, so stops asked by
+        # iter_cb are recorded here
+        stopped = []
+
+        def _iter_cb(*args, **kws):
+            if iter_cb(*args, **kws):
+                stopped.append(True)
+                return True
+            return False
+
+        if self.fit_engine == 'pvoigt':
+            out = fit_pvoigt(
+                self.x, self.y_bgsub, self.parameters,
+                self.get_order_of_baseline_in_queue(),
+                self.get_number_of_peaks_in_queue(),
+                iter_cb=None if iter_cb is None else _iter_cb)
+        else:
+            out = self.fit_model.fit(
+                self.y_bgsub, self.parameters, x=self.x,
+                iter_cb=None if iter_cb is None else _iter_cb)
+        if stopped != []:
+            return False
+        self.fit_result = FitResult(out)
+        # lmfit model and parameters are made again by prepare_for_fitting,
+        # not kept so that copying and saving the section is cheap
+        self.parameters = None
+        self.fit_model = None
         self.timestamp = str(datetime.datetime.now())[:-7]
         self.copy_fit_result_to_queue()
         if self.fit_result is None:
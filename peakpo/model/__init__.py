@@ -1 +1,5 @@
 from .model import PeakPoModel
+from .propagate import propagate_sections, make_chains, \
+    DEFAULT_PROPAGATE_SETTINGS
+from .dppfile import dump_dpp, load_dpp, is_dpp_v2, read_dpp_manifest, \
+    read_saved_pressure, DPP_FILE_VERSION
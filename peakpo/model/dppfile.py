@@ -0,0 +1,400 @@
+"""
+DPP version 2: a zip file, or a directory for PeakPoDirModel, with
+
+    manifest.json       the model, with arrays replaced by blob names
+    arrays/<n>.npy      arrays in NumPy format, stored without compression
+
+Arrays are written one by one as the model is walked, and are memory
+mapped when read, so that large arrays such as the image and cake come
+from the disk only when they are used.  Only PeakPo classes listed in
+_CLASSES are saved, each as the class name and its attributes, so the
+file does not depend on the versions of Python or dill.  Older DPP
+files are dill pickles and are still read.
+"""
+import os
+import json
+import shutil
+import struct
+import zipfile
+import datetime
+import threading
+from collections import OrderedDict
+import numpy as np
+import dill
+import pyFAI
+from pyFAI.geometry import Geometry
+from ds_cake import DiffImg
+from ds_jcpds import JCPDSplt, JCPDS, UnitCell, DiffractionLine, Session
+from ds_powdiff import PatternPeakPo
+from ds_powdiff.DiffractionPattern import Pattern, AziPatternPeakPo
+from ds_section import Section, FitResult
+from ds_section.fitresult import ParamRecord
+from .model import PeakPoModel
+
+DPP_FILE_VERSION = 2
+DPP_FORMAT = 'PeakPo DPP'
+_MANIFEST = 'manifest.json'
+_ZIP_MAGIC = b'PK\x03\x04'
+_CLASSES = {cls.__name__: cls for cls in [
+    PeakPoModel, Pattern, PatternPeakPo, AziPatternPeakPo, DiffImg,
+    JCPDS, JCPDSplt, UnitCell, DiffractionLine, Session, Section,
+    FitResult]}
+# caches and lmfit objects, made again when they are needed
+_JCPDS_CACHES = ['_line_arrays', '_line_src', '_dsp_memo', '_dsp',
+                 '_tth_memo']
+_SKIP = {'JCPDS': _JCPDS_CACHES, 'JCPDSplt': _JCPDS_CACHES,
+         'Section': ['parameters', 'fit_model']}
+_DEFAULTS = {'Section': {'parameters': None, 'fit_model': None}}
+# saved pressures read from DPP files, as filename: (mtime, pressure)
+_pressures = {}
+
+
+def _now():
+    return str(datetime.datetime.now())[:-7]
+
+
+class _ZipWriter(object):
+
+    def __init__(self, filename):
+        self.zf = zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED,
+                                  allowZip64=True)
+
+    def write_array(self, name, array):
+        # size is known, zip64 only when it is needed
+        with self.zf.open(name, 'w',
+                          force_zip64=(array.nbytes > 2 ** 30)) as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    def write_text(self, name, text):
+        self.zf.writestr(name, text, compress_type=zipfile.ZIP_DEFLATED)
+
+    def close(self):
+        self.zf.close()
+
+
+class _DirWriter(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'arrays'))
+
+    def write_array(self, name, array):
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    def write_text(self, name, text):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(text)
+
+    def close(self):
+        pass
+
+
+class _ZipReader(object):
+
+    def __init__(self, filename, mmap=True):
+        self.filename = filename
+        self.mmap = mmap
+        self.zf = zipfile.ZipFile(filename, 'r')
+
+    def read_text(self, name):
+        return self.zf.read(name).decode()
+
+    def read_array(self, name):
+        info = self.zf.getinfo(name)
+        if self.mmap and (info.compress_type == zipfile.ZIP_STORED):
+            array = self._map_array(info)
+            if array is not None:
+                return array
+        with self.zf.open(name) as f:
+            return np.lib.format.read_array(f, allow_pickle=False)
+
+    def _map_array(self, info):
+        """
+        :return: array mapped from the stored member, None if it cannot be
+        """
+        with open(self.filename, 'rb') as f:
+            # local header: 30 bytes, then name and extra field
+            f.seek(info.header_offset)
+            n_name, n_extra = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + n_name + n_extra)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                header = np.lib.format.read_array_header_2_0(f)
+            else:
+                return None
+            offset = f.tell()
+        shape, fortran_order, dtype = header
+        if (shape == ()) or (0 in shape) or dtype.hasobject:
+            return None
+        return _map_file(self.filename, dtype, offset, shape, fortran_order)
+
+    def close(self):
+        self.zf.close()
+
+
+class _DirReader(object):
+
+    def __init__(self, directory, mmap=True):
+        self.directory = directory
+        self.mmap = mmap
+
+    def read_text(self, name):
+        with open(os.path.join(self.directory, name), 'r') as f:
+            return f.read()
+
+    def read_array(self, name):
+        filename = os.path.join(self.directory, name)
+        if not self.mmap:
+            return np.load(filename, allow_pickle=False)
+        array = np.load(filename, mmap_mode='c', allow_pickle=False)
+        if isinstance(array, np.memmap):
+            # plain array on the map, which can be pickled and copied
+            return np.asarray(array)
+        return array
+
+    def close(self):
+        pass
+
+
+def _map_file(filename, dtype, offset, shape, fortran_order):
+    """
+    copy on write, so the array can be changed without changing the file.
+    A plain array on the map is returned, which can be pickled and copied.
+    """
+    return np.asarray(np.memmap(
+        filename, dtype=dtype, mode='c', offset=offset, shape=shape,
+        order='F' if fortran_order else 'C'))
+
+
+class _Encoder(object):
+    """
+    turns the model into json values, writing arrays as it goes
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.n_arrays = 0
+        # array objects shared in the model, such as x_bg and x_bgsub
+        # of a pattern, are written once
+        self._names = {}
+
+    def encode(self, value):
+        if (value is None) or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, np.ndarray):
+            return self._encode_array(value)
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, ParamRecord):
+            return {'__param__': [self.encode(v) for v in value]}
+        if isinstance(value, tuple):
+            return {'__tuple__': [self.encode(v) for v in value]}
+        if isinstance(value, list):
+            return [self.encode(v) for v in value]
+        if isinstance(value, dict):
+            return {'__dict__': [[self.encode(k), self.encode(v)]
+                                 for k, v in value.items()]}
+        if isinstance(value, Geometry):
+            # pyFAI integrator of the image, saved as its calibration
+            return {'__integrator__': self.encode(value.get_config())}
+        return self.encode_object(value)
+
+    def encode_object(self, obj, class_name=None):
+        """
+        :param class_name: to save obj as another class with the same
+            attributes
+        """
+        if class_name is None:
+            class_name = obj.__class__.__name__
+            if _CLASSES.get(class_name) is not obj.__class__:
+                raise TypeError('Cannot save {0:s} in a DPP file'.format(
+                    class_name))
+        if isinstance(obj, FitResult):
+            state = obj.__getstate__()
+        else:
+            state = dict(obj.__dict__)
+        for key in _SKIP.get(class_name, []):
+            state.pop(key, None)
+        if isinstance(obj, Section):
+            state['fit_result'] = _get_fit_result(obj)
+        return {'__object__': class_name,
+                'state': OrderedDict((key, self.encode(value))
+                                     for key, value in state.items())}
+
+    def _encode_array(self, array):
+        if array.dtype.hasobject:
+            raise TypeError('Cannot save an array of objects in a DPP file')
+        if id(array) in self._names:
+            return {'__array__': self._names[id(array)][0]}
+        name = 'arrays/{0:d}.npy'.format(self.n_arrays)
+        self.n_arrays += 1
+        self.writer.write_array(name, array)
+        # keep the array so that its id is not used again while writing
+        self._names[id(array)] = (name, array)
+        return {'__array__': name}
+
+
+def _get_fit_result(section):
+    """
+    fit result of sections from old dpp files is lmfit ModelResult
+    """
+    fit_result = section.fit_result
+    if (fit_result is None) or isinstance(fit_result, FitResult):
+        return fit_result
+    try:
+        return FitResult(fit_result)
+    except Exception as inst:
+        print(_now(), ": Fit result of a section is not saved, ", inst)
+        return None
+
+
+class _Decoder(object):
+
+    def __init__(self, reader):
+        self.reader = reader
+        self._arrays = {}
+
+    def decode(self, value):
+        if isinstance(value, list):
+            return [self.decode(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        if '__array__' in value:
+            name = value['__array__']
+            if name not in self._arrays:
+                self._arrays[name] = self.reader.read_array(name)
+            return self._arrays[name]
+        if '__tuple__' in value:
+            return tuple(self.decode(v) for v in value['__tuple__'])
+        if '__param__' in value:
+            return ParamRecord(*[self.decode(v) for v in value['__param__']])
+        if '__dict__' in value:
+            return dict((self.decode(k), self.decode(v))
+                        for k, v in value['__dict__'])
+        if '__integrator__' in value:
+            return pyFAI.load(dict(self.decode(value['__integrator__'])))
+        if '__object__' in value:
+            return self._decode_object(value)
+        raise ValueError('Unknown value in DPP file: ' + str(value)[:80])
+
+    def _decode_object(self, value):
+        class_name = value['__object__']
+        if class_name not in _CLASSES:
+            raise ValueError('Unknown class in DPP file: ' + class_name)
+        cls = _CLASSES[class_name]
+        state = dict(_DEFAULTS.get(class_name, {}))
+        for key, v in value['state'].items():
+            state[key] = self.decode(v)
+        obj = cls.__new__(cls)
+        if hasattr(obj, '__setstate__'):
+            obj.__setstate__(state)
+        else:
+            obj.__dict__.update(state)
+        return obj
+
+
+def is_dpp_v2(filename):
+    """
+    :return: True for version 2 DPP, False for dill DPP of older versions
+    """
+    if os.path.isdir(filename):
+        return os.path.exists(os.path.join(filename, _MANIFEST))
+    with open(filename, 'rb') as f:
+        return f.read(_ZIP_MAGIC.__len__()) == _ZIP_MAGIC
+
+
+def dump_dpp(model, filename, as_dir=False):
+    """
+    write model to a DPP version 2 file.  Written to a temporary name
+    first, so that a failed write does not break an existing DPP.
+
+    :param as_dir: write a directory instead of a zip file
+    """
+    temp_filen = filename + '.{0:d}.{1:d}.tmp'.format(
+        os.getpid(), threading.get_ident())
+    writer = _DirWriter(temp_filen) if as_dir else _ZipWriter(temp_filen)
+    try:
+        try:
+            encoder = _Encoder(writer)
+            manifest = OrderedDict([
+                ('format', DPP_FORMAT),
+                ('version', DPP_FILE_VERSION),
+                ('saved', _now()),
+                ('model', encoder.encode_object(model, 'PeakPoModel'))])
+            # manifest last, after all arrays are written
+            writer.write_text(_MANIFEST, json.dumps(manifest))
+        finally:
+            writer.close()
+    except:
+        if as_dir:
+            shutil.rmtree(temp_filen, ignore_errors=True)
+        elif os.path.exists(temp_filen):
+            os.remove(temp_filen)
+        raise
+    if as_dir and os.path.isdir(filename):
+        shutil.rmtree(filename)
+    os.replace(temp_filen, filename)
+
+
+def read_dpp_manifest(filename):
+    """
+    :return: manifest dict of a DPP version 2 file, arrays are not read
+    """
+    reader = _open_reader(filename, mmap=False)
+    try:
+        manifest = json.loads(reader.read_text(_MANIFEST))
+    finally:
+        reader.close()
+    if manifest.get('format') != DPP_FORMAT:
+        raise ValueError('Not a DPP file: ' + filename)
+    if manifest['version'] > DPP_FILE_VERSION:
+        raise ValueError('DPP file from a newer version: ' + filename)
+    return manifest
+
+
+def read_saved_pressure(filename):
+    """
+    :return: pressure saved in a DPP file.  Only the manifest is read for
+        version 2.  Kept until the file changes.
+    """
+    mtime = os.path.getmtime(filename)
+    if (filename in _pressures) and (_pressures[filename][0] == mtime):
+        return _pressures[filename][1]
+    if is_dpp_v2(filename):
+        state = read_dpp_manifest(filename)['model']['state']
+        pressure = state.get('saved_pressure')
+    else:
+        pressure = load_dpp(filename).get_saved_pressure()
+    _pressures[filename] = (mtime, pressure)
+    return pressure
+
+
+def _open_reader(filename, mmap=True):
+    if os.path.isdir(filename):
+        return _DirReader(filename, mmap=mmap)
+    return _ZipReader(filename, mmap=mmap)
+
+
+def load_dpp(filename, mmap=None):
+    """
+    read a DPP file of any version
+
+    :param mmap: memory map the arrays.  By default not on Windows, where
+        a mapped file cannot be replaced when the DPP is saved again.
+    :return: PeakPoModel
+    """
+    if not is_dpp_v2(filename):
+        with open(filename, 'rb') as f:
+            return dill.load(f)
+    if mmap is None:
+        mmap = (os.name != 'nt')
+    manifest = read_dpp_manifest(filename)
+    reader = _open_reader(filename, mmap=mmap)
+    try:
+        model = _Decoder(reader).decode(manifest['model'])
+    finally:
+        reader.close()
+    return model
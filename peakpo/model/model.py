@@ -6,12 +6,25 @@ from ds_cake import DiffImg
 # do not change the module structure for ds_jcpds and ds_powdiff for
 # retro compatibility
 from ds_jcpds import JCPDSplt, Session
-from ds_powdiff import PatternPeakPo, get_DataSection
+from ds_powdiff import PatternPeakPo, get_DataSection, subtract_bg_batch, \
+    fit_bg_batch, write_bg_batch, bg_cache, get_bg_cache_dir
 from ds_section import Section
 from utils import samefilename, make_filename, change_file_path, \
     cal_dspacing, extract_extension
 
 
+def _copy_shallow(obj):
+    """
+    new object with the same attributes, without __getstate__, which
+    would copy memory maps
+    """
+    if obj is None:
+        return None
+    new = object.__new__(obj.__class__)
+    new.__dict__.update(obj.__dict__)
+    return new
+
+
 class PeakPoModel(object):
     """
     session is only for reading/writing/referencing.
@@ -146,8 +159,31 @@ class PeakPoModel(object):
         self.jcpds_path = model_r.jcpds_path
         self.chi_path = model_r.chi_path
 
+    def make_snapshot(self):
+        """
+        copy of the model for saving in a worker thread.  Patterns and the
+        image share their arrays with the model, as PeakPo replaces these
+        arrays instead of changing them.  Sections, jcpds and session are
+        small and copied.
+        """
+        snapshot = _copy_shallow(self)
+        snapshot.base_ptn = _copy_shallow(self.base_ptn)
+        snapshot.waterfall_ptn = [_copy_shallow(ptn)
+                                  for ptn in self.waterfall_ptn]
+        snapshot.diff_img = _copy_shallow(self.diff_img)
+        snapshot.jcpds_lst = copy.deepcopy(self.jcpds_lst)
+        snapshot.ucfit_lst = copy.deepcopy(self.ucfit_lst)
+        snapshot.session = copy.deepcopy(self.session)
+        snapshot.current_section = copy.deepcopy(self.current_section)
+        snapshot.section_lst = copy.deepcopy(self.section_lst)
+        return snapshot
+
     def import_section_list(self, model_r):
-        new_section_lst = copy.deepcopy(model_r.section_lst)
+        """
+        sections of model_r are taken over, not copied.  model_r should
+        not be used after.
+        """
+        new_section_lst = model_r.section_lst
         if new_section_lst == []:
             return
         for section in new_section_lst:
@@ -155,9 +191,8 @@ class PeakPoModel(object):
             roi = section.get_xrange()
             x, y_bgsub, y_bg = self.get_single_section(roi)
             section.set(x, y_bgsub, y_bg)
-        existing_section_lst = copy.deepcopy(self.section_lst)
-        self.section_lst[:] = []
-        self.section_lst = existing_section_lst + new_section_lst
+        model_r.section_lst = []
+        self.section_lst = self.section_lst + new_section_lst
 
     def get_single_section(self, roi):
         x_section_bg, y_section_bg = get_DataSection(
@@ -232,12 +267,19 @@ class PeakPoModel(object):
     def same_filename_as_base_ptn(self, filename):
         return samefilename(self.base_ptn.fname, filename)
 
-    def set_base_ptn(self, new_base_ptn_filen, wavelength):
+    def set_base_ptn(self, new_base_ptn_filen, wavelength, sidecar=False,
+                     prefetched=None):
         """
         :param new_base_ptn: PatternPeakPo object
+        :param sidecar: read raw data through a binary sidecar file
+        :param prefetched: pattern already read from new_base_ptn_filen
         """
         self.reset_base_ptn()
-        self.base_ptn.read_file(new_base_ptn_filen)
+        if prefetched is None:
+            self.base_ptn.read_file(new_base_ptn_filen, sidecar=sidecar)
+        else:
+            self.base_ptn.fname = new_base_ptn_filen
+            self.base_ptn.x_raw, self.base_ptn.y_raw = prefetched.get_raw()
         self.set_chi_path(os.path.split(new_base_ptn_filen)[0])
         self.set_base_ptn_wavelength(wavelength)
         self.base_ptn.display = True
@@ -246,40 +288,121 @@ class PeakPoModel(object):
         return self.base_ptn
 
     def append_a_waterfall_ptn(self, filename, wavelength,
-                               bg_roi, bg_params, temp_dir=None):
+                               bg_roi, bg_params, temp_dir=None,
+                               bg_engine='cheb'):
         pattern = PatternPeakPo()
-        pattern.read_file(filename)
+        pattern.read_file(filename, sidecar=(temp_dir is not None))
         pattern.wavelength = wavelength
         pattern.display = False
-        if temp_dir is None:
-            pattern.get_chbg(bg_roi, params=bg_params, yshift=0)
-        else:
-            success = pattern.read_bg_from_tempfile(temp_dir=temp_dir)
-            if not success:
-                pattern.get_chbg(bg_roi, params=bg_params, yshift=0)
+        self._get_waterfall_bg(pattern, bg_roi, bg_params, temp_dir=temp_dir,
+                               bg_engine=bg_engine)
         self.waterfall_ptn.append(pattern)
 
+    def make_waterfall_ptns(self, filenames, wavelength, bg_roi,
+                            bg_params, temp_dir=None, bg_engine='cheb',
+                            display=False, is_cancelled=None, report=None):
+        """
+        read many patterns, such as all files in a directory, for the
+        waterfall list.  Background is read from current temp files, the
+        others are fitted together in a process pool.  The model is not
+        changed, so this can run in a worker thread.
+        :param is_cancelled: function, reading stops if it returns True
+        :param report: called with the number of files read and total
+        :return: list of patterns, None if cancelled
+        """
+        patterns = []
+        for filename in filenames:
+            if (is_cancelled is not None) and is_cancelled():
+                return None
+            pattern = PatternPeakPo()
+            pattern.read_file(filename, sidecar=(temp_dir is not None))
+            pattern.wavelength = wavelength
+            pattern.display = display
+            if temp_dir is not None:
+                pattern.read_bg_from_tempfile(
+                    temp_dir=temp_dir, roi=bg_roi, params=bg_params,
+                    engine=bg_engine)
+            patterns.append(pattern)
+            if report is not None:
+                report(patterns.__len__(), filenames.__len__())
+        if (is_cancelled is not None) and is_cancelled():
+            return None
+        subtract_bg_batch(patterns, bg_roi, bg_params, temp_dir=temp_dir,
+                          cache=bg_cache, engine=bg_engine)
+        return patterns
+
+    def _get_waterfall_bg(self, pattern, bg_roi, bg_params, temp_dir=None,
+                          bg_engine='cheb'):
+        """
+        use temp files or cached fit if they were made for the same
+        raw data, roi, params and engine.  otherwise fit background.
+        """
+        if temp_dir is None:
+            pattern.get_chbg(bg_roi, params=bg_params, yshift=0,
+                             cache=bg_cache, engine=bg_engine)
+            return
+        success = pattern.read_bg_from_tempfile(
+            temp_dir=temp_dir, roi=bg_roi, params=bg_params,
+            engine=bg_engine)
+        if not success:
+            pattern.get_chbg(bg_roi, params=bg_params, yshift=0,
+                             cache=bg_cache,
+                             cache_dir=get_bg_cache_dir(pattern.fname),
+                             engine=bg_engine)
+
     def replace_a_waterfall(self, new_pattern, index_to_replace):
         self.waterfall_ptn[index_to_replace] = new_pattern
 
     def set_waterfall_ptn(
             self, filenames, wavelength, display, bg_roi, bg_params,
-            temp_dir=None):
+            temp_dir=None, bg_engine='cheb'):
         new_waterfall_ptn = []
         for f, wl, dp in zip(filenames, wavelength, display):
             pattern = PatternPeakPo()
-            pattern.read_file(f)
+            pattern.read_file(f, sidecar=(temp_dir is not None))
             pattern.wavelength = wl
             pattern.display = dp
-            if temp_dir is None:
-                pattern.get_chbg(bg_roi, params=bg_params, yshift=0)
-            else:
-                success = pattern.read_bg_from_tempfile(temp_dir=temp_dir)
-                if not success:
-                    pattern.get_chbg(bg_roi, params=bg_params, yshift=0)
+            self._get_waterfall_bg(pattern, bg_roi, bg_params,
+                                   temp_dir=temp_dir, bg_engine=bg_engine)
             new_waterfall_ptn.append(pattern)
         self.waterfall_ptn = new_waterfall_ptn
 
+    def fit_bg_waterfall(self, patterns, bg_roi, bg_params, temp_dir=None,
+                         force=False, bg_engine='cheb'):
+        """
+        fit background of waterfall patterns in a process pool, without
+        changing them, so that it can be done in a worker thread.
+        patterns already fitted with the same roi, params and engine are
+        skipped.
+        :param patterns: list of patterns, taken from waterfall_ptn in
+            the main thread
+        :param temp_dir: if given, temp files are written for the fits
+        :return: fits for set_bg_waterfall
+        """
+        fits = fit_bg_batch(patterns, bg_roi, bg_params, force=force,
+                            cache=bg_cache,
+                            cache_on_disk=(temp_dir is not None),
+                            engine=bg_engine)
+        if temp_dir is not None:
+            write_bg_batch(fits, bg_roi, bg_params, temp_dir,
+                           engine=bg_engine)
+        return fits
+
+    def set_bg_waterfall(self, fits, bg_roi, bg_params, bg_engine='cheb'):
+        """
+        set background from fit_bg_waterfall for the patterns still in
+        the waterfall list
+        :return: number of patterns changed
+        """
+        n_set = 0
+        for ptn, x, y, y_bg in fits:
+            if not any(ptn is p for p in self.waterfall_ptn):
+                continue
+            ptn.set_bg_from_fit(x, y, y_bg, bg_roi, params=list(bg_params),
+                                engine=bg_engine)
+            n_set += 1
+        return n_set
+
     def append_a_jcpds(self, filen, color):
         try:
             phase = JCPDSplt()
@@ -10,6 +10,7 @@ from ds_jcpds import JCPDSplt, Session
 from ds_powdiff import PatternPeakPo, get_DataSection
 from ds_section import Section
 from utils import samefilename, make_filename, change_file_path
+from .dppfile import dump_dpp
 
 
 class PeakPoDirModel(object):
@@ -48,16 +49,19 @@ class PeakPoDirModel(object):
         return proc_dir
 
     def write_to_dir(self, tmp=False, overwrite=False):
-        # check if directory exists and decide if overwrite or tmp, make new_folder
-        # get path for base_ptn
-        if os.path.exists(proc_dir):
-
-            # make JSON file for basic info
-            # copy jcpds files to jcpds_folder
-            # copy waterfall_ptn
-            # copy diff_img
-            # copy poni file
-            # copy other files which used to be saparate from PeakPoModel
+        """
+        write the model as a DPP version 2 directory: a JSON manifest
+        and NumPy files for the arrays
+        """
+        proc_dir = self.make_proc_dir(tmp=tmp)
+        if proc_dir is None:
+            return None
+        if os.path.exists(proc_dir) and (not overwrite):
+            print(str(datetime.datetime.now())[:-7],
+                  ': Directory already exists ', proc_dir)
+            return None
+        dump_dpp(self, proc_dir, as_dir=True)
+        return proc_dir
 
     def exist_in_waterfall(self, filename):
         if not self.waterfall_exist():
@@ -0,0 +1,373 @@
+"""
+Fit the sections of one file to all files of a pressure series.
+
+Files are fitted in order of pressure.  Each fit starts from the
+converged peaks and baseline of the previous file in the same chain, and
+peak centers can be moved first by the shift the JCPDS equation of state
+predicts between the two pressures.  Chains start at the file the
+sections were made in and go up and down in pressure, so that they can
+run in separate processes.  Results are saved to the DPP of each file
+and to an xls file in its -param directory.
+"""
+import os
+import copy
+import time
+import datetime
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from ds_section import Section
+from ds_powdiff import PatternPeakPo, bg_cache, get_bg_cache_dir
+from utils import make_filename, get_temp_dir
+from .model import PeakPoModel
+from .dppfile import dump_dpp, load_dpp, read_saved_pressure
+
+DEFAULT_PROPAGATE_SETTINGS = {'wavelength': 0.3344,
+                              'bg_roi': [6.0, 21.0],
+                              'bg_params': [20, 10, 20],
+                              'bg_engine': 'cheb',
+                              'maxwidth': 0.3,
+                              'centerrange': 0.3,
+                              'eos_shift': True,
+                              'temperature': 300.}
+
+
+def _now():
+    return str(datetime.datetime.now())[:-7]
+
+
+def make_section_template(section):
+    """
+    :return: dict with roi, peaks and baseline of a section, without fit
+        results, so that it is small to send to other processes
+    """
+    return {'roi': [float(v) for v in section.get_xrange()],
+            'peaks': copy.deepcopy(section.peaks_in_queue),
+            'baseline': copy.deepcopy(section.baseline_in_queue),
+            'fit_engine': section.fit_engine}
+
+
+def read_dpp(chi_filen):
+    """
+    :return: model in the dpp of a chi file, None if there is none
+    """
+    filen_dpp = make_filename(chi_filen, 'dpp')
+    if not os.path.exists(filen_dpp):
+        return None
+    try:
+        return load_dpp(filen_dpp)
+    except Exception:
+        print(_now(), ": Cannot read ", filen_dpp)
+        return None
+
+
+def read_pressures(chi_filens):
+    """
+    :return: list of pressures saved in the dpp files, None for files
+        without dpp
+    """
+    pressures = []
+    for chi_filen in chi_filens:
+        filen_dpp = make_filename(chi_filen, 'dpp')
+        if not os.path.exists(filen_dpp):
+            pressures.append(None)
+            continue
+        try:
+            pressures.append(read_saved_pressure(filen_dpp))
+        except Exception:
+            print(_now(), ": Cannot read ", filen_dpp)
+            pressures.append(None)
+    return pressures
+
+
+def sort_by_pressure(chi_filens, pressures):
+    """
+    sort files by pressure if all pressures are known, otherwise keep
+    the order of navigation
+
+    :return: chi filenames and pressures
+    """
+    if (chi_filens == []) or (None in pressures):
+        return list(chi_filens), list(pressures)
+    order = np.argsort(pressures, kind='stable')
+    return [chi_filens[i] for i in order], [pressures[i] for i in order]
+
+
+def make_chains(n_files, i_start, n_chains=2):
+    """
+    split files to chains fitted one after the other.  Chains start at
+    i_start and move away from it, up and down in the list.
+
+    :return: list of lists of indices
+    """
+    up = list(range(i_start, n_files))
+    down = list(range(i_start - 1, -1, -1))
+    if (n_chains <= 2) or (n_files <= 2):
+        return [chain for chain in [up, down] if chain != []]
+    if down == []:
+        n_up, n_down = n_chains, 0
+    elif up == []:
+        n_up, n_down = 0, n_chains
+    else:
+        n_up = int(round(n_chains * up.__len__() / n_files))
+        n_up = min(max(n_up, 1), n_chains - 1)
+        n_down = n_chains - n_up
+    chains = []
+    for direction, n_pieces in [(up, n_up), (down, n_down)]:
+        n_pieces = min(n_pieces, direction.__len__())
+        for piece in np.array_split(direction, max(n_pieces, 1)):
+            if piece.size > 0:
+                chains.append(piece.tolist())
+    return chains
+
+
+def predict_center_shift(jcpds_lst, peak, wavelength, pressure_from,
+                         pressure_to, temperature=300.):
+    """
+    :param peak: peak dict of a section, with phasename and hkl
+    :return: change in two theta of the peak predicted from the equation
+        of state of its phase, 0 if the phase or line is not in jcpds_lst
+    """
+    if (pressure_from is None) or (pressure_to is None) or \
+            (pressure_from == pressure_to):
+        return 0.
+    hkl = (peak['h'], peak['k'], peak['l'])
+    for phase in jcpds_lst:
+        if phase.name != peak['phasename']:
+            continue
+        for i, line in enumerate(phase.DiffLines):
+            if (line.h, line.k, line.l) != hkl:
+                continue
+            # table values at 0 GPa may not follow the unit cell
+            phase.cal_dsp(pressure_from, temperature,
+                          use_table_for_0GPa=False)
+            d_from = phase.DiffLines[i].dsp
+            phase.cal_dsp(pressure_to, temperature,
+                          use_table_for_0GPa=False)
+            d_to = phase.DiffLines[i].dsp
+            tth_from = 2. * np.degrees(np.arcsin(wavelength / 2. / d_from))
+            tth_to = 2. * np.degrees(np.arcsin(wavelength / 2. / d_to))
+            if np.isnan(tth_from) or np.isnan(tth_to):
+                return 0.
+            return float(tth_to - tth_from)
+    return 0.
+
+
+def shift_template(template, jcpds_lst, wavelength, pressure_from,
+                   pressure_to, temperature=300.):
+    """
+    :return: copy of the template with peaks moved by the equation of
+        state and roi moved by the mean of the shifts
+    """
+    new_template = copy.deepcopy(template)
+    shifts = []
+    for peak in new_template['peaks']:
+        shift = predict_center_shift(jcpds_lst, peak, wavelength,
+                                     pressure_from, pressure_to,
+                                     temperature=temperature)
+        peak['center'] += shift
+        shifts.append(shift)
+    if shifts != []:
+        mean_shift = float(np.mean(shifts))
+        new_template['roi'] = [v + mean_shift for v in template['roi']]
+    return new_template
+
+
+def load_pattern(chi_filen, settings):
+    """
+    read a chi file and get background the same way as the GUI, from
+    the temp files if they were made with the same roi, params and engine
+    """
+    temp_dir = get_temp_dir(chi_filen)
+    ptn = PatternPeakPo()
+    ptn.read_file(chi_filen, sidecar=True)
+    ptn.wavelength = settings['wavelength']
+    if not ptn.read_bg_from_tempfile(temp_dir=temp_dir,
+                                     roi=settings['bg_roi'],
+                                     params=settings['bg_params'],
+                                     engine=settings['bg_engine']):
+        ptn.get_chbg(settings['bg_roi'], params=settings['bg_params'],
+                     yshift=0, cache=bg_cache,
+                     cache_dir=get_bg_cache_dir(chi_filen),
+                     engine=settings['bg_engine'])
+        ptn.write_temporary_bgfiles(temp_dir)
+    return ptn
+
+
+def fit_template(model, template, settings):
+    """
+    :return: fitted section, None if fitting failed
+    """
+    section = Section()
+    section.set(*model.get_single_section(template['roi']))
+    section.peaks_in_queue = copy.deepcopy(template['peaks'])
+    section.baseline_in_queue = copy.deepcopy(template['baseline'])
+    section.set_fit_engine(template.get('fit_engine', 'lmfit'))
+    section.prepare_for_fitting(
+        max(section.get_order_of_baseline_in_queue(), 0),
+        settings['maxwidth'], settings['centerrange'])
+    if not section.conduct_fitting():
+        return None
+    return section
+
+
+def _overlaps(section, roi):
+    xmin, xmax = section.get_xrange()
+    return (xmin < roi[1]) and (xmax > roi[0])
+
+
+def save_sections(chi_filen, ptn, sections, jcpds_lst, pressure):
+    """
+    save sections to the dpp of a chi file.  Sections already in the dpp
+    are kept unless they overlap with a new one.
+
+    :return: dpp filename
+    """
+    model = read_dpp(chi_filen)
+    if model is None:
+        model = PeakPoModel()
+        model.base_ptn = ptn
+        model.set_chi_path(os.path.split(chi_filen)[0])
+        model.jcpds_lst = copy.deepcopy(jcpds_lst)
+        if pressure is not None:
+            model.save_pressure(pressure)
+    elif model.base_ptn is None:
+        model.base_ptn = ptn
+    rois = [section.get_xrange() for section in sections]
+    model.section_lst = [
+        section for section in model.section_lst
+        if not any(_overlaps(section, roi) for roi in rois)] + sections
+    temp_dir = get_temp_dir(chi_filen)
+    model.save_peak_fit_results_to_xls(
+        make_filename(chi_filen, 'peakfit.xls', temp_dir=temp_dir))
+    filen_dpp = make_filename(chi_filen, 'dpp')
+    dump_dpp(model, filen_dpp)
+    return filen_dpp
+
+
+def fit_chain(chi_filens, pressures, templates, settings, jcpds_lst=None,
+              pressure_start=None):
+    """
+    fit files one after the other, each starting from the result of the
+    previous one.  Top level function so that it can be sent to a
+    process pool.
+
+    :param templates: list from make_section_template
+    :param pressure_start: pressure of the file the templates are from
+    :return: list of (chi filename, dpp filename or None, error text or
+        None)
+    """
+    if jcpds_lst is None:
+        jcpds_lst = []
+    jcpds_lst = copy.deepcopy(jcpds_lst)
+    results = []
+    pressure_prev = pressure_start
+    for chi_filen, pressure in zip(chi_filens, pressures):
+        t_start = time.time()
+        try:
+            ptn = load_pattern(chi_filen, settings)
+            model = PeakPoModel()
+            model.base_ptn = ptn
+            sections = []
+            new_templates = []
+            for template in templates:
+                if settings['eos_shift']:
+                    template = shift_template(
+                        template, jcpds_lst, settings['wavelength'],
+                        pressure_prev, pressure,
+                        temperature=settings['temperature'])
+                section = fit_template(model, template, settings)
+                if section is None:
+                    # a failed fit does not start the next one
+                    new_templates.append(template)
+                    continue
+                sections.append(section)
+                new_templates.append(make_section_template(section))
+            if sections == []:
+                raise ValueError('No section was fitted')
+            filen_dpp = save_sections(chi_filen, ptn, sections, jcpds_lst,
+                                      pressure)
+        except Exception:
+            results.append((chi_filen, None, traceback.format_exc()))
+            print(_now(), ": Propagate failed for ", chi_filen)
+            continue
+        templates = new_templates
+        if pressure is not None:
+            pressure_prev = pressure
+        results.append((chi_filen, filen_dpp, None))
+        print(_now(), ": Propagate ", os.path.basename(chi_filen),
+              " takes {0:.2f}s".format(time.time() - t_start))
+    return results
+
+
+def propagate_sections(model, chi_filens, settings=None, pressures=None,
+                       n_chains=2, max_workers=None, is_cancelled=None,
+                       report=None):
+    """
+    fit the sections in model.section_lst to all files
+
+    :param model: PeakPoModel with the sections, jcpds and base pattern
+        the sections were made for
+    :param chi_filens: files of the series in the order of navigation
+    :param pressures: pressure of each file.  If None, read from the dpp
+        files.  Files are fitted in order of pressure only if all are
+        known.
+    :param n_chains: number of chains, run in separate processes
+    :param is_cancelled: function, no new chain starts if it returns True
+    :param report: called with the number of chains done and total
+    :return: list of (chi filename, dpp filename or None, error text or
+        None)
+    """
+    if settings is None:
+        settings = dict(DEFAULT_PROPAGATE_SETTINGS)
+    t_start = time.time()
+    if pressures is None:
+        pressures = read_pressures(chi_filens)
+    ref_filen = model.get_base_ptn_filename()
+    pressures = [model.get_saved_pressure() if f == ref_filen else p
+                 for f, p in zip(chi_filens, pressures)]
+    chi_filens, pressures = sort_by_pressure(chi_filens, pressures)
+    if None in pressures:
+        print(_now(), ": Pressure is not known for all files, "
+              "files are fitted in the order of names.")
+    i_start = chi_filens.index(ref_filen) if ref_filen in chi_filens else 0
+    templates = [make_section_template(section)
+                 for section in model.section_lst]
+    chains = make_chains(chi_filens.__len__(), i_start, n_chains=n_chains)
+    jobs = [([chi_filens[i] for i in chain], [pressures[i] for i in chain])
+            for chain in chains]
+    print(_now(), ": Propagate {0:d} sections to {1:d} files in {2:d} "
+          "chains".format(templates.__len__(), chi_filens.__len__(),
+                          jobs.__len__()))
+    args = (templates, settings, model.jcpds_lst, pressures[i_start])
+    results = []
+    remaining = list(range(jobs.__len__()))
+    if jobs.__len__() > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(fit_chain, *jobs[i], *args): i
+                           for i in remaining}
+                for future in as_completed(futures):
+                    results += future.result()
+                    remaining.remove(futures[future])
+                    if report is not None:
+                        report(jobs.__len__() - remaining.__len__(),
+                               jobs.__len__())
+                    if (is_cancelled is not None) and is_cancelled():
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        break
+        except (BrokenProcessPool, OSError) as inst:
+            print(_now(), ": Process pool failed, fit one by one: ", inst)
+    for i in list(remaining):
+        if (is_cancelled is not None) and is_cancelled():
+            break
+        results += fit_chain(*jobs[i], *args)
+        remaining.remove(i)
+        if report is not None:
+            report(jobs.__len__() - remaining.__len__(), jobs.__len__())
+    n_failed = [r for r in results if r[2] is not None].__len__()
+    print(_now(), ": Propagate finished in {0:.2f}s, {1:d} files fitted, "
+          "{2:d} failed".format(time.time() - t_start,
+                                results.__len__() - n_failed, n_failed))
+    return results
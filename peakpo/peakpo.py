@@ -14,6 +14,7 @@ import numpy
 import time
 import os
 import faulthandler
+import multiprocessing
 from sys import platform as _platform
 
 faulthandler.enable()
@@ -51,50 +52,59 @@ def excepthook(exc_type, exc_value, traceback_obj):
     errorbox.exec_()
 
 
-# 2020/02/15 block below does not affect screen resolution
-#QtCore.QCoreApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
-app = QtWidgets.QApplication(sys.argv) #app.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling)
-app.setStyle('Fusion')
-# fbs
-#  comment two lines above and uncomment the following two lines
-#appctxt = ApplicationContext() #QtWidgets.QApplication(sys.argv)
-#appctxt.app.setStyle('Fusion')
-sys.excepthook = excepthook
+if __name__ == '__main__':
+    # workers of the process pools for background fitting import this
+    # module again under spawn, so the app has to be started only here
+    multiprocessing.freeze_support()
+    # python -m peakpo batch ... from this directory runs this file
+    from cli import COMMANDS
+    if sys.argv[1:2] in [[command] for command in COMMANDS]:
+        from cli import main
+        sys.exit(main(sys.argv[1:]))
+    # 2020/02/15 block below does not affect screen resolution
+    #QtCore.QCoreApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
+    app = QtWidgets.QApplication(sys.argv) #app.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling)
+    app.setStyle('Fusion')
+    # fbs
+    #  comment two lines above and uncomment the following two lines
+    #appctxt = ApplicationContext() #QtWidgets.QApplication(sys.argv)
+    #appctxt.app.setStyle('Fusion')
+    sys.excepthook = excepthook
 
-# Now use a palette to switch to dark colors:
-dark_palette = QPalette()
-dark_palette.setColor(QPalette.Window, QColor(53, 53, 53))
-dark_palette.setColor(QPalette.WindowText, Qt.white)
-dark_palette.setColor(QPalette.Base, QColor(35, 35, 35))
-dark_palette.setColor(QPalette.AlternateBase, QColor(53, 53, 53))
-dark_palette.setColor(QPalette.ToolTipBase, QColor(25, 25, 25))
-dark_palette.setColor(QPalette.ToolTipText, Qt.white)
-if _platform == "darwin": # works only for mac
-    dark_palette.setColor(QPalette.Text, Qt.white)
-else:
-    dark_palette.setColor(QPalette.Text, Qt.darkGray)
-dark_palette.setColor(QPalette.Button, QColor(53, 53, 53))
-dark_palette.setColor(QPalette.ButtonText, Qt.white)
-dark_palette.setColor(QPalette.BrightText, Qt.red)
-dark_palette.setColor(QPalette.Link, QColor(42, 130, 218))
-dark_palette.setColor(QPalette.Highlight, QColor(42, 130, 218))
-dark_palette.setColor(QPalette.HighlightedText, QColor(35, 35, 35))
-dark_palette.setColor(QPalette.Active, QPalette.Button, QColor(53, 53, 53))
-dark_palette.setColor(QPalette.Disabled, QPalette.ButtonText, Qt.darkGray)
-dark_palette.setColor(QPalette.Disabled, QPalette.WindowText, Qt.darkGray)
-dark_palette.setColor(QPalette.Disabled, QPalette.Text, Qt.darkGray)
-dark_palette.setColor(QPalette.Disabled, QPalette.Light, QColor(53, 53, 53))
-app.setPalette(dark_palette)
+    # Now use a palette to switch to dark colors:
+    dark_palette = QPalette()
+    dark_palette.setColor(QPalette.Window, QColor(53, 53, 53))
+    dark_palette.setColor(QPalette.WindowText, Qt.white)
+    dark_palette.setColor(QPalette.Base, QColor(35, 35, 35))
+    dark_palette.setColor(QPalette.AlternateBase, QColor(53, 53, 53))
+    dark_palette.setColor(QPalette.ToolTipBase, QColor(25, 25, 25))
+    dark_palette.setColor(QPalette.ToolTipText, Qt.white)
+    if _platform == "darwin": # works only for mac
+        dark_palette.setColor(QPalette.Text, Qt.white)
+    else:
+        dark_palette.setColor(QPalette.Text, Qt.darkGray)
+    dark_palette.setColor(QPalette.Button, QColor(53, 53, 53))
+    dark_palette.setColor(QPalette.ButtonText, Qt.white)
+    dark_palette.setColor(QPalette.BrightText, Qt.red)
+    dark_palette.setColor(QPalette.Link, QColor(42, 130, 218))
+    dark_palette.setColor(QPalette.Highlight, QColor(42, 130, 218))
+    dark_palette.setColor(QPalette.HighlightedText, QColor(35, 35, 35))
+    dark_palette.setColor(QPalette.Active, QPalette.Button, QColor(53, 53, 53))
+    dark_palette.setColor(QPalette.Disabled, QPalette.ButtonText, Qt.darkGray)
+    dark_palette.setColor(QPalette.Disabled, QPalette.WindowText, Qt.darkGray)
+    dark_palette.setColor(QPalette.Disabled, QPalette.Text, Qt.darkGray)
+    dark_palette.setColor(QPalette.Disabled, QPalette.Light, QColor(53, 53, 53))
+    app.setPalette(dark_palette)
 
-# fbs
-#  comment a line above and uncomment the following line
-#    appctxt.app.setPalette(dark_palette)
+    # fbs
+    #  comment a line above and uncomment the following line
+    #    appctxt.app.setPalette(dark_palette)
 
-controller = MainController()
-controller.show_window()
-ret = app.exec_()
-# fbs
-#  comment line above and uncomment line below
-#ret = appctxt.app.exec_()
-controller.write_setting()
-sys.exit(ret)
+    controller = MainController()
+    controller.show_window()
+    ret = app.exec_()
+    # fbs
+    #  comment line above and uncomment line below
+    #ret = appctxt.app.exec_()
+    controller.write_setting()
+    sys.exit(ret)
@@ -1,10 +1,29 @@
-from .pyqtutils import undo_button_press, SpinBoxFixStyle
 from .fileutils import samefilename, extract_filename, make_filename, \
     get_sorted_filelist, find_from_filelist, writechi, readchi, \
-    extract_extension, change_file_path, get_directory, get_temp_dir
-from .dialogs import dialog_savefile, ErrorMessageBox, InformationBox
+    extract_extension, change_file_path, get_directory, get_temp_dir, \
+    read_xy_with_sidecar, find_associated_image
 from .excelutils import xls_ucfitlist, xls_jlist
 from .physutils import convert_wl_to_energy
+from .plotutils import decimate_minmax, is_increasing
+from .cacheutils import MemoryLRU, write_replace, touch_cache_file, \
+    evict_cache_files
 from .unitcellfit import make_output_table, fit_cubic_cell, \
     fit_tetragonal_cell, fit_orthorhombic_cell, fit_hexagonal_cell, \
     cal_dspacing
+
+# helpers for the GUI are imported when they are used, so that data files
+# can be read without PyQt
+_QT_NAMES = {'undo_button_press': 'pyqtutils',
+             'SpinBoxFixStyle': 'pyqtutils',
+             'dialog_savefile': 'dialogs',
+             'ErrorMessageBox': 'dialogs',
+             'InformationBox': 'dialogs'}
+
+
+def __getattr__(name):
+    if name not in _QT_NAMES:
+        raise AttributeError(
+            "module 'utils' has no attribute '{0:s}'".format(name))
+    import importlib
+    module = importlib.import_module('.' + _QT_NAMES[name], __name__)
+    return getattr(module, name)
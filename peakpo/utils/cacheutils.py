@@ -0,0 +1,112 @@
+import os
+import glob
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+class MemoryLRU(object):
+    """
+    Thread-safe LRU of objects with nbytes, such as arrays, kept up to
+    max_bytes.  The last object put is kept even if it is larger.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._entries.__len__()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._n_bytes = 0
+
+    def get(self, key):
+        """
+        :return: object or None
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = value
+            self._n_bytes += value.nbytes
+            while (self._n_bytes > self.max_bytes) and \
+                    (self._entries.__len__() > 1):
+                __, old = self._entries.popitem(last=False)
+                self._n_bytes -= old.nbytes
+
+
+@contextmanager
+def write_replace(filename):
+    """
+    open a temporary file for writing in binary, which replaces filename
+    when the block ends without error, so that other threads or processes
+    never read a partial file
+
+    :param filename: file to write
+    :return: file object for the with block
+    """
+    temp_filen = filename + '.{0:d}.{1:d}.tmp'.format(
+        os.getpid(), threading.get_ident())
+    try:
+        with open(temp_filen, 'wb') as f:
+            yield f
+        os.replace(temp_filen, filename)
+    except BaseException:
+        try:
+            os.remove(temp_filen)
+        except OSError:
+            pass
+        raise
+
+
+def touch_cache_file(filename):
+    """
+    mark a file as recently used for evict_cache_files.  Others sharing
+    the directory may have removed it already.
+    """
+    try:
+        os.utime(filename, None)
+    except OSError:
+        pass
+
+
+def evict_cache_files(pattern, max_bytes):
+    """
+    remove least recently used files until the total size is max_bytes.
+    Files removed meanwhile by other threads or processes sharing the
+    directory are skipped.
+
+    :param pattern: glob pattern of the cache files
+    :param max_bytes: total size to keep
+    """
+    stats = []
+    for f in glob.glob(pattern):
+        try:
+            stat = os.stat(f)
+        except OSError:
+            continue
+        stats.append((f, stat.st_size, stat.st_mtime))
+    total = sum(size for __, size, __ in stats)
+    if total <= max_bytes:
+        return
+    for f, size, __ in sorted(stats, key=lambda stat: stat[2]):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(f)
+        except OSError:
+            continue
+        total -= size
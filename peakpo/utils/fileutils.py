@@ -1,5 +1,6 @@
 import os.path
 import glob
+import tempfile
 import numpy as np
 import re
 
@@ -15,17 +16,88 @@ def writechi(filen, x, y, preheader=None):
                fmt='%1.7e', header=header, comments=preheader)
 
 
-def readchi(filen):
+def readchi(filen, sidecar=False):
     """
     read chi with BG ROI and BG PARAMS
+
+    :param sidecar: use binary sidecar, see read_xy_with_sidecar
     """
     with open(filen) as f:
-        content = f.readlines()
-    roi = re.findall(r"[-+]?\d*\.\d+|\d+", content[0])
-    bg_params = re.findall(r"[-+]?\d*\.\d+|\d+", content[1])
-    data = np.loadtxt(filen, skiprows=4)
-    x, y = data.T
-    return [float(r) for r in roi], [int(b) for b in bg_params], x, y
+        line0 = f.readline()
+        line1 = f.readline()
+    roi = re.findall(r"[-+]?\d*\.\d+|\d+", line0)
+    bg_params = re.findall(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?",
+                           line1)
+    if sidecar:
+        x, y = read_xy_with_sidecar(filen)
+    else:
+        data = np.loadtxt(filen, skiprows=4)
+        x, y = data.T
+    return [float(r) for r in roi], [_to_number(b) for b in bg_params], \
+        x, y
+
+
+def _to_number(text):
+    """
+    int for integers, so that cheb parameters read back the same
+    """
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def read_xy_with_sidecar(filen, sidecar_filen=None, skiprows=4):
+    """
+    read two column text data.  On the first read, a binary copy is saved
+    to sidecar_filen and later reads memory-map it as long as the size and
+    modification time of filen stay the same.
+    The first column of the sidecar keeps size and mtime of filen.
+
+    :param filen: text file name
+    :param sidecar_filen: binary file name, default is filen + '.npy'
+    :param skiprows: number of header lines in filen
+    :return: x, y
+    """
+    if sidecar_filen is None:
+        sidecar_filen = filen + '.npy'
+    stat = os.stat(filen)
+    stamp = [float(stat.st_size), stat.st_mtime]
+    if os.path.exists(sidecar_filen):
+        try:
+            # copy-on-write so that callers can still modify the arrays
+            data = np.load(sidecar_filen, mmap_mode='c')
+            if (data.ndim == 2) and (data.shape[0] == 2) and \
+                    (data[:, 0].tolist() == stamp):
+                # plain arrays on the map, because dill cannot save
+                # memmap objects in dpp files
+                return np.asarray(data[0, 1:]), np.asarray(data[1, 1:])
+        except (OSError, ValueError):
+            pass
+    x, y = np.loadtxt(filen, skiprows=skiprows).T
+    data = np.empty((2, x.size + 1))
+    data[:, 0] = stamp
+    data[0, 1:] = x
+    data[1, 1:] = y
+    _save_sidecar(sidecar_filen, data)
+    return x, y
+
+
+def _save_sidecar(sidecar_filen, data):
+    """
+    write to a temporary file first so that other readers never see
+    a partial sidecar.  failure to write only means no sidecar.
+    """
+    sidecar_dir = os.path.dirname(os.path.abspath(sidecar_filen))
+    try:
+        os.makedirs(sidecar_dir, exist_ok=True)
+        fd, temp_filen = tempfile.mkstemp(suffix='.tmp', dir=sidecar_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, data)
+        os.replace(temp_filen, sidecar_filen)
+    except OSError:
+        if ('temp_filen' in locals()) and os.path.exists(temp_filen):
+            os.remove(temp_filen)
 
 
 def find_from_filelist(flist, filen):
@@ -37,7 +109,14 @@ def find_from_filelist(flist, filen):
     return -1
 
 
-def get_sorted_filelist(path, search_ext='*.chi', sorted_by_name=True):
+def get_sorted_filelist(path, search_ext='*.chi', sorted_by_name=True,
+                        cached=False):
+    """
+    :param cached: reuse the last list for the same path unless the
+        directory was modified, i.e. files were added, removed or renamed
+    """
+    if cached:
+        return _get_sorted_filelist_cached(path, search_ext, sorted_by_name)
     filelist = glob.glob(os.path.join(path, search_ext))
     if sorted_by_name:
         return sorted(filelist)
@@ -45,6 +124,22 @@ def get_sorted_filelist(path, search_ext='*.chi', sorted_by_name=True):
         return sorted(filelist, key=os.path.getmtime)
 
 
+_filelist_cache = {}
+
+
+def _get_sorted_filelist_cached(path, search_ext, sorted_by_name):
+    key = (os.path.abspath(path), search_ext, sorted_by_name)
+    try:
+        stamp = os.stat(path).st_mtime_ns
+    except OSError:
+        return get_sorted_filelist(path, search_ext, sorted_by_name)
+    if (key in _filelist_cache) and (_filelist_cache[key][0] == stamp):
+        return list(_filelist_cache[key][1])
+    filelist = get_sorted_filelist(path, search_ext, sorted_by_name)
+    _filelist_cache[key] = (stamp, filelist)
+    return list(filelist)
+
+
 def samefilename(filen1, filen2):
     """
     take out filenames and compare
@@ -133,3 +228,17 @@ def get_temp_dir(base_ptn_filename, branch='-param'):
     if not os.path.exists(temp_dir):
         os.makedirs(temp_dir)
     return temp_dir
+
+
+def find_associated_image(filename,
+                          extensions=('tif', 'tiff', 'mar3450', 'cbf')):
+    """
+    image for a chi file, in the same order as PeakPoModel
+
+    :return: image filename, None if there is none
+    """
+    for ext in extensions:
+        filen = make_filename(filename, ext, original=True)
+        if os.path.exists(filen):
+            return filen
+    return None
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def decimate_minmax(x, y, x_min, x_max, n_columns):
+    """
+    Reduce a line to what can be seen at screen resolution.
+    The view range is divided into n_columns pixel columns and, for each
+    column, the first, last, lowest and highest points are kept in their
+    original order.  As the extrema of every column are kept, peaks are
+    never dropped and the drawn envelope is the same as for full data.
+
+    :param x: x, increasing
+    :param y: y, nan for gaps in the line
+    :param x_min: lower limit of the view
+    :param x_max: upper limit of the view
+    :param n_columns: width of the view in pixels
+    :return: x, y to plot
+    """
+    n_columns = int(n_columns)
+    # one point beyond the view on each side so that the line reaches
+    # the edges of the axes
+    i_start = max(np.searchsorted(x, x_min, side='left') - 1, 0)
+    i_end = min(np.searchsorted(x, x_max, side='right') + 1, x.size)
+    x_view = x[i_start:i_end]
+    y_view = y[i_start:i_end]
+    if (n_columns < 1) or (x_max <= x_min) or \
+            (x_view.size <= 4 * n_columns):
+        return x_view, y_view
+    column = np.floor((x_view - x_min) / (x_max - x_min) *
+                      n_columns).astype(int)
+    np.clip(column, -1, n_columns, out=column)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(column)) + 1))
+    ends = np.append(starts[1:], column.size)
+    # nan are taken as neither lowest nor highest, and the first nan of
+    # each column is kept so that gaps in the line stay
+    nan = np.isnan(y_view)
+    keep = [starts, ends - 1,
+            _argreduceat(np.where(nan, np.inf, y_view), starts, ends,
+                         np.minimum),
+            _argreduceat(np.where(nan, -np.inf, y_view), starts, ends,
+                         np.maximum)]
+    if nan.any():
+        keep.append(_argreduceat(nan, starts, ends, np.maximum))
+    keep = np.unique(np.concatenate(keep))
+    return x_view[keep], y_view[keep]
+
+
+def _argreduceat(y, starts, ends, ufunc):
+    """
+    index of the first minimum or maximum in each of y[starts:ends],
+    y should not have nan
+    """
+    extremes = np.repeat(ufunc.reduceat(y, starts), ends - starts)
+    index = np.where(y == extremes, np.arange(y.size), y.size)
+    return np.minimum.reduceat(index, starts)
+
+
+def is_increasing(x):
+    """
+    return True if x can be used for decimate_minmax
+    """
+    return (x.size < 2) or bool(np.all(np.diff(x) >= 0.))
@@ -82,6 +82,15 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.comboBox_Symmetry.setCurrentText('cubic')
         self.tableWidget_DiffImgAzi.\
             setHorizontalHeaderLabels(['Notes', '2th', 'Azi', '2th', 'Azi'])
+        # jobs running in worker threads, see control/taskrunner.py
+        self.label_TaskStatus = QtWidgets.QLabel()
+        self.progressBar_Task = QtWidgets.QProgressBar()
+        self.progressBar_Task.setMaximumWidth(150)
+        self.pushButton_CancelTask = QtWidgets.QPushButton('Cancel')
+        for task_widget in [self.label_TaskStatus, self.progressBar_Task,
+                            self.pushButton_CancelTask]:
+            self.statusBar().addPermanentWidget(task_widget)
+            task_widget.setVisible(False)
         # navigation toolbar modification
         """
         self.ntb_WholePtn = QtWidgets.QPushButton()
@@ -116,6 +125,10 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         """
 
     def closeEvent(self, event):
+        task_runner = getattr(self, 'task_runner', None)
+        if task_runner is not None:
+            task_runner.cancel_all()
+            task_runner.wait()
         self.deleteLater()
         event.accept()
 
@@ -12,6 +12,7 @@ from matplotlib.gridspec import GridSpec
 import matplotlib.style as mplstyle
 from matplotlib.transforms import Bbox
 from matplotlib import cbook
+from utils import decimate_minmax, is_increasing
 
 DEBUG = False
 
@@ -108,6 +109,16 @@ class FigureCanvasQTAgg_modified(FigureCanvasAgg, FigureCanvasQT_modified):
         finally:
             painter.end()
 
+    def blit(self, bbox=None):
+        """
+        repaint only the region of bbox from the Agg buffer
+        """
+        if bbox is None and self.figure:
+            bbox = self.figure.bbox
+        l, b, w, h = [int(pt / self.device_pixel_ratio) for pt in bbox.bounds]
+        t = b + h
+        self.repaint(l, self.rect().height() - t, w, h)
+
     def print_figure(self, *args, **kwargs):
         super().print_figure(*args, **kwargs)
         self.draw()
@@ -136,6 +147,229 @@ class MplCanvas(FigureCanvasQTAgg_modified):
             self, QtWidgets.QSizePolicy.Expanding,
             QtWidgets.QSizePolicy.Expanding)
         FigureCanvasQTAgg_modified.updateGeometry(self)
+        # artists in blit_artists are animated.  They are drawn on top of
+        # blit_background after every full draw and can be updated alone
+        # with update_blit_artists
+        self.blit_artists = []
+        self.blit_background = None
+        # handles of JCPDS artists, see MplController._plot_jcpds
+        self.jcpds_layer = None
+        self.mpl_connect('draw_event', self._on_draw)
+        # lines in ax_pattern plotted with plot_decimated, as
+        # [line, x, y].  They are decimated again on zoom, pan and resize
+        self.decimated_lines = []
+        self.decimation_on = True
+        self._decimation_stale = False
+        self.mpl_connect('resize_event', self._mark_decimation_stale)
+        self._connect_xlim_changed()
+        # waterfall heat map in ax_cake, as [image, heat_map, view].  The
+        # part in view is made again on zoom, pan and resize
+        self.heat_map = None
+        # artists kept between updates by key, see start_update.  The
+        # axes are made again only when layout changes.
+        self.retained = {}
+        self._retained_used = set()
+        self.layout = (1, self.night_view)
+
+    def add_blit_artist(self, artist):
+        artist.set_animated(True)
+        self.blit_artists.append(artist)
+        return artist
+
+    def _on_draw(self, event):
+        # savefig draws animated artists with the rest
+        if self.is_saving():
+            return
+        self.blit_background = self.copy_from_bbox(self.fig.bbox)
+        self._draw_blit_artists()
+
+    def _draw_blit_artists(self):
+        for artist in self.blit_artists:
+            if artist.figure is self.fig:
+                self.fig.draw_artist(artist)
+
+    def update_blit_artists(self):
+        """
+        redraw only blit_artists
+        :return: False if there is no background to draw on
+        """
+        if self.blit_background is None:
+            return False
+        self.restore_region(self.blit_background)
+        self._draw_blit_artists()
+        self.blit(self.fig.bbox)
+        return True
+
+    def start_update(self, h_cake):
+        """
+        prepare the axes for a new plot.  The figure is cleared only if
+        the height of ax_cake or the night view changed.  Otherwise all
+        artists are removed except retained ones, which are updated in
+        place by the next plot and removed by remove_unused_retained if
+        they are not.
+
+        :param h_cake: height of ax_cake, 1 to hide it
+        """
+        layout = (h_cake, self.night_view)
+        if layout != self.layout:
+            self.resize_axes(h_cake)
+            return
+        kept = set(id(artist) for artist in self.retained.values())
+        for ax in [self.ax_pattern, self.ax_cake]:
+            for artist in list(ax.lines) + list(ax.collections) + \
+                    list(ax.patches) + list(ax.texts) + list(ax.images) + \
+                    list(ax.artists) + list(ax.tables):
+                if id(artist) not in kept:
+                    artist.remove()
+            if ax.legend_ is not None:
+                ax.legend_.remove()
+            ax.set_autoscale_on(True)
+        if h_cake >= 10:
+            self.ax_cake.set_ylabel("Azimuth (degrees)")
+        else:
+            self.ax_cake.set_ylabel('')
+        self.blit_artists = []
+        self.blit_background = None
+        self.jcpds_layer = None
+        self.decimated_lines = []
+        self.heat_map = None
+        self._retained_used = set()
+        # views in the zoom history are of the last plot
+        if self.toolbar is not None:
+            self.toolbar.update()
+
+    def get_retained(self, key):
+        """
+        :return: artist kept under key by retain, or None
+        """
+        artist = self.retained.get(key)
+        if artist is not None:
+            self._retained_used.add(key)
+        return artist
+
+    def retain(self, key, artist):
+        """
+        keep artist between updates, see start_update
+        """
+        self.retained[key] = artist
+        self._retained_used.add(key)
+        return artist
+
+    def remove_unused_retained(self):
+        """
+        remove retained artists which were not used since start_update
+        and reset data limits to the artists left.  Call this before
+        transient artists are added.
+        """
+        for key in list(self.retained.keys()):
+            if key not in self._retained_used:
+                self.retained.pop(key).remove()
+        self.ax_pattern.relim()
+        self.ax_cake.relim()
+
+    def plot_decimated(self, x, y, key=None, **kwargs):
+        """
+        plot a line in ax_pattern, but draw only the points that can be
+        seen at screen resolution, see utils.decimate_minmax
+
+        :param key: if given, the line is retained and only gets new data
+            and kwargs in the next updates
+        """
+        line = None
+        if key is not None:
+            line = self.get_retained(key)
+        # full data here so that autoscale sees the same data limits
+        if line is None:
+            line = self.ax_pattern.plot(x, y, **kwargs)[0]
+            if key is not None:
+                self.retain(key, line)
+        else:
+            line.set_data(x, y)
+            line.update(kwargs)
+        if is_increasing(x):
+            self.decimated_lines.append([line, x, y])
+            self._decimation_stale = True
+        return line
+
+    def _update_decimated_lines(self):
+        x_min, x_max = sorted(self.ax_pattern.get_xlim())
+        n_columns = self.ax_pattern.bbox.width
+        for line, x, y in self.decimated_lines:
+            if self.decimation_on:
+                line.set_data(*decimate_minmax(x, y, x_min, x_max, n_columns))
+            else:
+                line.set_data(x, y)
+        self._decimation_stale = False
+
+    def show_heat_map(self, heat_map, **kwargs):
+        """
+        show a HeatMap in ax_cake.  The image is made for the view when
+        the canvas is drawn, see ds_powdiff.HeatMap.get_image
+        """
+        image = self.get_retained('heat_map')
+        if image is None:
+            image = self.retain('heat_map', self.ax_cake.imshow(
+                np.full((1, 1), np.nan), origin='lower', aspect='auto',
+                interpolation='nearest', extent=heat_map.get_extent(),
+                clim=heat_map.clim, **kwargs))
+        else:
+            image.set_data(np.full((1, 1), np.nan))
+            image.set_extent(heat_map.get_extent())
+            image.set_clim(heat_map.clim)
+            image.update(kwargs)
+        # image extent changes with the view, not the limits
+        self.ax_cake.set_autoscale_on(False)
+        self.heat_map = [image, heat_map, None]
+        return image
+
+    def _update_heat_map(self, full_resolution=False):
+        image, heat_map, view = self.heat_map
+        bbox = self.ax_cake.bbox
+        new_view = (tuple(self.ax_cake.get_xlim()),
+                    tuple(self.ax_cake.get_ylim()),
+                    bbox.width, bbox.height, full_resolution)
+        if new_view == view:
+            return
+        if full_resolution:
+            part = heat_map.get_image(new_view[0], new_view[1])
+        else:
+            part = heat_map.get_image(new_view[0], new_view[1],
+                                      width=bbox.width, height=bbox.height)
+        if part is None:
+            image.set_visible(False)
+        else:
+            image.set_data(part[0])
+            image.set_extent(part[1])
+            image.set_visible(True)
+        self.heat_map[2] = new_view
+
+    def _mark_decimation_stale(self, *args):
+        self._decimation_stale = True
+
+    def _connect_xlim_changed(self):
+        self.ax_pattern.callbacks.connect(
+            'xlim_changed', self._mark_decimation_stale)
+
+    def draw(self):
+        # decimate once for all limit changes since the last draw
+        if self._decimation_stale:
+            self._update_decimated_lines()
+        if self.heat_map is not None:
+            self._update_heat_map()
+        super().draw()
+
+    def print_figure(self, *args, **kwargs):
+        # saved files may have higher resolution than the screen
+        self.decimation_on = False
+        self._update_decimated_lines()
+        if self.heat_map is not None:
+            self._update_heat_map(full_resolution=True)
+        try:
+            super().print_figure(*args, **kwargs)
+        finally:
+            self.decimation_on = True
+            self._mark_decimation_stale()
+        self.draw_idle()
 
     def _define_axes(self, h_cake):
         self.gs = GridSpec(100, 1)
@@ -150,7 +384,16 @@ class MplCanvas(FigureCanvasQTAgg_modified):
 
     def resize_axes(self, h_cake):
         self.fig.clf()
+        self.layout = (h_cake, self.night_view)
+        self.retained = {}
+        self._retained_used = set()
+        self.blit_artists = []
+        self.blit_background = None
+        self.jcpds_layer = None
+        self.decimated_lines = []
+        self.heat_map = None
         self._define_axes(h_cake)
+        self._connect_xlim_changed()
         if h_cake == 1:
             self.ax_cake.tick_params(
                 axis='y', colors=self.objColor, labelleft=False)
@@ -170,6 +413,7 @@ class MplCanvas(FigureCanvasQTAgg_modified):
                 mplstyle.use('dark_background')
             self.bgColor = 'black'
             self.objColor = 'white'
+            self.night_view = True
         else:
             try:
                 mplstyle.use(
@@ -178,6 +422,7 @@ class MplCanvas(FigureCanvasQTAgg_modified):
                 mplstyle.use('classic')
             self.bgColor = 'white'
             self.objColor = 'black'
+            self.night_view = False
 #        self.fig.clf()
 #        self.ax_pattern.cla()
 #        Cursor(self.ax, useblit=True, color=self.objColor, linewidth=2 )
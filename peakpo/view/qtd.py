@@ -877,6 +877,15 @@ class Ui_MainWindow(object):
         self.horizontalSlider_WaterfallGaps.setOrientation(QtCore.Qt.Horizontal)
         self.horizontalSlider_WaterfallGaps.setObjectName("horizontalSlider_WaterfallGaps")
         self.verticalLayout_17.addWidget(self.horizontalSlider_WaterfallGaps)
+        self.checkBox_WaterfallHeatMap = QtWidgets.QCheckBox(self.groupBox_6)
+        self.checkBox_WaterfallHeatMap.setChecked(False)
+        self.checkBox_WaterfallHeatMap.setObjectName("checkBox_WaterfallHeatMap")
+        self.verticalLayout_17.addWidget(self.checkBox_WaterfallHeatMap)
+        self.comboBox_HeatMapYAxis = QtWidgets.QComboBox(self.groupBox_6)
+        self.comboBox_HeatMapYAxis.setObjectName("comboBox_HeatMapYAxis")
+        self.comboBox_HeatMapYAxis.addItem("")
+        self.comboBox_HeatMapYAxis.addItem("")
+        self.verticalLayout_17.addWidget(self.comboBox_HeatMapYAxis)
         self.verticalLayout_2.addWidget(self.groupBox_6)
         self.frame_27 = QtWidgets.QFrame(self.tab_Waterfall)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Fixed)
@@ -890,6 +899,15 @@ class Ui_MainWindow(object):
         self.gridLayout_12 = QtWidgets.QGridLayout(self.frame_27)
         self.gridLayout_12.setContentsMargins(3, 3, 3, 3)
         self.gridLayout_12.setObjectName("gridLayout_12")
+        self.pushButton_AddDirectory = QtWidgets.QPushButton(self.frame_27)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.pushButton_AddDirectory.sizePolicy().hasHeightForWidth())
+        self.pushButton_AddDirectory.setSizePolicy(sizePolicy)
+        self.pushButton_AddDirectory.setMaximumSize(QtCore.QSize(32, 25))
+        self.pushButton_AddDirectory.setObjectName("pushButton_AddDirectory")
+        self.gridLayout_12.addWidget(self.pushButton_AddDirectory, 0, 1, 1, 1)
         self.pushButton_AddPatterns = QtWidgets.QPushButton(self.frame_27)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Fixed)
         sizePolicy.setHorizontalStretch(0)
@@ -1968,6 +1986,15 @@ class Ui_MainWindow(object):
         self.gridLayout_5.addItem(spacerItem4, 1, 1, 1, 1)
         spacerItem5 = QtWidgets.QSpacerItem(40, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
         self.gridLayout_5.addItem(spacerItem5, 2, 1, 1, 1)
+        self.label_BGEngine = QtWidgets.QLabel(self.groupBox_7)
+        self.label_BGEngine.setObjectName("label_BGEngine")
+        self.gridLayout_5.addWidget(self.label_BGEngine, 3, 0, 1, 1)
+        self.comboBox_BGEngine = QtWidgets.QComboBox(self.groupBox_7)
+        self.comboBox_BGEngine.setObjectName("comboBox_BGEngine")
+        self.comboBox_BGEngine.addItem("")
+        self.comboBox_BGEngine.addItem("")
+        self.comboBox_BGEngine.addItem("")
+        self.gridLayout_5.addWidget(self.comboBox_BGEngine, 3, 2, 1, 1)
         self.verticalLayout_8.addWidget(self.groupBox_7)
         self.groupBox_4 = QtWidgets.QGroupBox(self.tab_Bkgn)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Fixed)
@@ -2109,6 +2136,19 @@ class Ui_MainWindow(object):
         self.pushButton_PkFtSectionSavetoXLS = QtWidgets.QPushButton(self.frame_28)
         self.pushButton_PkFtSectionSavetoXLS.setObjectName("pushButton_PkFtSectionSavetoXLS")
         self.gridLayout_20.addWidget(self.pushButton_PkFtSectionSavetoXLS, 1, 2, 1, 1)
+        self.pushButton_PkFtSectionPropagate = QtWidgets.QPushButton(self.frame_28)
+        self.pushButton_PkFtSectionPropagate.setObjectName("pushButton_PkFtSectionPropagate")
+        self.gridLayout_20.addWidget(self.pushButton_PkFtSectionPropagate, 2, 0, 1, 1)
+        self.spinBox_PropagateChains = QtWidgets.QSpinBox(self.frame_28)
+        self.spinBox_PropagateChains.setMinimum(1)
+        self.spinBox_PropagateChains.setMaximum(16)
+        self.spinBox_PropagateChains.setProperty("value", 2)
+        self.spinBox_PropagateChains.setObjectName("spinBox_PropagateChains")
+        self.gridLayout_20.addWidget(self.spinBox_PropagateChains, 2, 1, 1, 1)
+        self.checkBox_PropagateEOS = QtWidgets.QCheckBox(self.frame_28)
+        self.checkBox_PropagateEOS.setChecked(True)
+        self.checkBox_PropagateEOS.setObjectName("checkBox_PropagateEOS")
+        self.gridLayout_20.addWidget(self.checkBox_PropagateEOS, 2, 2, 1, 1)
         self.verticalLayout_15.addWidget(self.frame_28)
         self.tableWidget_PkFtSections = QtWidgets.QTableWidget(self.tab_PeakFitSection)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
@@ -2160,6 +2200,11 @@ class Ui_MainWindow(object):
         self.pushButton_ClearSection = QtWidgets.QPushButton(self.groupBox_35)
         self.pushButton_ClearSection.setObjectName("pushButton_ClearSection")
         self.gridLayout_17.addWidget(self.pushButton_ClearSection, 1, 1, 1, 1)
+        self.comboBox_FitEngine = QtWidgets.QComboBox(self.groupBox_35)
+        self.comboBox_FitEngine.setObjectName("comboBox_FitEngine")
+        self.comboBox_FitEngine.addItem("")
+        self.comboBox_FitEngine.addItem("")
+        self.gridLayout_17.addWidget(self.comboBox_FitEngine, 1, 3, 1, 1)
         self.verticalLayout_16.addWidget(self.groupBox_35)
         self.groupBox_32 = QtWidgets.QGroupBox(self.tab_PeakFitPeaks)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Fixed)
@@ -2326,6 +2371,20 @@ class Ui_MainWindow(object):
         self.checkBox_UseTempBGSub.setChecked(True)
         self.checkBox_UseTempBGSub.setObjectName("checkBox_UseTempBGSub")
         self.gridLayout_6.addWidget(self.checkBox_UseTempBGSub, 0, 1, 1, 1)
+        self.checkBox_PrecomputeCake = QtWidgets.QCheckBox(self.groupBox_10)
+        self.checkBox_PrecomputeCake.setChecked(True)
+        self.checkBox_PrecomputeCake.setObjectName("checkBox_PrecomputeCake")
+        self.gridLayout_6.addWidget(self.checkBox_PrecomputeCake, 2, 0, 1, 1)
+        self.spinBox_PrecomputeWorkers = QtWidgets.QSpinBox(self.groupBox_10)
+        self.spinBox_PrecomputeWorkers.setMinimum(1)
+        self.spinBox_PrecomputeWorkers.setMaximum(16)
+        self.spinBox_PrecomputeWorkers.setProperty("value", 2)
+        self.spinBox_PrecomputeWorkers.setObjectName("spinBox_PrecomputeWorkers")
+        self.gridLayout_6.addWidget(self.spinBox_PrecomputeWorkers, 2, 1, 1, 1)
+        self.label_CakeQueue = QtWidgets.QLabel(self.groupBox_10)
+        self.label_CakeQueue.setText("")
+        self.label_CakeQueue.setObjectName("label_CakeQueue")
+        self.gridLayout_6.addWidget(self.label_CakeQueue, 3, 0, 1, 2)
         self.verticalLayout_7.addWidget(self.groupBox_10)
         self.groupBox_12 = QtWidgets.QGroupBox(self.tab_Process)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Fixed)
@@ -2592,6 +2651,7 @@ class Ui_MainWindow(object):
         self.label_4.setBuddy(self.spinBox_BGParam0)
         self.label_6.setBuddy(self.spinBox_BGParam2)
         self.label_5.setBuddy(self.spinBox_BGParam1)
+        self.label_BGEngine.setBuddy(self.comboBox_BGEngine)
 
         self.retranslateUi(MainWindow)
         self.tabWidget.setCurrentIndex(0)
@@ -2713,8 +2773,15 @@ class Ui_MainWindow(object):
         self.checkBox_IntNorm.setText(_translate("MainWindow", "Normalize intensity for same scale"))
         self.label_18.setText(_translate("MainWindow", "Waterfall gap"))
         self.horizontalSlider_WaterfallGaps.setToolTip(_translate("MainWindow", "Change size of vertical gaps between waterfall patterns"))
+        self.checkBox_WaterfallHeatMap.setToolTip(_translate("MainWindow", "Show waterfall patterns as an image in the upper panel, for long series"))
+        self.checkBox_WaterfallHeatMap.setText(_translate("MainWindow", "Heat map"))
+        self.comboBox_HeatMapYAxis.setToolTip(_translate("MainWindow", "Vertical axis of the heat map.  Pressures are read from the DPP files of the patterns"))
+        self.comboBox_HeatMapYAxis.setItemText(0, _translate("MainWindow", "File index"))
+        self.comboBox_HeatMapYAxis.setItemText(1, _translate("MainWindow", "Pressure"))
         self.pushButton_AddPatterns.setToolTip(_translate("MainWindow", "Add CHI files to waterfall list"))
         self.pushButton_AddPatterns.setText(_translate("MainWindow", "+"))
+        self.pushButton_AddDirectory.setToolTip(_translate("MainWindow", "Add all CHI files in a directory to waterfall list"))
+        self.pushButton_AddDirectory.setText(_translate("MainWindow", "📂"))
         self.pushButton_DownPattern.setToolTip(_translate("MainWindow", "Move down highlighted pattern in the waterfall list"))
         self.pushButton_DownPattern.setText(_translate("MainWindow", "↓"))
         self.pushButton_UpPattern.setToolTip(_translate("MainWindow", "Move up highlighted pattern in the waterfall list"))
@@ -2847,6 +2914,11 @@ class Ui_MainWindow(object):
         self.spinBox_BGParam1.setToolTip(_translate("MainWindow", "Number of order for fit function"))
         self.label_5.setText(_translate("MainWindow", "N Iteration (20):"))
         self.spinBox_BGParam2.setToolTip(_translate("MainWindow", "Number of iterations"))
+        self.label_BGEngine.setText(_translate("MainWindow", "Engine:"))
+        self.comboBox_BGEngine.setToolTip(_translate("MainWindow", "Background engine.  Chebyshev fits a polynomial to a smoothed pattern, SNIP clips peaks, ALS fits a smooth curve under the pattern."))
+        self.comboBox_BGEngine.setItemText(0, _translate("MainWindow", "Chebyshev"))
+        self.comboBox_BGEngine.setItemText(1, _translate("MainWindow", "SNIP"))
+        self.comboBox_BGEngine.setItemText(2, _translate("MainWindow", "ALS"))
         self.groupBox_4.setTitle(_translate("MainWindow", "Range for background fit"))
         self.label_2.setText(_translate("MainWindow", "Minimum two theta"))
         self.doubleSpinBox_Background_ROI_max.setToolTip(_translate("MainWindow", "Max two theta angle for background fit"))
@@ -2868,6 +2940,12 @@ class Ui_MainWindow(object):
         self.pushButton_PkFtSectionImport.setText(_translate("MainWindow", "Import"))
         self.pushButton_PkFtSectionSavetoXLS.setToolTip(_translate("MainWindow", "Save all fitting results in an excel file"))
         self.pushButton_PkFtSectionSavetoXLS.setText(_translate("MainWindow", "Save XLS"))
+        self.pushButton_PkFtSectionPropagate.setToolTip(_translate("MainWindow", "Fit these sections to all chi files in the folder in order of pressure and save to their dpp files"))
+        self.pushButton_PkFtSectionPropagate.setText(_translate("MainWindow", "Propagate"))
+        self.spinBox_PropagateChains.setToolTip(_translate("MainWindow", "Number of chains fitted at the same time"))
+        self.spinBox_PropagateChains.setSuffix(_translate("MainWindow", " chains"))
+        self.checkBox_PropagateEOS.setToolTip(_translate("MainWindow", "Move peaks by the shifts predicted from the JCPDS equation of state before fitting"))
+        self.checkBox_PropagateEOS.setText(_translate("MainWindow", "EOS shift"))
         self.tabWidget_PeakFit.setTabText(self.tabWidget_PeakFit.indexOf(self.tab_PeakFitSection), _translate("MainWindow", "Sections"))
         self.groupBox_35.setTitle(_translate("MainWindow", "Section"))
         self.pushButton_ConductFitting.setToolTip(_translate("MainWindow", "Conduct fitting"))
@@ -2880,6 +2958,9 @@ class Ui_MainWindow(object):
         self.pushButton_PkSave.setText(_translate("MainWindow", "Save"))
         self.pushButton_ClearSection.setToolTip(_translate("MainWindow", "Clear current fitting result"))
         self.pushButton_ClearSection.setText(_translate("MainWindow", "Clear"))
+        self.comboBox_FitEngine.setToolTip(_translate("MainWindow", "Fitting engine for this section.  Fast fits all peaks together with analytic derivatives, for sections with many peaks."))
+        self.comboBox_FitEngine.setItemText(0, _translate("MainWindow", "lmfit"))
+        self.comboBox_FitEngine.setItemText(1, _translate("MainWindow", "Fast"))
         self.groupBox_32.setTitle(_translate("MainWindow", "Add/Remove peaks"))
         self.pushButton_AddRemoveFromMouse.setToolTip(_translate("MainWindow", "Get starting peak positions from mouse click"))
         self.pushButton_AddRemoveFromMouse.setText(_translate("MainWindow", "From mouse"))
@@ -2902,6 +2983,10 @@ class Ui_MainWindow(object):
         self.pushButton_DelTempCHI.setToolTip(_translate("MainWindow", "Delete temporary CHI files"))
         self.pushButton_DelTempCHI.setText(_translate("MainWindow", "Del temp chi"))
         self.checkBox_UseTempBGSub.setText(_translate("MainWindow", "Use for bgsub"))
+        self.checkBox_PrecomputeCake.setToolTip(_translate("MainWindow", "Make temporary cakes for all images in the folder in the background once a PONI is set"))
+        self.checkBox_PrecomputeCake.setText(_translate("MainWindow", "Precompute cakes"))
+        self.spinBox_PrecomputeWorkers.setToolTip(_translate("MainWindow", "Number of images caked at the same time"))
+        self.spinBox_PrecomputeWorkers.setSuffix(_translate("MainWindow", " workers"))
         self.groupBox_12.setTitle(_translate("MainWindow", "Session (backward compatibility)"))
         self.pushButton_LoadPPSS.setToolTip(_translate("MainWindow", "Load PPSS file"))
         self.pushButton_LoadPPSS.setText(_translate("MainWindow", "Load ppss"))
@@ -0,0 +1,48 @@
+import os
+import sys
+import numpy as np
+
+# modules of peakpo import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'peakpo'))
+from utils import decimate_minmax  # noqa: E402
+
+
+def _make_line():
+    x = np.linspace(0., 1., 20001)
+    y = np.sin(x * 50.) + np.exp(-((x - 0.3) / 1.e-4) ** 2) * 10.
+    return x, y
+
+
+def test_peaks_are_kept():
+    x, y = _make_line()
+    x_d, y_d = decimate_minmax(x, y, 0., 1., 100)
+    assert x_d.size < x.size / 10
+    assert y_d.max() == y.max()
+    assert y_d.min() == y.min()
+    assert np.all(np.diff(x_d) > 0.)
+
+
+def test_nan_gaps():
+    x, y = _make_line()
+    y[5000:6000] = np.nan
+    y[12345] = np.nan
+    x_d, y_d = decimate_minmax(x, y, 0., 1., 1000)
+    assert x_d.size < x.size
+    assert np.nanmax(y_d) == np.nanmax(y)
+    assert np.nanmin(y_d) == np.nanmin(y)
+    # line breaks where the data has gaps
+    gaps = x_d[np.isnan(y_d)]
+    assert np.any((gaps >= x[5000]) & (gaps <= x[5999]))
+    assert x[12345] in gaps
+    # no point of a gap is drawn as data
+    in_gap = (x_d >= x[5000]) & (x_d <= x[5999])
+    assert np.all(np.isnan(y_d[in_gap]))
+
+
+def test_all_nan():
+    x, __ = _make_line()
+    y = np.full(x.size, np.nan)
+    x_d, y_d = decimate_minmax(x, y, 0.2, 0.8, 50)
+    assert x_d.size > 0
+    assert np.all(np.isnan(y_d))